@@ -330,13 +330,11 @@ def create_app(test_config=None):
 
         return _redirect('main', content_id='user_form', user_id=user.id)
 
-    @app.route('/get_content', methods=['GET', 'POST'])
-    def get_content():
-        if flask.request.method == 'GET':
-            content_kwargs = flask.request.args.to_dict()
-        else:
-            content_kwargs = flask.request.form.to_dict()
-
+    def render_content(content_kwargs, raiseError=False):
+        """ Render the template for a given content_id, retrieving
+        its data from the DataContent. If raiseError is True, exceptions
+        are raised instead of rendering the error dialog.
+        """
         content_id = content_kwargs['content_id']
 
         if content_id in NO_LOGIN_CONTENT or app.user.is_authenticated:
@@ -346,6 +344,8 @@ def create_app(test_config=None):
 
                 kwargs = app.dc.get(**content_kwargs)
             except Exception as e:
+                if raiseError:
+                    raise
                 import traceback
                 tb = traceback.format_exc()
                 error = {
@@ -371,8 +371,21 @@ def create_app(test_config=None):
         error = {
             "message": "Template '%s' not found." % content_template
         }
+        if raiseError:
+            raise Exception(error['message'])
         return flask.render_template('error_dialog.html', error=error)
 
+    app.render_content = render_content
+
+    @app.route('/get_content', methods=['GET', 'POST'])
+    def get_content():
+        if flask.request.method == 'GET':
+            content_kwargs = flask.request.args.to_dict()
+        else:
+            content_kwargs = flask.request.form.to_dict()
+
+        return render_content(content_kwargs)
+
     @app.template_filter('basename')
     def basename(filename):
         return os.path.basename(filename) if filename else ''
@@ -468,13 +481,77 @@ def create_app(test_config=None):
                                   charset="utf-8", decode_responses=True)
         app.r.ping()
 
-    app.dm = DataManager(app.instance_path, user=app.user, redis=app.r)
+    # Statistics of SQL statements, slow ones (over EMHUB_SLOW_QUERY seconds)
+    # are logged. Set EMHUB_SLOW_QUERY = 0 in config.py to disable it.
+    # Monthly usage aggregates (used by multi-year reports) are updated
+    # after each commit. Set USAGE_AGGREGATES = False in config.py to
+    # disable it (reports will then read all bookings)
+    app.dm = DataManager(app.instance_path, user=app.user, redis=app.r,
+                         slowQuery=float(app.config.get('EMHUB_SLOW_QUERY', 0.5)),
+                         usageAggregates=app.config.get('USAGE_AGGREGATES', True))
+
+    from .reports.jobs import ReportJobManager
+    app.jobs = ReportJobManager(app)
+
+    # Detect repeated queries (N+1) when computing content in
+    # development or testing mode. In testing mode it will raise an error
+    # unless QUERY_DETECTOR_FAIL = False. Set QUERY_DETECTOR_THRESHOLD = 0
+    # to disable it or a positive value to enable it in production.
+    app.query_detector = None
+    testing = app.is_devel or app.testing
+    detector_threshold = app.config.get('QUERY_DETECTOR_THRESHOLD',
+                                        50 if testing else 0)
+    if detector_threshold:
+        from .data.query_log import RepeatedQueryDetector
+        app.query_detector = RepeatedQueryDetector(
+            threshold=detector_threshold,
+            fail=app.config.get('QUERY_DETECTOR_FAIL', app.testing))
+        app.dm.add_query_listener(app.query_detector.record)
+
+    # Request, SQL and Redis metrics exposed at /api/metrics
+    # can be disabled with EMHUB_METRICS = False in config.py
+    app.metrics = None
+    if app.config.get('EMHUB_METRICS', True):
+        from .utils.metrics import Metrics
+        app.metrics = Metrics()
+        app.dm.add_query_listener(app.metrics.record_sql)
+        if app.r is not None:
+            app.metrics.wrap_redis(app.r)
+
+        @app.before_request
+        def metrics_start_request():
+            app.metrics.start_request()
+
+        @app.after_request
+        def metrics_end_request(response):
+            request = flask.request
+            content_id = None
+            if request.endpoint in ['main', 'get_content']:
+                content_id = app.dc.content_label(
+                    request.values.get('content_id', None))
+            size = None if response.is_streamed else response.content_length
+            app.metrics.end_request(request.endpoint, request.method,
+                                    response.status_code, size=size,
+                                    content_id=content_id)
+            return response
 
     from flaskext.markdown import Markdown
     Markdown(app)
 
     app.jinja_env.filters['pretty_datetime'] = app.dm.local_datetime
 
+    # Limit concurrent requests to heavy image endpoints, the limit can be
+    # set with ADMISSION_MAX_ACTIVE (0 to disable), the queue size with
+    # ADMISSION_MAX_QUEUE and the maximum wait (seconds) with ADMISSION_MAX_WAIT
+    app.admission = None
+    if max_active := app.config.get('ADMISSION_MAX_ACTIVE', os.cpu_count() or 4):
+        from .utils.admission import AdmissionController
+        app.admission = AdmissionController(
+            max_active=max_active,
+            max_queue=app.config.get('ADMISSION_MAX_QUEUE', 32),
+            max_wait=app.config.get('ADMISSION_MAX_WAIT', 10),
+            metrics=app.metrics)
+
     extra_setup = load_module('app_setup')
     if extra_setup and 'setup_app' in dir(extra_setup):
         print(f"Extending app setup from: {extra_setup.__file__}")
@@ -36,6 +36,7 @@ and the server `DataManager`.
 """
 
 import os
+import math
 import time
 import json
 from glob import glob
@@ -51,6 +52,7 @@ import jwt
 from emtools.utils import Pretty, Color
 from emhub.utils import (datetime_from_isoformat, datetime_to_isoformat,
                          send_json_data, send_error)
+from emhub.utils.admission import admission_control
 
 
 api_bp = flask.Blueprint('api', __name__)
@@ -413,15 +415,13 @@ def get_bookings_range():
     )
     funcName = d.get('func', 'to_event')
     if funcName == 'to_event':
-        func = app.dc.booking_to_event
+        data = app.dc.bookings_to_events(bookings)
     elif funcName == 'to_json':
-        def to_json(b):
-            return b.json()
-        func = to_json
+        data = [b.json() for b in bookings]
     else:
         raise Exception(f"Unknown function {funcName}")
 
-    return send_json_data([func(b) for b in bookings])
+    return send_json_data(data)
 
 
 @api_bp.route('/update_booking', methods=['POST'])
@@ -470,9 +470,9 @@ def poll_sessions():
         sessions = app.dm.get_sessions(condition='status=="pending"')
         if sessions:
             data = []
-            for s in sessions:
+            events = app.dc.bookings_to_events([s.booking for s in sessions])
+            for s, e in zip(sessions, events):
                 b = s.booking
-                e = app.dc.booking_to_event(b)
                 data.append({
                     'id': s.id,
                     'name': s.name,
@@ -620,6 +620,7 @@ def get_session_run():
 
 
 @api_bp.route("/get_classes2d", methods=['POST'])
+@admission_control
 def get_classes2d():
     """ Load 2d classification data. """
     kwargs = request.form.to_dict()
@@ -721,16 +722,57 @@ def update_task():
 @api_bp.post('/get_new_tasks')
 def get_new_tasks():
     """ This function will return tasks for a given worker when they
-    are available. If not, it will be sleeping waiting for it.
+    are available. If not, it will wait for them at most 'timeout' seconds
+    (TASKS_WAIT_TIMEOUT in config.py, 30 by default).
     """
     def _get_new_tasks(**attrs):
         worker = validate_worker_token(attrs['token'])
-        tasks = app.dm.get_worker_stream(worker, update=True).get_new_tasks()
-        return tasks
+        ws = app.dm.get_worker_stream(worker, update=True)
+        return ws.get_new_tasks(timeout=_tasks_timeout(attrs))
 
     return _handle_item(_get_new_tasks, 'tasks')
 
 
+@api_bp.post('/stream_new_tasks')
+def stream_new_tasks():
+    """ Stream new tasks for a given worker as server-sent events.
+    The connection is kept open (with keep-alive comments) and closed
+    after TASKS_STREAM_TIMEOUT seconds, then the worker should reconnect.
+    """
+    try:
+        attrs = request.json['attrs']
+        worker = validate_worker_token(attrs['token'])
+        ws = app.dm.get_worker_stream(worker, update=True)
+        timeout = _tasks_timeout(attrs)
+    except Exception as e:
+        return send_error('ERROR from Server: %s' % e)
+
+    stream_timeout = app.config.get('TASKS_STREAM_TIMEOUT', 600)
+
+    def _events():
+        start = time.time()
+        while time.time() - start < stream_timeout:
+            if tasks := ws.get_new_tasks(timeout=timeout):
+                yield f"data: {json.dumps({'tasks': tasks})}\n\n"
+            else:
+                yield ": keep-alive\n\n"
+
+    return flask.Response(flask.stream_with_context(_events()),
+                          mimetype='text/event-stream',
+                          headers={'Cache-Control': 'no-cache'})
+
+
+def _tasks_timeout(attrs):
+    """ Wait time (in seconds) for new tasks, bounded between 1 second
+    and TASKS_WAIT_TIMEOUT, to avoid clients polling in a busy loop. """
+    max_timeout = app.config.get('TASKS_WAIT_TIMEOUT', 30)
+    timeout = attrs.get('timeout', max_timeout)
+    if (isinstance(timeout, bool) or not isinstance(timeout, (int, float))
+            or math.isnan(timeout)):
+        raise Exception(f"Invalid timeout value: {timeout}")
+    return max(1.0, min(float(timeout), max_timeout))
+
+
 @api_bp.post('/get_pending_tasks')
 def get_pending_tasks():
     """ This function will return pending tasks for a given worker.
@@ -778,6 +820,118 @@ def get_workers():
     return _handle_item(app.dc.get_workers, 'workers')
 
 
+# ---------------------------- METRICS ----------------------------------------
+
+@api_bp.route('/metrics', methods=['GET'])
+def metrics():
+    """ Export request, SQL and Redis metrics in Prometheus text format.
+    Metrics are only returned to logged admin users, or if the value of
+    EMHUB_METRICS_TOKEN (in config.py) is provided as a Bearer token in
+    the Authorization header.
+    """
+    if app.metrics is None:
+        return send_error('Metrics are disabled.')
+
+    token = app.config.get('EMHUB_METRICS_TOKEN', None)
+    authorized = (token and
+                  request.headers.get('Authorization', '') == f'Bearer {token}')
+    if not authorized and not (app.user.is_authenticated and app.user.is_admin):
+        return flask.Response('Unauthorized', status=401)
+
+    return flask.Response(app.metrics.render(),
+                          mimetype='text/plain; version=0.0.4')
+
+
+# ---------------------------- REPORT JOBS ------------------------------------
+
+@api_bp.route('/create_report_job', methods=['POST'])
+@flask_login.login_required
+def create_report_job():
+    """ Submit a report to be computed in background.
+
+    Arguments are expected in ``request.json['attrs']``, with the
+    ``content_id`` of the report and the same params used for /get_content.
+    """
+    def _create_report_job(**attrs):
+        params = dict(attrs)
+        content_id = params.pop('content_id')
+        return app.jobs.submit(content_id, params, app.user).json()
+
+    return _handle_item(_create_report_job, 'job')
+
+
+@api_bp.route('/get_report_job', methods=['POST'])
+@flask_login.login_required
+def get_report_job():
+    """ Return the status of a report job and its result (rendered html)
+    if it has finished. """
+    def _get_report_job(**attrs):
+        return _get_job(attrs['job_id']).json(result=True)
+
+    return _handle_item(_get_report_job, 'job')
+
+
+@api_bp.route('/stream_report_job', methods=['GET'])
+@flask_login.login_required
+def stream_report_job():
+    """ Stream the progress of a report job as server-sent events.
+    The last event contains the job result.
+    """
+    try:
+        job = _get_job(request.args['job_id'])
+    except Exception as e:
+        return send_error(str(e))
+
+    def _events():
+        last = None
+        while True:
+            finished = job.is_finished
+            current = (job.status, job.progress, job.message)
+            if finished or current != last:
+                last = current
+                data = json.dumps(job.json(result=finished))
+                yield f"data: {data}\n\n"
+            if finished:
+                break
+            job.wait_change(timeout=1)
+
+    return flask.Response(flask.stream_with_context(_events()),
+                          mimetype='text/event-stream',
+                          headers={'Cache-Control': 'no-cache'})
+
+
+def _get_job(job_id):
+    job = app.jobs.get(job_id)
+    if job is None or job.user_id != app.user.id:
+        raise Exception(f"Invalid report job id: {job_id}")
+    return job
+
+
+@api_bp.route('/export_data', methods=['GET'])
+@flask_login.login_required
+def export_data():
+    """ Stream tabular data of a report or booking list as CSV or XLSX.
+
+    Request args should contain the ``export_id``, the ``format``
+    (csv by default) and the same params used by the report content.
+    """
+    from emhub.utils.export import FORMATS, export_chunks
+
+    try:
+        kwargs = request.args.to_dict()
+        fmt = kwargs.pop('format', 'csv')
+        export_id = kwargs['export_id']
+        header, rows = app.dc.get_export(**kwargs)
+        chunks = export_chunks(fmt, header, rows)
+    except Exception as e:
+        return send_error(str(e))
+
+    return flask.Response(
+        flask.stream_with_context(chunks), mimetype=FORMATS[fmt],
+        headers={'Content-Disposition':
+                     f'attachment; filename="{export_id}.{fmt}"'})
+
+
 # ---------------------------- INVOICE PERIODS --------------------------------
 
 @api_bp.route('/get_invoice_periods', methods=['POST'])
@@ -1025,8 +1179,10 @@ def handle_booking(result_key, booking_func, booking_transform=None):
 
         fix_dates(attrs, *dates)
 
-        bt = booking_transform or app.dc.booking_to_event
-        return [bt(b) for b in booking_func(**attrs)]
+        bookings = booking_func(**attrs)
+        if booking_transform is None:
+            return app.dc.bookings_to_events(bookings)
+        return [booking_transform(b) for b in bookings]
 
     return _handle_item(handle, result_key)
 
@@ -27,15 +27,14 @@
 # **************************************************************************
 
 import os
-import io
-import base64
-from PIL import Image, ImageEnhance, ImageOps, ImageFilter
 
 import flask
 from flask import request
 from flask import current_app as app
+import flask_login
 
-from emhub.utils import send_json_data
+from emhub.utils import send_json_data, send_error
+from emhub.utils.admission import admission_control
 
 
 images_bp = flask.Blueprint('images', __name__)
@@ -66,6 +65,7 @@ def user_profile():
 
 
 @images_bp.route("/get_mic_data", methods=['POST'])
+@admission_control
 def get_mic_data():
     """ Load micrograph data from a given micId.
     There are two ways where to retrieve micrograph data:
@@ -89,6 +89,7 @@ def get_mic_data():
 
 
 @images_bp.route("/get_micrograph_gridsquare", methods=['POST'])
+@admission_control
 def get_micrograph_gridsquare():
     kwargs = request.form.to_dict()
     project = app.dm.get_processing_project(**kwargs)['project']
@@ -97,6 +98,7 @@ def get_micrograph_gridsquare():
 
 
 @images_bp.route("/get_volume_data", methods=['POST'])
+@admission_control
 def get_volume_data():
     """ Load volume data from a given run and output name.
     Input: projectId, runId, volName
@@ -109,3 +111,98 @@ def get_volume_data():
     vol = run.get_volume_data(volName, volume_data='slices', axis=axis)
 
     return send_json_data(vol)
+
+
+def _volume_path(kwargs):
+    """ Return the absolute path of the volume file_path in the processing
+    project of the given entry_id or session_id. The logged user should
+    have access to the entry's project or to the session. """
+    dm = app.dm
+    user = app.user
+
+    if 'entry_id' in kwargs:
+        entry = dm.get_entry_by(id=int(kwargs['entry_id']))
+        if entry is None:
+            raise Exception("Invalid entry id: %s" % kwargs['entry_id'])
+        p = entry.project
+        allowed = user.can_edit_project(p) or user.same_pi(p.user)
+        args = {'entry_id': entry.id}
+    elif 'session_id' in kwargs:
+        session = dm.get_session_by(id=int(kwargs['session_id']))
+        if session is None:
+            raise Exception("Invalid session id: %s" % kwargs['session_id'])
+        a = session.booking.application if session.booking else None
+        allowed = a is None or a.allows_access(user)
+        args = {'session_id': session.id}
+    else:
+        raise Exception("Expecting either 'entry_id' or 'session_id' "
+                        "to load a volume.")
+
+    if not allowed:
+        raise Exception("You do not have access to this volume.")
+
+    project = dm.get_processing_project(**args)['project']
+    projectPath = os.path.realpath(project.path)
+    path = os.path.realpath(project.join(kwargs['file_path']))
+    if not path.startswith(projectPath + os.sep) or not path.endswith('.mrc'):
+        raise Exception("Invalid volume path: %s" % kwargs['file_path'])
+    return path
+
+
+@images_bp.route("/get_volume_slices", methods=['POST'])
+@flask_login.login_required
+@admission_control
+def get_volume_slices():
+    """ Render slices of a volume on demand.
+    Input: entry_id or session_id, file_path, axis (x, y or z),
+        start, end (inclusive, default start), step and slice_dim
+    """
+    from emhub.data.processing import volumes
+
+    try:
+        kwargs = request.form.to_dict()
+        path = _volume_path(kwargs)
+        axis = kwargs.get('axis', 'z')
+        if axis not in volumes.AXES:
+            raise Exception("Invalid axis: %s" % axis)
+        start = int(kwargs.get('start', 0))
+        end = int(kwargs.get('end', start))
+        step = int(kwargs.get('step', 1))
+        slice_dim = int(kwargs.get('slice_dim', 128))
+        if step <= 0 or slice_dim <= 0:
+            raise Exception("Step and slice_dim should be positive.")
+        stats = volumes.get_volume_stats(path)
+    except Exception as e:
+        return send_error('ERROR from Server: %s' % e)
+
+    dim = stats['dimensions']['xyz'.index(axis)]
+    indexes = range(max(0, start), min(dim - 1, end) + 1, step)
+
+    return send_json_data({
+        'axis': axis,
+        'dimensions': stats['dimensions'],
+        'slices': volumes.get_volume_slices(path, axis, indexes, slice_dim)
+    })
+
+
+@images_bp.route("/get_volume_array", methods=['GET'])
+@flask_login.login_required
+@admission_control
+def get_volume_array():
+    """ Stream the volume data as uint8 values (z, y, x order), the
+    dimensions (x, y, z) are in the X-Volume-Dimensions header.
+    Input: entry_id or session_id and file_path
+    """
+    from emhub.data.processing import volumes
+
+    try:
+        path = _volume_path(request.args.to_dict())
+        xdim, ydim, zdim = volumes.get_volume_stats(path)['dimensions']
+    except Exception as e:
+        return send_error('ERROR from Server: %s' % e)
+
+    return flask.Response(
+        flask.stream_with_context(volumes.iter_volume_uint8(path)),
+        mimetype='application/octet-stream',
+        headers={'Content-Length': str(xdim * ydim * zdim),
+                 'X-Volume-Dimensions': f'{xdim},{ydim},{zdim}'})
@@ -36,7 +36,15 @@ A helper function `open_client` is provided for creating a context
 where a `DataClient` instance is created, logged in and out.
 """
 from .data_client import config, open_client, DataClient
-from .worker import TaskHandler, Worker, DefaultTaskHandler
+
+
+def __getattr__(name):
+    """ Load worker classes only when used, so scripts that only
+    need the DataClient do not pay the import cost. """
+    if name in ['TaskHandler', 'Worker', 'DefaultTaskHandler']:
+        from . import worker
+        return getattr(worker, name)
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
 
 
 __all__ = ['config', 'open_client', 'DataClient', 'TaskHandler', 'Worker',
@@ -30,7 +30,6 @@ from pprint import pprint
 import traceback
 
 from emtools.utils import Pretty, Process, Path, Color, System
-from emtools.metadata import EPU
 
 from emhub.client import open_client, config, DataClient
 
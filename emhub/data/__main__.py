@@ -63,6 +63,10 @@ def main():
                         "For example: forms, resources, etc. "
                         "Write the output to a json file.")
 
+    g.add_argument('--rebuild_aggregates', action='store_true',
+                   help="Recompute the monthly usage aggregates of the "
+                        "instance in EMHUB_INSTANCE (e.g. nightly from cron).")
+
     p.add_argument('--force', '-f', action='store_true',
                    help="Force to do some actions "
                         "(e.g. remove instance folder if existing)")
@@ -81,6 +85,12 @@ def main():
     if args.dump:
         dump(args.dump[0].split(','), args.dump[1])
 
+    if args.rebuild_aggregates:
+        from emhub.data.data_manager import DataManager
+        dm = DataManager(os.environ['EMHUB_INSTANCE'], create=False)
+        n = dm.rebuild_usage_aggregates()
+        print(f"Usage aggregates rebuilt: {n} rows")
+
 
 if __name__ == '__main__':
     main()
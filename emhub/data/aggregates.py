@@ -0,0 +1,242 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *
+# * [1] SciLifeLab, Stockholm University
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'delarosatrevin@scilifelab.se'
+# *
+# **************************************************************************
+
+
+import datetime as dt
+import math
+import traceback
+from collections import defaultdict
+
+import sqlalchemy
+from sqlalchemy import event, select
+
+
+class UsageAggregates:
+    """ Materialized monthly usage (bookings, days, hours, cost, sessions,
+    movies and bytes) by (month, resource, PI, application, booking type).
+
+    Bookings are counted in the month (local time) of their start, with
+    the PI of the booking's owner, and sessions in the month of their
+    booking. If track=True, months touched by committed changes of bookings
+    or sessions are recomputed after the commit, and everything is
+    recomputed after changes of users PI or resources cost (or if the
+    table is empty). Aggregates are only used by reports when tracking,
+    since changes done without it are not reflected until rebuild().
+    """
+    KEYS = ['resource_id', 'pi_id', 'application_id', 'booking_type']
+    VALUES = ['bookings', 'days', 'hours', 'cost', 'sessions', 'movies', 'bytes']
+
+    def __init__(self, dm, track=False):
+        self.dm = dm
+        self._table = dm.UsageAggregate.__table__
+        # The table might not exist in old databases until migrated
+        self.enabled = sqlalchemy.inspect(dm._engine).has_table(self._table.name)
+        self.tracking = self.enabled and track
+
+        if self.tracking:
+            factory = dm._db_session.session_factory
+            event.listen(factory, 'before_flush', self._before_flush)
+            event.listen(factory, 'after_commit', self._after_commit)
+            event.listen(factory, 'after_soft_rollback', self._after_rollback)
+            if self._is_empty():
+                self.rebuild()
+
+    # ------------------ Tracking of changes ----------------------------------
+    def _values(self, obj, attr):
+        """ Current and previous (if modified) values of an attribute. """
+        history = sqlalchemy.inspect(obj).attrs[attr].history
+        values = list(history.deleted or [])
+        values.append(getattr(obj, attr))
+        return [v for v in values if v is not None]
+
+    def _months(self, session, obj):
+        if isinstance(obj, self.dm.Booking):
+            return {self.month(s) for s in self._values(obj, 'start')}
+
+        if isinstance(obj, self.dm.Session):
+            months = set()
+            for bid in self._values(obj, 'booking_id'):
+                b = session.get(self.dm.Booking, bid)
+                if b is not None:
+                    months.update(self._months(session, b))
+            return months
+
+        return set()
+
+    def _changes_all(self, obj):
+        """ Return True if changes in the object affect all months. """
+        if isinstance(obj, self.dm.User):
+            attrs = ['pi_id', 'roles']
+        elif isinstance(obj, self.dm.Resource):
+            attrs = ['extra']
+        else:
+            return False
+        state = sqlalchemy.inspect(obj)
+        return any(state.attrs[a].history.has_changes() for a in attrs)
+
+    def _before_flush(self, session, flush_context, instances):
+        months = session.info.setdefault('usage_months', set())
+        for objects in [session.new, session.dirty, session.deleted]:
+            for obj in objects:
+                months.update(self._months(session, obj))
+        if any(self._changes_all(obj) for obj in session.dirty):
+            session.info['usage_rebuild'] = True
+
+    def _after_commit(self, session):
+        months = session.info.pop('usage_months', None)
+        rebuild = session.info.pop('usage_rebuild', False)
+        if months or rebuild:
+            try:
+                if rebuild:
+                    self.rebuild()
+                else:
+                    self.update(months)
+            except Exception:
+                # Aggregates will be fixed in the next rebuild
+                traceback.print_exc()
+
+    def _after_rollback(self, session, previous_transaction):
+        session.info.pop('usage_months', None)
+        session.info.pop('usage_rebuild', None)
+
+    # ------------------ Computation ------------------------------------------
+    def month(self, d):
+        """ Month key (YYYY-MM) of the given datetime in local time. """
+        return self.dm.dt_as_local(d).strftime('%Y-%m')
+
+    def _month_range(self, month):
+        """ Start and end (UTC) of the given month. """
+        y, m = map(int, month.split('-'))
+        start = self.dm.date(dt.date(y, m, 1))
+        end = self.dm.date(dt.date(y + m // 12, m % 12 + 1, 1))
+        return start.astimezone(dt.timezone.utc), end.astimezone(dt.timezone.utc)
+
+    def whole_months(self, start, end):
+        """ Return the months (YYYY-MM) completely inside the range
+        between start and end (UTC datetimes), and the UTC start and
+        end of these months (None if there are no months). """
+        months = []
+        first = last = None
+        month = self.month(start)
+        while True:
+            mStart, mEnd = self._month_range(month)
+            if mEnd > end:
+                return months, first, last
+            if mStart >= start:
+                months.append(month)
+                first = first or mStart
+                last = mEnd
+            month = self.month(mEnd)
+
+    def _lookups(self, conn):
+        """ Return dicts: user -> PI id and resource -> daily cost. """
+        U = self.dm.User.__table__
+        R = self.dm.Resource.__table__
+        user_pi = {uid: uid if 'pi' in (roles or []) else (pi_id or 0)
+                   for uid, roles, pi_id in conn.execute(
+                       select(U.c.id, U.c.roles, U.c.pi_id))}
+        daily_cost = {rid: (extra or {}).get('daily_cost', 0)
+                      for rid, extra in conn.execute(
+                          select(R.c.id, R.c.extra))}
+        return user_pi, daily_cost
+
+    def _compute(self, conn, condition=None):
+        """ Compute aggregate rows for bookings matching the condition. """
+        B = self.dm.Booking.__table__
+        S = self.dm.Session.__table__
+        user_pi, daily_cost = self._lookups(conn)
+
+        query = select(B.c.id, B.c.start, B.c.end, B.c.type, B.c.resource_id,
+                       B.c.owner_id, B.c.application_id, B.c.extra)
+        if condition is not None:
+            query = query.where(condition)
+
+        rows = defaultdict(lambda: dict.fromkeys(self.VALUES, 0))
+        booking_keys = {}
+
+        for bid, start, end, btype, rid, oid, aid, extra in conn.execute(query):
+            key = (self.month(start), rid or 0, user_pi.get(oid, 0),
+                   aid or 0, btype or '')
+            booking_keys[bid] = key
+            # Same as Booking days, hours and total_cost properties
+            days = (end.date() - start.date()).days + 1
+            td = end - start
+            cost = days * daily_cost.get(rid, 0)
+            for _, _, c in (extra or {}).get('costs', []):
+                try:
+                    cost += int(c)
+                except:
+                    pass
+            r = rows[key]
+            r['bookings'] += 1
+            r['days'] += days
+            r['hours'] += td.days * 24 + math.ceil(td.seconds / 3600)
+            r['cost'] += cost
+
+        query = select(S.c.booking_id, S.c.extra)
+        if condition is None:
+            query = query.where(S.c.booking_id.is_not(None))
+        else:
+            query = query.where(S.c.booking_id.in_(list(booking_keys)))
+
+        for bid, extra in conn.execute(query):
+            if bid not in booking_keys:
+                continue
+            raw = (extra or {}).get('raw', {})
+            r = rows[booking_keys[bid]]
+            r['sessions'] += 1
+            r['movies'] += raw.get('movies', 0)
+            r['bytes'] += sum(f['size'] for f in raw.get('files', {}).values())
+
+        return [dict(zip(['month'] + self.KEYS, key), **values)
+                for key, values in rows.items()]
+
+    def update(self, months):
+        """ Recompute the aggregates of the given months. """
+        B = self.dm.Booking.__table__
+        T = self._table
+        with self.dm._engine.begin() as conn:
+            for month in sorted(months):
+                start, end = self._month_range(month)
+                rows = self._compute(conn, (B.c.start >= start) & (B.c.start < end))
+                conn.execute(T.delete().where(T.c.month == month))
+                if rows:
+                    conn.execute(T.insert(), rows)
+
+    def _is_empty(self):
+        T = self._table
+        with self.dm._engine.connect() as conn:
+            return conn.execute(select(T.c.month).limit(1)).first() is None
+
+    def rebuild(self):
+        """ Recompute all aggregates from scratch. """
+        T = self._table
+        with self.dm._engine.begin() as conn:
+            rows = self._compute(conn)
+            conn.execute(T.delete())
+            if rows:
+                conn.execute(T.insert(), rows)
+        return len(rows)
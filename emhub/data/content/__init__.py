@@ -16,7 +16,7 @@
 
 from .dc_base import DataContent, register_content
 from . import (dc_base, dc_raw, dc_users, dc_reports, dc_bookings,
-               dc_projects, dc_sessions)
+               dc_projects, dc_sessions, dc_exports)
 
 dc = DataContent()
 
@@ -27,3 +27,4 @@ dc_sessions.register_content(dc)
 dc_raw.register_content(dc)
 dc_projects.register_content(dc)
 dc_reports.register_content(dc)
+dc_exports.register_content(dc)
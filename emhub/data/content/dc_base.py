@@ -30,6 +30,7 @@ import os
 import datetime as dt
 import json
 import sys
+import functools
 from collections import defaultdict
 from glob import glob
 
@@ -39,10 +40,9 @@ from flask import current_app as app
 
 from emhub.utils import (pretty_datetime, datetime_to_isoformat, pretty_date,
                          datetime_from_isoformat, get_quarter, pretty_quarter,
-                         image, shortname)
+                         shortname, SuffixMap)
 
 from emtools.utils import Pretty
-from emtools.metadata import Bins, TsBins, EPU
 
 
 class DataContent:
@@ -57,6 +57,8 @@ class DataContent:
         """ Create a new content for the given Flask application. """
         self.app = app
         self._contentDict = {}
+        self._exportDict = {}
+        self._versionCache = {}
 
     def _dateStr(self, datetime):
         return
@@ -72,15 +74,90 @@ class DataContent:
         if get_func is None:
             raise Exception(f"Missing content function for '{content_id}'")
 
-        dataDict.update(get_func(**kwargs))
+        detector = getattr(self.app, 'query_detector', None)
+        if detector is None:
+            dataDict.update(get_func(**kwargs))
+        else:
+            with detector.check(content_id):
+                dataDict.update(get_func(**kwargs))
         return dataDict
 
+    def content_label(self, content_id):
+        """ Return the content_id if it is registered, or 'other'.
+        Used to bound the number of labels in metrics and query logs,
+        since the content_id comes from the request.
+        """
+        if content_id and content_id.replace('-', '_') in self._contentDict:
+            return content_id
+        return 'other'
+
     def content(self, func):
         self._contentDict[func.__name__] = func
 
         # No need for a do-nothing wrapper
         return func
 
+    def export(self, func):
+        """ Register a function to export tabular data. It should
+        return a tuple (header, rows), where rows can be a generator.
+        """
+        self._exportDict[func.__name__] = func
+        return func
+
+    def get_export(self, **kwargs):
+        """ Return (header, rows) for the given 'export_id'. """
+        export_id = kwargs.pop('export_id')
+        func = self._exportDict.get(export_id, None)
+        if func is None:
+            raise Exception(f"Missing export function for '{export_id}'")
+        return func(**kwargs)
+
+    def _memo(self):
+        """ Return the memo dict of the current request (or None).
+        It is cleared if there were changes committed to the database.
+        """
+        if not flask.has_app_context():
+            return None
+        commits = getattr(self.app.dm, 'commit_count', 0)
+        memo = flask.g.get('emhub_memo', None)
+        if memo is None or memo['_commits'] != commits:
+            memo = flask.g.emhub_memo = {'_commits': commits}
+        return memo
+
+    def cached(self, key, func, *args):
+        """ Return func(*args), computed only once per request
+        for the given key. Returned objects are shared, so they should not
+        be modified by the caller.
+        """
+        memo = self._memo()
+        if memo is None:
+            return func(*args)
+        if key not in memo:
+            memo[key] = func(*args)
+        return memo[key]
+
+    def memoize(self, func):
+        """ Decorator for content functions that are used by others,
+        the result is computed once per request for the same kwargs
+        (ignoring 'content_id'). A shallow copy of the result is returned,
+        since callers usually update the dict with their own values.
+        """
+        @functools.wraps(func)
+        def wrapper(**kwargs):
+            key = (func.__name__,) + tuple(sorted(
+                (k, str(v)) for k, v in kwargs.items() if k != 'content_id'))
+            return dict(self.cached(key, functools.partial(func, **kwargs)))
+
+        return wrapper
+
+    def get_all_sessions(self):
+        """ Shortcut to dm.get_sessions(), cached for the request. """
+        return self.cached('sessions', self.app.dm.get_sessions)
+
+    def get_all_projects(self):
+        """ Shortcut to dm.get_projects(), cached for the request. """
+        return self.cached('projects', self.app.dm.get_projects)
+
     def get_lab_members(self, user):
         unit = user.staff_unit
         if user.is_staff(unit):
@@ -188,111 +265,135 @@ class DataContent:
 
     def booking_to_event(self, booking, **kwargs):
         """ Return a dict that can be used as calendar Event object. """
-        resource = booking.resource
-        # Bookings should have resources, just in case an erroneous one
-        if resource is None:
-            resource = self.app.dm.Resource(
-                name='Error: MISSING',
-                status='inactive',
-                tags='',
-                image='',
-                color='rgba(256, 256, 256, 1.0)',
-                extra={})
-
-        owner = booking.owner
-        operator = booking.operator  # shortcut
-        creator = booking.creator
-        a = booking.application
-        user = self.app.user
+        return self.bookings_to_events([booking], **kwargs)[0]
+
+    def bookings_to_events(self, bookings, viewer=None, **kwargs):
+        """ Same as booking_to_event for a list of bookings, but the display
+        config, viewer permissions, PIs and short names are computed
+        only once.
+
+        Args:
+            bookings: list of bookings to convert
+            viewer: user that will see the events (current user by default)
+            kwargs: same as booking_to_event (prettyDate, piApp)
+        """
         dm = self.app.dm
-        b_title = booking.title
-        b_description = booking.description
-
-        user_can_book = False
-        # Define which users are allowed to modify the booking
-        # - managers
-        # - application creators
-        # - the owner and pi of the owner
-        can_modify_list = [owner.id]
-
-        if a is not None:
-            can_modify_list.append(a.creator.id)
-
-        if user.is_manager and (a is None or a.allows_access(user)):
-            can_modify_list.append(user.id)
-
-        pi = owner.get_pi()
-        if pi is not None:
-            can_modify_list.append(pi.id)
-
-        user_can_modify = user.id in can_modify_list
-        user_can_view = user_can_modify or user.same_pi(owner)
-        color = resource.color if resource else 'grey'
-
-        application_label = 'None'
-
-        if booking.type == 'special':
-            color = 'rgba(98,50,45,1.0)'
-            title = "%s (SPECIAL): %s" % (resource.name, b_title)
-        if booking.type == 'downtime':
-            color = 'rgba(181,4,0,1.0)'
-            title = "%s (DOWNTIME): %s" % (resource.name, b_title)
-        if booking.type == 'maintenance' or any(k in b_title for k in ['cycle', 'installation', 'maintenance', 'afis']):
-            color = 'rgba(255,107,53,1.0)'
-            title = "%s (MAINTENANCE): %s" % (resource.name, b_title)
-        elif booking.type == 'slot':
-            color = color.replace('1.0', '0.5')  # transparency for slots
-            title = "%s (SLOT): %s" % (resource.name,
-                                       booking.slot_auth.get('applications', ''))
-            user_can_book = user.can_book_slot(booking)
-        else:
-            # Show all booking information in title in some cases only
-            display = dm.get_config('bookings')['display']
-            emptyApp = a is None or not display['show_application']
-            appStr = '' if emptyApp else ', %s' % a.code
-            emptyPi = (owner.is_manager or owner.is_pi or
-                       pi is None or not display.get('show_pi', False))
-            piStr = '' if emptyPi else shortname(pi) + '/'
-            emptyOp = operator is None or not display.get('show_operator', False)
-            opStr = '' if emptyOp else ' -> ' + shortname(operator)
-
-            extra = "%s%s%s%s" % (piStr, shortname(owner), appStr, opStr)
-            if user_can_view:
-                title = "%s (%s) %s" % (resource.name, extra, b_title)
-                if a:
-                    application_label = a.code
-                    if a.alias:
-                        application_label += "  (%s)" % a.alias
+        user = viewer or self.app.user
+        display = None
+        prettyDate = kwargs.get('prettyDate', False)
+        piApp = kwargs.get('piApp', False)
+        missing_resource = None
+        user_pi = user.get_pi()
+
+        pis = {}  # owner id -> PI
+        names = {}  # user id -> short name
+        apps_access = {}  # application id -> allows_access(user)
+
+        def _pi(u):
+            if u.id not in pis:
+                pis[u.id] = u.get_pi()
+            return pis[u.id]
+
+        def _shortname(u):
+            if u.id not in names:
+                names[u.id] = shortname(u)
+            return names[u.id]
+
+        def _allows_access(a):
+            if a.id not in apps_access:
+                apps_access[a.id] = a.allows_access(user)
+            return apps_access[a.id]
+
+        def _event(booking):
+            nonlocal display, missing_resource
+
+            resource = booking.resource
+            # Bookings should have resources, just in case an erroneous one
+            if resource is None:
+                if missing_resource is None:
+                    missing_resource = dm.Resource(
+                        name='Error: MISSING',
+                        status='inactive',
+                        tags='',
+                        image='',
+                        color='rgba(256, 256, 256, 1.0)',
+                        extra={})
+                resource = missing_resource
+
+            owner = booking.owner
+            operator = booking.operator  # shortcut
+            a = booking.application
+            b_title = booking.title
+
+            # Define which users are allowed to modify the booking
+            # - managers
+            # - application creators
+            # - the owner and pi of the owner
+            pi = _pi(owner)
+            user_can_modify = (user.id == owner.id or
+                               (a is not None and user.id == a.creator_id) or
+                               (user.is_manager and (a is None or _allows_access(a))) or
+                               (pi is not None and user.id == pi.id))
+            # Same as user.same_pi(owner)
+            user_can_view = user_can_modify or user_pi == pi
+            color = resource.color if resource else 'grey'
+
+            if booking.type == 'maintenance' or any(k in b_title for k in ['cycle', 'installation', 'maintenance', 'afis']):
+                color = 'rgba(255,107,53,1.0)'
+                title = "%s (MAINTENANCE): %s" % (resource.name, b_title)
+            elif booking.type == 'slot':
+                color = color.replace('1.0', '0.5')  # transparency for slots
+                title = "%s (SLOT): %s" % (resource.name,
+                                           booking.slot_auth.get('applications', ''))
             else:
-                title = "%s (%s)" % (resource.name, extra)
-                b_title = "Hidden title"
-                b_description = "Hidden description"
-
-        bd = {
-            'id': booking.id,
-            'title': title,
-            'resource': {'id': resource.id},
-            'start': datetime_to_isoformat(booking.start),
-            'end': datetime_to_isoformat(booking.end),
-            'color': color,
-            'textColor': 'white',
-            'booking_title': b_title,
-        }
+                if booking.type == 'special':
+                    color = 'rgba(98,50,45,1.0)'
+                elif booking.type == 'downtime':
+                    color = 'rgba(181,4,0,1.0)'
+                # Show all booking information in title in some cases only
+                if display is None:
+                    display = dm.get_config('bookings')['display']
+                emptyApp = a is None or not display['show_application']
+                appStr = '' if emptyApp else ', %s' % a.code
+                emptyPi = (owner.is_manager or owner.is_pi or
+                           pi is None or not display.get('show_pi', False))
+                piStr = '' if emptyPi else _shortname(pi) + '/'
+                emptyOp = operator is None or not display.get('show_operator', False)
+                opStr = '' if emptyOp else ' -> ' + _shortname(operator)
+
+                extra = "%s%s%s%s" % (piStr, _shortname(owner), appStr, opStr)
+                if user_can_view:
+                    title = "%s (%s) %s" % (resource.name, extra, b_title)
+                else:
+                    title = "%s (%s)" % (resource.name, extra)
+                    b_title = "Hidden title"
+
+            bd = {
+                'id': booking.id,
+                'title': title,
+                'resource': {'id': resource.id},
+                'start': datetime_to_isoformat(booking.start),
+                'end': datetime_to_isoformat(booking.end),
+                'color': color,
+                'textColor': 'white',
+                'booking_title': b_title,
+            }
+
+            if prettyDate:
+                bd['pretty_start'] = pretty_datetime(booking.start)
+                bd['pretty_end'] = pretty_datetime(booking.end)
 
-        if kwargs.get('prettyDate', False):
-            bd['pretty_start'] = pretty_datetime(booking.start)
-            bd['pretty_end'] = pretty_datetime(booking.end)
+            if piApp:
+                if pi is not None:
+                    bd['pi_id'] = pi.id
+                    bd['pi_name'] = pi.name
 
-        if kwargs.get('piApp', False):
-            if pi is not None:
-                bd['pi_id'] = pi.id
-                bd['pi_name'] = pi.name
+                if a is not None:
+                    bd['app_id'] = a.id
 
-            app = booking.application
-            if app is not None:
-                bd['app_id'] = app.id
+            return bd
 
-        return bd
+        return [_event(b) for b in bookings]
 
     def booking_from_entry(self, entry, scopes):
         """ Create a booking instance from an existing entry of type
@@ -486,24 +587,10 @@ class DataContent:
                     for u in dm.get_users() if 'manager' in u.roles]
         return []
 
-    def get_booking_in_range(self, kwargs,
-                             asJson=True, filter=None, bookingFunc=None):
-        """ Return the list of bookings in the given time range.
-
-         It will also attach PI information to each booking.
-         This function is used from report functions.
-         If 'start' and 'end' keys are not in kwargs, the current
-         year quarter will be used for the range.
-
-         Args:
-             kwargs (dict): dict from where to read 'start' and 'end'
-             asJson (bool): if True return json entries for each booking
-             filter: function to filter bookings. If None, the non-slot bookings
-                with non-zero cost resource will be used.
-            bookingFunc: if asJson is True, function used to convert
-                booking into a jsonDict. If it is none, booking_to_event is used.
+    def get_booking_range(self, kwargs):
+        """ Return a dict with 'start' and 'end' of the range from kwargs.
+        If not present, the current year quarter will be used.
         """
-
         if 'start' in kwargs and 'end' in kwargs:
             # d = request.json or request.form
             d = {'start': kwargs['start'], 'end': kwargs['end']}
@@ -522,23 +609,87 @@ class DataContent:
                  'end': '%d/%s' % (now.year, end)
                  }
 
-        bookings = self.app.dm.get_bookings_range(
-            datetime_from_isoformat(d['start'].replace('/', '-')),
-            datetime_from_isoformat(d['end'].replace('/', '-'))
-        )
+        return d
+
+    def _range_dates(self, d):
+        return (datetime_from_isoformat(d['start'].replace('/', '-')),
+                datetime_from_isoformat(d['end'].replace('/', '-')))
+
+    def get_booking_snapshot(self, kwargs):
+        """ Same as get_booking_in_range, but return a columnar
+        BookingSnapshot (without any filter) instead of a list.
+        """
+        from emhub.reports.snapshot import BookingSnapshot
+        d = self.get_booking_range(kwargs)
+        return BookingSnapshot(self.app.dm, *self._range_dates(d)), d
+
+    def get_versioned(self, key, func, *args):
+        """ Return the value stored with this key, or compute it with
+        func(*args). Values are kept across requests until the data in
+        the database changes.
+        """
+        dm = self.app.dm
+        version = dm.data_version(), getattr(dm, 'commit_count', 0)
+        item = self._versionCache.get(key, None)
+        if item is None or item[0] != version:
+            item = self._versionCache[key] = version, func(*args)
+        return item[1]
+
+    def get_session_snapshot(self):
+        """ Return a SessionSnapshot with the metrics of all sessions,
+        cached until the data in the database changes.
+        """
+        from emhub.reports.snapshot import SessionSnapshot
+        return self.get_versioned('session_snapshot', SessionSnapshot,
+                                  self.app.dm)
+
+    def get_universities_map(self):
+        """ Return a SuffixMap to find the university from an email,
+        built from the 'universities' form (empty if not defined).
+        """
+        def _create():
+            try:
+                univ_dict = self.app.dm.get_universities_dict()
+            except:
+                univ_dict = {}
+            return SuffixMap(univ_dict.items())
+
+        return self.get_versioned('universities_map', _create)
+
+    def get_booking_in_range(self, kwargs,
+                             asJson=True, filter=None, bookingFunc=None):
+        """ Return the list of bookings in the given time range.
+
+         It will also attach PI information to each booking.
+         This function is used from report functions.
+         If 'start' and 'end' keys are not in kwargs, the current
+         year quarter will be used for the range.
 
-        bookingFunc = bookingFunc or self.booking_to_event
+         Args:
+             kwargs (dict): dict from where to read 'start' and 'end'
+             asJson (bool): if True return json entries for each booking
+             filter: function to filter bookings. If None, the non-slot bookings
+                with non-zero cost resource will be used.
+            bookingFunc: if asJson is True, function used to convert
+                booking into a jsonDict. If it is none, booking_to_event is used.
+        """
 
-        def process_booking(b):
-            if not asJson:
-                return b
-            return bookingFunc(b, prettyDate=True, piApp=True)
+        d = self.get_booking_range(kwargs)
+        bookings = self.app.dm.get_bookings_range(*self._range_dates(d))
 
         def _filter(b):
             return b.resource.daily_cost > 0 and not b.is_slot
 
         filterFunc = filter or _filter
-        bookings = [process_booking(b) for b in bookings if filterFunc(b)]
+        bookings = [b for b in bookings if filterFunc(b)]
+
+        if asJson:
+            if bookingFunc is None:
+                bookings = self.bookings_to_events(bookings, prettyDate=True,
+                                                   piApp=True)
+            else:
+                bookings = [bookingFunc(b, prettyDate=True, piApp=True)
+                            for b in bookings]
 
         return bookings, d
 
@@ -560,6 +711,7 @@ class DataContent:
 
             fn = dm.get_resource_image_path(r)
             if os.path.exists(fn):
+                from emhub.utils import image
                 base64 = image.Base64Converter(max_size=(128, 128))
                 return 'data:image/%s;base64, ' + base64.from_path(fn)
             else:
@@ -613,7 +765,7 @@ class DataContent:
 
         pi_select = {}
 
-        for p in dm.get_projects():
+        for p in self.get_all_projects():
             if status and p.status != status:
                 continue
 
@@ -649,7 +801,7 @@ class DataContent:
             projects[p.id] = p
 
         # Find sessions for each project (based on project_id or booking's project)
-        for s in dm.get_sessions():
+        for s in self.get_all_sessions():
             if p := s.project:
                 if p.id in projects:
                     projects[p.id].sessions.append(s)
@@ -695,25 +847,14 @@ class DataContent:
                 }
 
     def get_session_data(self, session, **kwargs):
+        """ Return CTF values (or 2D classes) of the session processing.
+        If 'packed' is True, CTF series are encoded with
+        emhub.data.processing.base.pack_array.
+        """
         result = kwargs.get('result', 'micrographs')
 
-        defocus = []
-        defocusAngle = []
-        resolution = []
-        astigmatism = []
-        timestamps = []
-        gridsquares = []
-        tsRange = {}
-        beamshifts = []
-
         sdata = self.app.dm.get_processing_project(session_id=session.id)['project']
 
-        def _microns(v):
-            return round(v * 0.0001, 3)
-
-        def _ts(fn):
-            return os.path.getmtime(sdata.join(fn))
-
         data = {
             'session': session.json(),
             'classes2d': []
@@ -726,57 +867,34 @@ class DataContent:
         data['stats'] = sdata.get_stats()
 
         if result == 'micrographs':
-            firstMic = lastMic = None
-            dbins = Bins([1, 2, 3])
-            rbins = Bins([3, 4, 6])
-            epuData = None
+            ctfData = {
+                'defocus': [],
+                'defocusAngle': [],
+                'astigmatism': [],
+                'resolution': [],
+                'tsRange': {},
+                'defocus_bins': [],
+                'resolution_bins': [],
+                'gridsquares': []
+            }
+            beamshifts = []
 
             if data['stats']['ctfs']['count'] > 0:
-                for mic in sdata.get_micrographs():
-                    micFn = mic['micrograph']
-                    micName = mic.get('micName', micFn)
-                    loc = EPU.get_movie_location(micName)
-                    gridsquares.append(loc['gs'])
-                    if not defocus:
-                        firstMic = micFn
-                    lastMic = micFn
-                    d = _microns(mic['ctfDefocus'])
-                    defocus.append(d)
-                    dbins.addValue(d)
-                    defocusAngle.append(mic['ctfDefocusAngle'])
-                    astigmatism.append(_microns(mic['ctfAstigmatism']))
-                    r = round(mic['ctfResolution'], 3)
-                    resolution.append(r)
-                    rbins.addValue(r)
-
-                if firstMic and lastMic:
-                    tsFirst, tsLast = _ts(firstMic), _ts(lastMic)
-                    step = (tsLast - tsFirst) / len(defocus)
-                else:
-                    tsFirst = dt.datetime.timestamp(dt.datetime.now())
-                    step = 1000
-                    tsLast = tsFirst + len(defocus) * step
-
+                ctfData = sdata.get_ctf_series(packed=kwargs.get('packed', False))
+                if self.app.config.get('THUMBNAILS_PREGENERATE', False):
+                    from emhub.data.processing import thumbnails
+                    from emtools.image import Thumbnail
+                    thumbnails.pregenerate(sdata, Thumbnail.Micrograph(),
+                                           Thumbnail.Psd(),
+                                           count=data['stats']['ctfs']['count'])
                 epuData = sdata.getEpuData()
-                if epuData is None:
-                    beamshifts = []
-                else:
+                if epuData is not None:
                     beamshifts = [{'x': row.beamShiftX, 'y': row.beamShiftY}
                                   for row in epuData.moviesTable]
-                tsRange = {'first': tsFirst * 1000,  # Timestamp in milliseconds
-                           'last': tsLast * 1000,
-                           'step': step * 1000}
-                
+
+            data.update(ctfData)
             data.update({
-                'defocus': defocus,
-                'defocusAngle': defocusAngle,
-                'astigmatism': astigmatism,
-                'resolution': resolution,
-                'tsRange': tsRange,
                 'beamshifts': beamshifts,
-                'defocus_bins': dbins.toList(),
-                'resolution_bins': rbins.toList(),
-                'gridsquares': gridsquares,
                 'gs_info': True, # epuData is not None,
                 'ctfs_run_id': sdata.get_ctfs_runid()
             })
@@ -945,7 +1063,7 @@ def register_content(dc):
         scopes = {r.id: r for r in dm.get_resources()}
 
         # Retrieve open requests for each scope from entries and bookings
-        for p in dm.get_projects():
+        for p in dc.get_all_projects():
             if p.is_active:
                 last_bookings = {}
                 # Find last bookings for each scope
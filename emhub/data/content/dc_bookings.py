@@ -91,9 +91,8 @@ def register_content(dc):
     def booking_calendar(**kwargs):
         dm = dc.app.dm  # shortcut
         dataDict = dc.get_resources()
-        dataDict['bookings'] = [dc.booking_to_event(b)
-                                for b in dm.get_bookings()
-                                if b.resource is not None]
+        dataDict['bookings'] = dc.bookings_to_events(
+            [b for b in dm.get_bookings() if b.resource is not None])
         dataDict['applications'] = [{'id': a.id,
                                      'code': a.code,
                                      'alias': a.alias}
@@ -0,0 +1,119 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *              Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk) [2]
+# *
+# * [1] SciLifeLab, Stockholm University
+# * [2] MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'delarosatrevin@scilifelab.se'
+# *
+"""
+Register export functions (tabular data streamed as CSV/XLSX)
+"""
+
+
+def register_content(dc):
+
+    def _check_manager():
+        if not dc.app.user.is_manager:
+            raise Exception('Invalid access')
+
+    def _load_related():
+        """ Load all users, resources and applications, so the relations
+        of bookings are found in the session (identity map) instead of
+        being queried for each booking. The returned lists should be kept
+        while iterating the bookings.
+        """
+        dm = dc.app.dm
+        return dm.get_users(), dm.get_resources(), dm.get_applications()
+
+    def _booking_row(b):
+        pi = b.owner.get_pi()
+        a = b.application
+        return [b.id, b.resource.name, b.type, b.start, b.end, b.title,
+                b.owner.name, b.owner.email, pi.name if pi else '',
+                a.code if a else '', b.days, b.hours, b.total_cost]
+
+    BOOKING_HEADER = ['Id', 'Resource', 'Type', 'Start', 'End', 'Title',
+                      'Owner', 'Owner email', 'PI', 'Application',
+                      'Days', 'Hours', 'Cost']
+
+    @dc.export
+    def bookings(**kwargs):
+        """ All bookings in the range, fetched in chunks. """
+        _check_manager()
+        range_dict = dc.get_booking_range(kwargs)
+
+        def _rows():
+            # Referenced while iterating, so they are kept in the session
+            _keepalive = _load_related()
+            for b in dc.app.dm.iter_bookings_range(*dc._range_dates(range_dict)):
+                yield _booking_row(b)
+
+        return BOOKING_HEADER, _rows()
+
+    @dc.export
+    def reports_invoices(**kwargs):
+        """ Invoiceable bookings with their application and PI. """
+        _check_manager()
+        data = dc.get(content_id='reports_invoices', **kwargs)
+
+        def _rows():
+            # Application and PI columns of each booking are taken from the
+            # grouping computed from the bookings snapshot, and rows are
+            # emitted while iterating over the range (fetched in chunks)
+            _keepalive = _load_related()
+            groups = {bid: [code, pi_info['pi_name'], pi_info['pi_email']]
+                      for code, pi_dict in data['apps_dict'].items()
+                      for pi_info in pi_dict.values() if pi_info['bookings']
+                      for bid in pi_info['bookings'].ids}
+
+            for b in dc.app.dm.iter_bookings_range(*dc._range_dates(data)):
+                if group := groups.get(b.id, None):
+                    yield group + _booking_row(b)
+
+        return ['Application code', 'PI name', 'PI email'] + BOOKING_HEADER, _rows()
+
+    @dc.export
+    def invoices_per_pi(**kwargs):
+        """ Bookings, transactions and period balances of a PI. """
+        data = dc.get(content_id='invoices_per_pi', **kwargs)
+        rows = ([e['date'], e['type'], e['id'], e['title'], e['amount']]
+                for e in data.get('entries', []))
+        return ['Date', 'Type', 'Id', 'Title', 'Amount'], rows
+
+    @dc.export
+    def report_microscopes_usage(**kwargs):
+        """ Usage of each PI (and total) per resource. """
+        data = dc.get(content_id='report_microscopes_usage', **kwargs)
+        resources = [data['resources_dict'][rid]
+                     for rid in data['selected_resources']
+                     if rid in data['resources_dict']]
+
+        def _rows():
+            for e in data['entries']:
+                days = e['days']
+                yield ([e['label'], e.get('app', ''), e['email'], e['total_days']] +
+                       [days.get(r['id'], 0) for r in resources] +
+                       [len(e['bookings']), len(e.get('users', []))])
+
+        header = (['PI', 'Application', 'Email', 'Total (%s)' % data['metric']] +
+                  [r['name'] for r in resources] + ['Bookings', 'Users'])
+        return header, _rows()
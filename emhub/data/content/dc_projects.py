@@ -29,6 +29,7 @@
 Register content functions related to Sessions
 """
 import os
+from collections import defaultdict
 
 
 def register_content(dc):
@@ -114,7 +115,7 @@ def register_content(dc):
         def _new_booking(b):
             return b.type == 'booking' and b.id not in bookings
 
-        for s in dm.get_sessions():
+        for s in dc.get_all_sessions():
             if s.project == project:
                 b = s.booking
                 if _new_booking(b):
@@ -204,6 +205,7 @@ def register_content(dc):
         images = []
 
         # Convert images in data form to base64
+        from emhub.utils import image
         base64 = image.Base64Converter(max_size=(512, 512))
 
         for k, v in data.items():
@@ -34,6 +34,8 @@ import json
 import datetime as dt
 from emtools.utils import Pretty
 
+from emhub.data.query_log import QueryLog
+
 
 def register_content(dc):
 
@@ -138,6 +140,22 @@ def register_content(dc):
 
         return {'logs': logs}
 
+    @dc.content
+    def slow_queries(**kwargs):
+        if not dc.app.user.is_admin:
+            raise Exception('Invalid access')
+
+        query_log = dc.app.dm.query_log
+        sort_key = kwargs.get('sort', 'total')
+        if sort_key not in QueryLog.SORT_KEYS:
+            sort_key = 'total'
+        n = int(kwargs.get('n', 50))
+
+        return {'queries': query_log.top(n, key=sort_key) if query_log else [],
+                'enabled': query_log is not None,
+                'threshold': query_log.threshold if query_log else 0,
+                'sort': sort_key}
+
     @dc.content
     def pages(**kwargs):
         page_id = kwargs['page_id']
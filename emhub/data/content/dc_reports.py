@@ -107,7 +107,11 @@ def register_content(dc):
 
     @dc.content
     def reports_invoices(**kwargs):
-        bookings, range_dict = dc.get_booking_in_range(kwargs, asJson=False)
+        import numpy as np
+        from emhub.reports.snapshot import group_by
+
+        snap, range_dict = dc.get_booking_snapshot(kwargs)
+        dc.app.jobs.progress(0.3, 'Bookings loaded')
 
         if hasattr(dc.app, 'sll_pm'):  # Portal Manager
             portal_users = {
@@ -127,51 +131,41 @@ def register_content(dc):
             } for pi in a.pi_list
             }
 
-        def update_pi_info(pi_info, b):
-            pi_info['bookings'].append(b)
-            pi_info['sum_cost'] += b.total_cost
-            pi_info['sum_days'] += b.days
+        def update_pi_info(pi_info, indexes):
+            pi_info['bookings'] = snap.bookings(indexes)
+            pi_info['sum_cost'] += total_cost[indexes].sum().item()
+            pi_info['sum_days'] += snap.days[indexes].sum().item()
 
         # Create a dictionary where pi/bookings are grouped by Application
         # and another one grouped by pi
         apps_dict = {}
         pi_dict = {}
+        app_codes = {}
+        app_pis = []  # valid (application, pi) pairs
 
         for a in dc.app.dm.get_applications():
             apps_dict[a.code] = create_pi_info_dict(a)
             pi_dict.update(create_pi_info_dict(a))
+            app_codes[a.id] = a.code
+            app_pis.extend((a.id, pi.id) for pi in a.pi_list)
 
-        for b in bookings:
-            if b.application is None:
-                continue
-
-            app_id = b.application.code
-
-            if app_id not in apps_dict:
-                print(">>> Missing app: ", app_id)
-                continue
+        # Only take into account booking type (i.e no slot, downtime, etc)
+        # of non-zero cost resources and from one of the PIs of the
+        # booking's application
+        n = max([int(snap.pi_id.max(initial=0))] + [p for _, p in app_pis]) + 1
+        app_pi_keys = snap.application_id * n + snap.pi_id
+        mask = ((snap.daily_cost > 0) & snap.type_in('booking') &
+                (snap.pi_id > 0) &
+                np.isin(app_pi_keys, [a * n + p for a, p in app_pis]))
+        total_cost = snap.total_cost
 
-            pi = b.owner.get_pi()
+        for key, indexes in group_by(app_pi_keys, mask):
+            update_pi_info(apps_dict[app_codes[key // n]][key % n], indexes)
 
-            if pi is None:
-                print(">>>  None pi, user: ", b.owner.name)
-                continue
-
-            # Only take into account booking type (i.e no slot, downtime, etc)
-            if not b.is_booking:
-                continue
+        for pi_id, indexes in group_by(snap.pi_id, mask):
+            update_pi_info(pi_dict[pi_id], indexes)
 
-            try:
-                update_pi_info(apps_dict[app_id][pi.id], b)
-                update_pi_info(pi_dict[pi.id], b)
-
-                if b.total_cost == 0:
-                    print(">>> 0 cost booking!!!")
-                    print(b.json())
-
-            except KeyError:
-                print("Got KeyError, app_id: %s, pi_id: %s"
-                      % (app_id, pi.id))
+        dc.app.jobs.progress(0.9, 'Invoices computed')
 
         result = {
             'apps_dict': apps_dict,
@@ -212,34 +206,34 @@ def register_content(dc):
 
         pi_user = dc.get_pi_user(kwargs)
         dm = dc.app.dm  # shortcut
-
-        def _filter(b):
-            pi = b.owner.get_pi()
-            return (b.resource.daily_cost > 0 and
-                    b.start <= dm.now() and
-                    b.is_booking and pi and pi.id == pi_user.id)
+        bookings, transactions = dm.get_pi_ledger(pi_user)
 
         entries = []
 
-        for b in dm.get_bookings():
-            if _filter(b):
-                entries.append({'id': b.id,
-                                'title': dc.booking_to_event(b)['title'],
-                                'date': b.start,
-                                'amount': b.total_cost,
-                                'type': 'booking'
-                                })
+        for b in bookings:
+            entries.append({'id': b.id,
+                            'title': dc.booking_to_event(b)['title'],
+                            'date': b.start,
+                            'amount': b.total_cost,
+                            'type': 'booking'
+                            })
 
-        for t in dm.get_transactions():
-            if t.user.id == pi_user.id:
-                entries.append({'id': t.id,
-                                'title': t.comment,
-                                'date': t.date,
-                                'amount': t.amount,
-                                'type': 'transaction'
-                                })
+        for t in transactions:
+            entries.append({'id': t.id,
+                            'title': t.comment,
+                            'date': t.date,
+                            'amount': t.amount,
+                            'type': 'transaction'
+                            })
+
+        # Closed periods store the closing balance of each PI
+        closed_balances = {
+            ip.id: ip.extra['balances'] for ip in dm.get_invoice_periods()
+            if ip.status == 'closed' and 'balances' in (ip.extra or {})
+        }
+        pi_key = str(pi_user.id)
 
-        invoice_periods = dc.get_invoice_periods_list()['invoice_periods']
+        invoice_periods = invoice_periods_list()['invoice_periods']
         for ip in invoice_periods:
             if ip['order'] > 0:
                 entries.append({'id': ip['id'],
@@ -254,6 +248,8 @@ def register_content(dc):
         total = 0
         for e in entries:
             if e['type'] == 'summary':
+                if e['id'] in closed_balances:
+                    total = closed_balances[e['id']].get(pi_key, 0)
                 e['amount'] = total
                 if total > 0:
                     total = 0
@@ -343,7 +339,11 @@ def register_content(dc):
         return {'data': [(r.name, r.status, r.tags) for r in resources]}
 
     @dc.content
+    @dc.memoize
     def report_microscopes_usage(**kwargs):
+        import numpy as np
+        from emhub.reports.snapshot import group_by, sum_by
+
         metric = kwargs.get('metric', 'days')
         use_data = metric == 'data'
         use_days = metric == 'days'
@@ -353,9 +353,6 @@ def register_content(dc):
         dm = dc.app.dm  # shortcut
         centers = dm.get_config('sessions').get('centers', {})
 
-        def _filter(b):
-            return not b.is_slot
-
         app_id = kwargs.get('application', 'all')
 
         applications = [a for a in dm.get_visible_applications() if a.is_active]
@@ -367,22 +364,19 @@ def register_content(dc):
 
         pi_list = []
         pi_apps = {}
+        pi_objects = {}
         for app in selected_apps:
             for pi in app.pi_list:
                 pi_list.append(pi.id)
                 pi_apps[pi.id] = app
+                pi_objects[pi.id] = pi
 
-        bookings, range_dict = dc.get_booking_in_range(kwargs,
-                                                       asJson=False,
-                                                       filter=_filter)
+        snap, range_dict = dc.get_booking_snapshot(kwargs)
+        dc.app.jobs.progress(0.2, 'Bookings loaded')
         entries_usage = {}
         entries_operators = {}
-        total_usage = 0
         entries_down = {}
-        total_down = 0
         key = kwargs.get('key', '')
-        selected_entry = None
-        total_days = 0
         totalDays = defaultdict(lambda: 0)
         resources_data_usage = defaultdict(lambda: list())
 
@@ -396,8 +390,10 @@ def register_content(dc):
         else:
             selected = [r['id'] for r in resources]
 
-        def _value(b):
-            return b.total_size if use_data else (b.units(hours=12) if use_days else b.hours)
+        if use_data:
+            values = snap.total_size
+        else:
+            values = snap.units(hours=12) if use_days else snap.hours
 
         def _entry(key, label, app='', email='', total_days=0):
             return {
@@ -413,60 +409,56 @@ def register_content(dc):
                 'users': set()
             }
 
-        for b in bookings:
-            if b.resource_id not in selected:
-                continue
-
-            rid = b.resource.id
-            b_value = _value(b)
-            entry_app = ''
-
-            if b.type in ['downtime', 'maintenance', 'special']:
-                entry_key = b.type
-                entry_label = entry_key.capitalize()
-                entry_email = ''
-                entries = entries_down
-                total_down += b_value
-            else:
-                if b.project:
-                    pi = b.project.user.get_pi()
-                else:
-                    pi = b.owner.get_pi()
-                if not pi or pi.id not in pi_list:
-                    continue
-                entry_key = str(pi.id)
-                entry_app = pi_apps[pi.id].code
-                entry_label = centers.get(pi.email, pi.name)
-                entry_email = pi.email
-                entries = entries_usage
-                total_usage += b_value
-                totalDays[rid] += b_value
-                ts = dt.datetime.timestamp(b.end)
-                resources_data_usage[rid].append((ts * 1000, b_value))
-
-                # Store entries by operator
-                op = b.operator
-                opKey = op.name if op else 'Unknown'
-                if opKey not in entries_operators:
-                    entries_operators[opKey] = _entry(opKey, opKey)
-                entry = entries_operators[opKey]
-                entry['days'][rid] += 1
-                entry['total_days'] += 1
-
-            if entry_key not in entries:
-                entries[entry_key] = _entry(entry_key, entry_label,
-                                            entry_app, entry_email)
-
-            entry = entries[entry_key]
-            entry['bookings'].append(b)
-            entry['days'][rid] += b_value
-            entry['total_days'] += b_value
-            entry['users'].add(b.owner.email)
-
-            total_days += b_value
-            if key == entry_key:
-                selected_entry = entry
-
+        def _update_entry(entry, indexes):
+            entry['bookings'] = snap.bookings(indexes)
+            for rid, v in sum_by(snap.resource_id[indexes], values[indexes]).items():
+                entry['days'][rid] += v
+            entry['total_days'] += values[indexes].sum().item()
+            entry['users'].update(snap.users.get(uid, {}).get('email', None)
+                                  for uid in set(snap.owner_id[indexes].tolist()))
+            return entry
+
+        mask = ~snap.type_in('slot') & np.isin(snap.resource_id, selected)
+        down_mask = mask & snap.type_in('downtime', 'maintenance', 'special')
+        # Bookings of a project are counted for the PI of the project
+        pi_ids = np.where(snap.project_id > 0, snap.project_pi_id, snap.pi_id)
+        usage_mask = mask & ~down_mask & np.isin(pi_ids, pi_list)
+
+        for t, indexes in group_by(snap.type, down_mask):
+            entry_key = snap.TYPES[t]
+            entries_down[entry_key] = _update_entry(
+                _entry(entry_key, entry_key.capitalize()), indexes)
+
+        entries_indexes = {}
+        for pi_id, indexes in group_by(pi_ids, usage_mask):
+            pi = pi_objects[pi_id]
+            entry_key = str(pi_id)
+            entries_usage[entry_key] = _update_entry(
+                _entry(entry_key, centers.get(pi.email, pi.name),
+                       pi_apps[pi_id].code, pi.email), indexes)
+            entries_indexes[entry_key] = indexes
+
+        for rid, indexes in group_by(snap.resource_id, usage_mask):
+            totalDays[rid] += values[indexes].sum().item()
+            resources_data_usage[rid] = list(zip(
+                (snap.end_ts[indexes] * 1000).tolist(), values[indexes].tolist()))
+
+        # Store entries by operator
+        operators = snap.user_names(snap.operator_id)
+        operators[operators == ''] = 'Unknown'
+        for opKey, indexes in group_by(operators, usage_mask):
+            entry = entries_operators[opKey] = _entry(opKey, opKey)
+            for rid, count in sum_by(snap.resource_id[indexes],
+                                     np.ones(len(indexes), dtype=int)).items():
+                entry['days'][rid] += count
+            entry['total_days'] += len(indexes)
+
+        total_usage = values[usage_mask].sum().item()
+        total_down = values[down_mask].sum().item()
+        total_days = total_usage + total_down
+        selected_entry = entries_usage.get(key, entries_down.get(key, None))
+
+        dc.app.jobs.progress(0.5, 'Bookings usage computed')
         entries_sorted = [e for e in sorted(entries_usage.values(),
                                             key=lambda e: e['total_days'],
                                             reverse=True)]
@@ -554,14 +546,11 @@ def register_content(dc):
                 'drilldown': e['label']
             } for e in entries_sorted]
 
+            owners = snap.user_names(snap.owner_id)
             for e in entries_sorted:
                 percent = _percent(e['total_days'])
-                usage = {}
-                for b in e['bookings']:
-                    name = b.owner.name
-                    if name not in usage:
-                        usage[name] = 0
-                    usage[name] += _value(b)
+                indexes = entries_indexes[e['key']]
+                usage = sum_by(owners[indexes], values[indexes])
 
                 drilldown_data.append({
                     'name': _name(e),
@@ -637,53 +626,40 @@ def register_content(dc):
         return report_microscopes_usage(**kwargs)
 
     @dc.content
+    @dc.memoize
     def report_sessions_distribution(**kwargs):
         data = report_microscopes_usage(**kwargs)
         dm = dc.app.dm  # shortcut
-        sessions = dm.get_sessions()
-        selected = data['selected_resources']
-        start_date = data['start_date']
-        end_date = data['end_date']
-        sessions_images = []
-        sessions_size = []
+        snap = dc.get_session_snapshot()
         active_users = {}
-        biggest = [0, 0]
 
         all_users = {u.email: u for u in dm.get_users()}
+        users_by_id = {u.id: u for u in all_users.values()}
 
         for e in data['entries']:
             for u in e.get('users', []):
                 active_users[u] = all_users[u]
 
         # Create monthly histogram for plotting (Highcharts)
-        sessions_monthly = defaultdict(lambda : [0, 0, 0])
-        for s in sessions:
-            movies = s.total_movies
-            b = s.booking
-            if (s.resource_id not in selected or movies <= 0 or
-                b is None or b.start < start_date or b.end > end_date):
-                continue
-            dkey = s.start.strftime('%Y-%m-01')
-            sm = sessions_monthly[dkey]
-            sm[0] += 1
-            size = s.total_size
-            sm[1] += size
-            sm[2] += movies
-            if movies > biggest[0]:
-                biggest = [movies, size]
-            sessions_images.append(movies)
-            sessions_size.append(size)
-            active_users[b.owner.email] = b.owner
+        dc.app.jobs.progress(0.6, 'Processing sessions')
+        mask = snap.select(data['selected_resources'],
+                           data['start_date'], data['end_date'])
+        sessions_images = snap.movies[mask]
+        sessions_size = snap.size[mask]
+        biggest = snap.biggest(mask)
+
+        for uid in snap.owner_id[mask].tolist():
+            owner = users_by_id[uid]
+            active_users[owner.email] = owner
 
         n = len(sessions_images)
 
         data.update(
-            {'sessions': sessions,
-             'sessions_monthly': [(k, v[0], v[1], v[2]) for k, v in sessions_monthly.items()],
-             'sessions_images': sessions_images,
-             'sessions_size': sessions_size,
-             'avg_images': sum(sessions_images) // n,
-             'avg_size': sum(sessions_size) // n,
+            {'sessions_monthly': snap.monthly(mask),
+             'sessions_images': sessions_images.tolist(),
+             'sessions_size': sessions_size.tolist(),
+             'avg_images': sessions_images.sum().item() // n,
+             'avg_size': sessions_size.sum().item() // n,
              'active_users': active_users,
              'biggest': '%d images (%s)' % (biggest[0], Pretty.size(biggest[1]))
         })
@@ -698,12 +674,13 @@ def register_content(dc):
     def report_projects_overview(**kwargs):
         data = report_sessions_distribution(**kwargs)
         projects_monthly = defaultdict(lambda : [0, set()])
+        dc.app.jobs.progress(0.8, 'Processing projects')
 
-        for p in dc.app.dm.get_projects():
+        for p in dc.get_all_projects():
             dkey = p.creation_date.strftime('%Y-%m-01')
             projects_monthly[dkey][0] += 1
 
-        for s in dc.app.dm.get_sessions():
+        for s in dc.get_all_sessions():
             b = s.booking
             p = s.project
             if p:
@@ -723,51 +700,67 @@ def register_content(dc):
 
     @dc.content
     def report_pis_usage(**kwargs):
+        dm = dc.app.dm
+        range_dict = dc.get_booking_range(kwargs)
+        # Whole months of the range are taken from the usage aggregates,
+        # so only bookings of the first and last months are loaded
+        aggregates, owners, bookings = dm.get_usage_range(
+            *dc._range_dates(range_dict))
+
+        users = {u.id: u for u in dm.get_users()}
+        costs = {r.id: r.daily_cost for r in dm.get_resources()}
+        pi_dict = {}
+        univ_map = dc.get_universities_map()
 
-        bookings, range_dict = dc.get_booking_in_range(kwargs, asJson=False)
+        def _counted(resource_id, booking_type):
+            # Same as the default filter of get_booking_in_range
+            return costs.get(resource_id, 0) > 0 and booking_type != 'slot'
 
-        pi_dict = {}
-        try:
-            univ_dict = dc.app.dm.get_universities_dict()
-        except:
-            univ_dict = {}
+        def _pi_entry(pi):
+            if pi.email not in pi_dict:
+                parts = pi.name.split()
+                pi_dict[pi.email] = {
+                    'first_name': ' '.join(parts[:-1]),
+                    'last_name': parts[-1],
+                    'email': pi.email,
+                    # 'email_rev': pi.email[::-1],  # reverse email for sorting
+                    'university': univ_map.get(pi.email, 'z-Unknown'),
+                    'bookings': 0,
+                    'days': 0,
+                    'users': set()
+                }
+            return pi_dict[pi.email]
+
+        for a in aggregates:
+            pi = users.get(a.pi_id, None)
+            if pi and _counted(a.resource_id, a.booking_type):
+                pi_entry = _pi_entry(pi)
+                pi_entry['bookings'] += a.bookings
+                pi_entry['days'] += a.days
 
-        def _get_univ(email, default=None):
-            for k, v in univ_dict.items():
-                if email.endswith(k):
-                    return v
-            return default
+        for owner_id, resource_id, booking_type in owners:
+            owner = users[owner_id]
+            pi = owner.get_pi()
+            if pi and _counted(resource_id, booking_type):
+                _pi_entry(pi)['users'].add(owner.email)
 
         for b in bookings:
-            pi = b.owner.get_pi()
-            if pi:
-                parts = pi.name.split()
-                first_name = ' '.join(parts[:-1])
-                last_name = parts[-1]
-                if not pi.email in pi_dict:
-                    pi_dict[pi.email] = {
-                        'first_name': first_name,
-                        'last_name': last_name,
-                        'email': pi.email,
-                        # 'email_rev': pi.email[::-1],  # reverse email for sorting
-                        'university': _get_univ(pi.email, 'z-Unknown'),
-                        'bookings': 0,
-                        'days': 0,
-                        'users': set()
-                    }
-                pi_entry = pi_dict[pi.email]
+            owner = users[b.owner_id]
+            pi = owner.get_pi()
+            if pi and _counted(b.resource_id, b.type):
+                pi_entry = _pi_entry(pi)
                 pi_entry['bookings'] += 1
                 pi_entry['days'] += b.days
-                pi_entry['users'].add(b.owner.email)
+                pi_entry['users'].add(owner.email)
 
         data = {
-            'pi_list': sorted(pi_dict.values(), key=lambda pi: pi['university'].lower())
+            'pi_list': sorted(pi_dict.values(),
+                              key=lambda pi: (pi['university'].lower(), pi['email']))
         }
         data.update(range_dict)
 
         return data
 
-
     @dc.content
     def invoice_periods_list(**kwargs):
         c = 0
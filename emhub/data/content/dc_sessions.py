@@ -33,7 +33,6 @@ from glob import glob
 import datetime as dt
 
 from emtools.utils import Pretty, Path
-from emtools.metadata import Bins, TsBins, EPU
 
 
 def register_content(dc):
@@ -126,6 +125,7 @@ def register_content(dc):
             else:
                 raise Exception('Unknown plot type: ' + plot)
 
+            from emtools.metadata import TsBins
             data['plot_data'] = TsBins(items).bins
 
         return data
@@ -148,18 +148,19 @@ def register_content(dc):
     def sessions_list(**kwargs):
         show_extra = 'extra' in kwargs and dc.app.user.is_admin
         dm = dc.app.dm  # shortcut
-        all_sessions = dm.get_sessions()
+        all_sessions = dc.get_all_sessions()
         sessions = []
-        bookingDict = {}
+        bookings = []
 
         for s in all_sessions:
             if s.booking:
                 a = s.booking.application
                 if a is None or a.allows_access(dc.app.user):
                     sessions.append(s)
-                    b = dc.booking_to_event(s.booking,
-                                              prettyDate=True, piApp=True)
-                    bookingDict[s.booking.id] = b
+                    bookings.append(s.booking)
+
+        events = dc.bookings_to_events(bookings, prettyDate=True, piApp=True)
+        bookingDict = {b.id: e for b, e in zip(bookings, events)}
 
         return {
             'sessions': sessions,
@@ -220,7 +221,7 @@ def register_content(dc):
     @dc.content
     def processing_projects_list(**kwargs):
         project_list = []
-        for project in dc.app.dm.get_projects():
+        for project in dc.get_all_projects():
             entries = []
             for entry in project.entries:
                 if entry.type == 'data_processing':
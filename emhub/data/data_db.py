@@ -27,6 +27,7 @@
 # **************************************************************************
 
 import os
+import time
 import datetime as dt
 from tzlocal import get_localzone
 import decimal
@@ -36,19 +37,31 @@ from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 
 from emhub.utils import datetime_from_isoformat
+from .query_log import QueryLog
 
 
 class DbManager:
     """ Helper class to deal with DB stuff
     """
-    def init_db(self, dbPath, cleanDb=False, create=True):
+    def init_db(self, dbPath, cleanDb=False, create=True, slowQuery=0):
         self.timezone = get_localzone()
         do_echo = os.environ.get('SQLALCHEMY_ECHO', '0') == '1'
 
         if cleanDb and os.path.exists(dbPath):
             os.remove(dbPath)
 
+        self._dbPath = dbPath
         engine = sqlalchemy.create_engine('sqlite:///' + dbPath, echo=do_echo)
+        self._engine = engine
+        self._query_listeners = []
+        self.commit_count = 0  # to invalidate data cached by callers
+
+        # Keep statistics of SQL statements and log the slow ones
+        # (over slowQuery seconds), disabled if the value is 0
+        self.query_log = None
+        if slowQuery > 0:
+            self.query_log = QueryLog(threshold=slowQuery)
+            self.add_query_listener(self.query_log.record)
 
         self._db_session = scoped_session(sessionmaker(autocommit=False,
                                                        autoflush=False,
@@ -64,6 +77,7 @@ class DbManager:
 
     def commit(self):
         self._db_session.commit()
+        self.commit_count += 1
 
     def delete(self, item, commit=True):
         self._db_session.delete(item)
@@ -73,6 +87,45 @@ class DbManager:
     def close(self):
         self._db_session.remove()
 
+    def add_query_listener(self, listener):
+        """ Register a function that will be called after each SQL statement
+        is executed with the arguments: (statement, parameters, elapsed).
+        Engine events are only hooked when the first listener is added,
+        so there is no overhead if nobody is listening.
+        """
+        if not self._query_listeners:
+            def _before_execute(conn, cursor, statement, parameters,
+                                context, executemany):
+                conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+            def _after_execute(conn, cursor, statement, parameters,
+                               context, executemany):
+                elapsed = time.perf_counter() - conn.info['query_start'].pop()
+                for listener in self._query_listeners:
+                    listener(statement, parameters, elapsed)
+
+            sqlalchemy.event.listen(self._engine, 'before_cursor_execute',
+                                    _before_execute)
+            sqlalchemy.event.listen(self._engine, 'after_cursor_execute',
+                                    _after_execute)
+
+        self._query_listeners.append(listener)
+
+    def remove_query_listener(self, listener):
+        if listener in self._query_listeners:
+            self._query_listeners.remove(listener)
+
+    def data_version(self):
+        """ Return a value that changes every time the database is modified.
+        The sqlite file modification time is used, so changes done by other
+        processes (e.g. other gunicorn workers) are also detected.
+        """
+        try:
+            st = os.stat(self._dbPath)
+            return st.st_mtime_ns, st.st_size
+        except OSError:
+            return None
+
     # ------------------- Some utility methods --------------------------------
     def now(self):
         # get local timezone
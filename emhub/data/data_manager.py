@@ -38,15 +38,16 @@ from emtools.utils import Pretty
 from emhub.utils import datetime_from_isoformat, datetime_to_isoformat
 from .data_db import DbManager
 from .data_log import DataLog
+from .aggregates import UsageAggregates
 from .data_models import create_data_models
-from .processing import get_processing_project
 
 
 class DataManager(DbManager):
     """ Main class that will manage the sessions and their information.
     """
     def __init__(self, dataPath, dbName='emhub.sqlite',
-                 user=None, cleanDb=False, create=True, redis=None):
+                 user=None, cleanDb=False, create=True, redis=None,
+                 slowQuery=0, usageAggregates=False):
         self._dataPath = dataPath
         self._sessionsPath = os.path.join(dataPath, 'sessions')
         self._entryFiles = os.path.join(dataPath, 'entry_files')
@@ -54,7 +55,8 @@ class DataManager(DbManager):
 
         # Initialize main database
         dbPath = os.path.join(dataPath, dbName)
-        self.init_db(dbPath, cleanDb=cleanDb, create=create)
+        self.init_db(dbPath, cleanDb=cleanDb, create=create,
+                     slowQuery=slowQuery)
 
         self._lastSession = None
         self._user = user  # Logged user
@@ -69,6 +71,11 @@ class DataManager(DbManager):
 
         self.r = redis
 
+        # Monthly usage aggregates, updated when bookings or sessions change
+        # only if usageAggregates is True (otherwise only on rebuild and
+        # not used by reports)
+        self.usage_aggregates = UsageAggregates(self, track=usageAggregates)
+
     def _create_models(self):
         """ Function called from the init_db method. """
         create_data_models(self)
@@ -475,8 +482,8 @@ class DataManager(DbManager):
                                        orderBy=orderBy,
                                        asJson=asJson)
 
-    def get_bookings_range(self, start, end, resource=None):
-        """ Shortcut function to retrieve a range of bookings. """
+    def _bookings_range(self, start, end, resource=None):
+        """ Return the SQL condition and the UTC limits for a range. """
         # JMRT: We need to convert the start and end to UTC before getting the range
         newStart = self.date(start.date()).astimezone(dt.timezone.utc)
         newEnd = self.date(end.date()).astimezone(dt.timezone.utc) + dt.timedelta(days=1)
@@ -489,17 +496,106 @@ class DataManager(DbManager):
         if resource is not None:
             conditionStr += " AND resource_id=%s" % resource.id
 
-        def in_range(b):
-            s, e = b.start, b.end
+        def in_range(s, e):
             return ((s >= newStart and s <= newEnd) or
                     (e >= newStart and e <= newEnd) or
                     (s <= newStart and e >= newEnd))
 
+        return conditionStr, in_range
+
+    def get_bookings_range(self, start, end, resource=None):
+        """ Shortcut function to retrieve a range of bookings. """
+        conditionStr, in_range = self._bookings_range(start, end, resource)
+
         bookings = [b for b in self.get_bookings(condition=conditionStr, orderBy='start')
-                    if in_range(b)]
+                    if in_range(b.start, b.end)]
 
         return bookings
 
+    def iter_bookings_range(self, start, end, chunk_size=500):
+        """ Same as get_bookings_range, but bookings are fetched from the
+        database in chunks (yield_per) while iterating.
+        """
+        conditionStr, in_range = self._bookings_range(start, end)
+        Booking = self.Booking
+        query = self._db_session.query(Booking).filter(
+            sqlalchemy.text(conditionStr)).order_by(Booking.start)
+
+        for b in query.yield_per(chunk_size):
+            if in_range(b.start, b.end):
+                yield b
+
+    def get_bookings_range_rows(self, start, end, columns):
+        """ Same as get_bookings_range, but only the given column names
+        are retrieved as tuples, without creating Booking objects.
+        The first two columns should be 'start' and 'end'.
+        """
+        conditionStr, in_range = self._bookings_range(start, end)
+        Booking = self.Booking
+        query = self._db_session.query(*[getattr(Booking, c) for c in columns])
+        query = query.filter(sqlalchemy.text(conditionStr))
+        query = query.order_by(Booking.start)
+
+        return [row for row in query if in_range(row[0], row[1])]
+
+    def get_rows(self, ModelClass, columns, condition=None):
+        """ Retrieve some columns of the given model as tuples. """
+        query = self._db_session.query(*[getattr(ModelClass, c) for c in columns])
+        if condition is not None:
+            query = query.filter(sqlalchemy.text(condition))
+        return query.all()
+
+    def get_usage_aggregates(self, start=None, end=None):
+        """ Return the monthly usage aggregates (UsageAggregate rows)
+        between start and end months (as YYYY-MM, both included).
+        """
+        UsageAggregate = self.UsageAggregate
+        query = self._db_session.query(UsageAggregate)
+        if start:
+            query = query.filter(UsageAggregate.month >= start)
+        if end:
+            query = query.filter(UsageAggregate.month <= end)
+        return query.order_by(UsageAggregate.month).all()
+
+    def get_usage_range(self, start, end):
+        """ Return the usage of the bookings in a range (the same ones
+        of get_bookings_range) as a tuple with:
+            - usage aggregates of the months completely inside the range
+            - distinct (owner_id, resource_id, type) of bookings in them
+            - the other bookings of the range
+        If changes are not tracked in the aggregates, all bookings
+        are returned and no aggregates.
+        """
+        ua = self.usage_aggregates
+        if not ua.tracking:
+            return [], [], self.get_bookings_range(start, end)
+
+        Booking = self.Booking
+        newStart = self.date(start.date()).astimezone(dt.timezone.utc)
+        newEnd = (self.date(end.date()).astimezone(dt.timezone.utc) +
+                  dt.timedelta(days=1))
+        query = self._db_session.query(Booking).filter(sqlalchemy.or_(
+            Booking.start.between(newStart, newEnd),
+            Booking.end.between(newStart, newEnd),
+            (Booking.start <= newStart) & (Booking.end >= newEnd)))
+
+        months, first, last = ua.whole_months(newStart, newEnd)
+        if not months:
+            return [], [], query.order_by(Booking.start).all()
+
+        in_months = (Booking.start >= first) & (Booking.start < last)
+        bookings = query.filter(~in_months).order_by(Booking.start).all()
+        owners = self._db_session.query(
+            Booking.owner_id, Booking.resource_id, Booking.type).filter(
+            in_months).distinct().all()
+
+        return (self.get_usage_aggregates(months[0], months[-1]),
+                owners, bookings)
+
+    def rebuild_usage_aggregates(self):
+        """ Recompute all monthly usage aggregates. """
+        return self.usage_aggregates.rebuild()
+
     def get_user_bookings(self, uid):
         """ Return bookings related to this user.
         User might be creator, owner or operator of the booking.
@@ -770,6 +866,9 @@ class DataManager(DbManager):
             raise Exception("Expecting either 'session_id', 'entry_id' or 'path'"
                             "to load a project.")
 
+        # Processing readers are heavy (numpy, mrcfile, etc), only load
+        # them when a processing project is requested
+        from .processing import get_processing_project
         pp = get_processing_project(project_path)
         result = {'project': pp, 'args': args}
 
@@ -819,7 +918,18 @@ class DataManager(DbManager):
 
     def update_invoice_period(self, **attrs):
         """ Update session attrs. """
-        return self.__update_item(self.InvoicePeriod, **attrs)
+        period = self.__update_item(self.InvoicePeriod, **attrs)
+        # Store closing balances when a period is closed, and remove
+        # them if it is opened again
+        extra = period.extra or {}
+        if period.status == 'closed' and 'balances' not in extra:
+            self.update_invoice_balances(period)
+        elif period.status != 'closed' and 'balances' in extra:
+            extra = dict(extra)
+            del extra['balances']
+            period.extra = extra
+            self.commit()
+        return period
 
     def delete_invoice_period(self, **attrs):
         """ Remove a session row. """
@@ -829,6 +939,99 @@ class DataManager(DbManager):
         """ This should return a single user or None. """
         return self.__item_by(self.InvoicePeriod, **kwargs)
 
+    def _pi_members_ids(self, pi):
+        """ Ids of users for which user.get_pi() is the given pi. """
+        User = self.User
+        members = [uid for uid, roles in self._db_session.query(
+            User.id, User.roles).filter(User.pi_id == pi.id)
+                   if 'pi' not in (roles or [])]
+        if pi.is_pi:
+            members.append(pi.id)
+        return members
+
+    def _invoiceable_bookings(self):
+        """ Query of started bookings (type booking) of resources with cost. """
+        Booking = self.Booking
+        resources = [r.id for r in self.get_resources() if r.daily_cost > 0]
+        return self._db_session.query(Booking).filter(
+            Booking.type == 'booking',
+            Booking.resource_id.in_(resources),
+            Booking.start <= self.now())
+
+    def get_pi_ledger(self, pi):
+        """ Return the invoiceable bookings of the PI's lab members and the
+        PI's transactions, only loading the rows related to that PI.
+        """
+        Booking, Transaction = self.Booking, self.Transaction
+        bookings = self._invoiceable_bookings().filter(
+            Booking.owner_id.in_(self._pi_members_ids(pi))).order_by(Booking.id).all()
+        transactions = self._db_session.query(Transaction).filter(
+            Transaction.user_id == pi.id).order_by(Transaction.id).all()
+        return bookings, transactions
+
+    def get_invoice_balances(self, period):
+        """ Compute the closing balance of each PI at the end of the given
+        invoice period. Positive balances are invoiced and reset to 0 after
+        every (not disabled) period, negative ones are carried over.
+        Only bookings and transactions after the previous closed period
+        are loaded, starting from the balances stored in that period.
+
+        Returns:
+            dict: {pi_id: balance}
+        """
+        Booking, Transaction = self.Booking, self.Transaction
+        periods = [p for p in self.get_invoice_periods()
+                   if p.status != 'disabled' and p.end <= period.end
+                   and p.id != period.id]
+        periods.sort(key=lambda p: p.end)
+        closed = [p for p in periods
+                  if p.status == 'closed' and 'balances' in (p.extra or {})]
+
+        totals = defaultdict(lambda: 0)
+        bookings = self._invoiceable_bookings().filter(
+            Booking.start <= period.end)
+        transactions = self._db_session.query(Transaction).filter(
+            Transaction.date <= period.end)
+
+        if closed:
+            last = closed[-1]
+            periods = [p for p in periods if p.end > last.end]
+            for pi_id, total in last.extra['balances'].items():
+                totals[int(pi_id)] = min(total, 0)
+            bookings = bookings.filter(Booking.start > last.end)
+            transactions = transactions.filter(Transaction.date > last.end)
+
+        user_pi = {uid: uid if 'pi' in (roles or []) else pi_id
+                   for uid, roles, pi_id in self.get_rows(
+                       self.User, ['id', 'roles', 'pi_id'])}
+
+        entries = [(b.start, user_pi.get(b.owner_id), b.total_cost)
+                   for b in bookings]
+        entries.extend((t.date, t.user_id, t.amount) for t in transactions)
+        entries.sort(key=lambda e: e[0])
+
+        i, n = 0, len(entries)
+        for p in periods + [period]:
+            while i < n and entries[i][0] <= p.end:
+                date, pi_id, amount = entries[i]
+                if pi_id:
+                    totals[pi_id] += amount
+                i += 1
+            if p is not period:
+                for pi_id, total in totals.items():
+                    if total > 0:
+                        totals[pi_id] = 0
+
+        return dict(totals)
+
+    def update_invoice_balances(self, period):
+        """ Store closing balances in the extra of a closed period. """
+        extra = dict(period.extra or {})
+        extra['balances'] = {str(k): v
+                             for k, v in self.get_invoice_balances(period).items()}
+        period.extra = extra
+        self.commit()
+
     # ---------------------------- TRANSACTIONS -------------------------------
     def get_transactions(self, condition=None, orderBy=None, asJson=False):
         """ Returns a list.
@@ -1508,9 +1711,8 @@ class DataManager(DbManager):
                 return 0
             return 1
 
-        def get_new_tasks(self):
-            results = self.r.xreadgroup('group', self.worker, {self.name: '>'},
-                                        block=60000)
+        def _read_new_tasks(self):
+            results = self.r.xreadgroup('group', self.worker, {self.name: '>'})
             new_tasks = []
             if results:
                 for task_id, task in results[0][1]:
@@ -1522,6 +1724,23 @@ class DataManager(DbManager):
                 })
             return new_tasks
 
+        def get_new_tasks(self, timeout=0):
+            """ Return new tasks for this worker. If there are no tasks,
+            wait (at most timeout seconds) until new ones are added.
+            The wait is done using the shared TaskWaiter, without holding
+            a Redis connection per waiting worker.
+            """
+            new_tasks = self._read_new_tasks()
+
+            if not new_tasks and timeout:
+                with self.dm.get_task_waiter().wait_for(self.name) as event:
+                    # Read again, tasks could be added before registering
+                    new_tasks = self._read_new_tasks()
+                    if not new_tasks and event.wait(timeout):
+                        new_tasks = self._read_new_tasks()
+
+            return new_tasks
+
         def get_all_tasks(self):
             tasks = []
             pending = self.get_pending_tasks()
@@ -1563,6 +1782,13 @@ class DataManager(DbManager):
                   'connected': Pretty.datetime(now)})
         self.update_config('hosts', hosts, cache=True)
 
+    def get_task_waiter(self):
+        """ Return the shared TaskWaiter (created on first use). """
+        if getattr(self, '_task_waiter', None) is None:
+            from .task_waiter import TaskWaiter
+            self._task_waiter = TaskWaiter(self.r)
+        return self._task_waiter
+
     def get_worker_stream(self, worker, update=False):
         host = self.get_hosts().get(worker, None)
 
@@ -1328,6 +1328,39 @@ def create_data_models(dm):
             extra[key] = value
             self.extra = extra
 
+    class UsageAggregate(Base):
+        """ Monthly usage totals by resource, PI, application and booking
+        type. Rows are computed from bookings and sessions and kept up to
+        date by emhub.data.aggregates.UsageAggregates.
+        """
+        __tablename__ = 'usage_aggregates'
+
+        id = Column(Integer,
+                    primary_key=True)
+
+        # Month (in local time) of the bookings' start, as YYYY-MM
+        month = Column(String(7),
+                       index=True,
+                       nullable=False)
+
+        resource_id = Column(Integer, nullable=False)
+        # PI of the booking's owner, 0 if none
+        pi_id = Column(Integer, nullable=False)
+        # 0 if the bookings have no application
+        application_id = Column(Integer, nullable=False)
+        booking_type = Column(String(16), nullable=False)
+
+        bookings = Column(Integer, default=0)
+        days = Column(Integer, default=0)
+        hours = Column(Integer, default=0)
+        cost = Column(Float, default=0)
+        sessions = Column(Integer, default=0)
+        movies = Column(Integer, default=0)
+        bytes = Column(Integer, default=0)
+
+        def json(self):
+            return dm.json_from_object(self)
+
     class PuckStorage:
         """ Simple class to organize pucks access. """
 
@@ -1403,3 +1436,4 @@ def create_data_models(dm):
     dm.Entry = Entry
     dm.Puck = Puck
     dm.PuckStorage = PuckStorage
+    dm.UsageAggregate = UsageAggregate
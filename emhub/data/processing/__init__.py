@@ -16,17 +16,84 @@
 
 import os
 
+from emhub.utils.cache import LRUCache
+
 from .processing_relion import RelionSessionData
 from .processing_scipion import ScipionSessionData
 
 
-def get_processing_project(project_path):
-    """ Create a Processing Project instance from this path. """
+# Files and folders (relative to the project path) whose modification
+# time changes when new runs or outputs are added to the project
+PROJECT_FILES = ['project.sqlite', 'default_pipeline.star', 'Runs',
+                 os.path.join('EPU', 'movies.star')]
+
+_readers = None
+
+
+def _readers_cache():
+    """ Process-wide LRU cache of project readers. It is configured with
+    PROCESSING_CACHE_ITEMS and PROCESSING_CACHE_SIZE (in MB) if there is
+    an app context. """
+    global _readers
+    if _readers is None:
+        import flask
+        config = flask.current_app.config if flask.has_app_context() else {}
+        _readers = LRUCache(
+            max_items=config.get('PROCESSING_CACHE_ITEMS', 16),
+            max_size=config.get('PROCESSING_CACHE_SIZE', 512) * 1024 * 1024,
+            sizeof=lambda item: item[1].cache_size())
+    return _readers
+
+
+def project_signature(project_path):
+    """ Return the modification times of the main project files and of
+    the folders in the project (e.g. Relion job types), that change when
+    the readers should be created again. """
+    signature = []
+    for fn in PROJECT_FILES:
+        try:
+            signature.append(os.stat(os.path.join(project_path, fn)).st_mtime_ns)
+        except OSError:
+            signature.append(None)
+
+    with os.scandir(project_path) as it:
+        signature.extend(sorted((e.name, e.stat().st_mtime_ns) for e in it
+                                if e.is_dir() and not e.name.startswith('.')))
+    return signature
+
+
+def get_processing_project(project_path, cache=True):
+    """ Create a Processing Project instance from this path.
+    If cache is True, the same instance is returned while the main
+    files of the project are not modified.
+    """
     if not project_path or project_path.endswith('h5'):
         return None
     elif not os.path.exists(project_path):
         raise Exception(f"ERROR: can't load session data path: {project_path}")
 
+    if not cache:
+        return _create_processing_project(project_path)
+
+    readers = _readers_cache()
+    key = os.path.abspath(project_path)
+    signature = project_signature(key)
+    item = readers.get(key)
+
+    if item is None or item[0] != signature:
+        item = (signature, _create_processing_project(project_path))
+
+    # Store it again to update the size of the reader internal caches
+    readers.put(key, item)
+    return item[1]
+
+
+def clear_processing_cache():
+    """ Remove all cached readers. """
+    _readers_cache().clear()
+
+
+def _create_processing_project(project_path):
     projectSqlite = os.path.join(project_path, 'project.sqlite')
 
     if os.path.exists(projectSqlite):
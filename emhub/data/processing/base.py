@@ -19,7 +19,10 @@ import datetime as dt
 from glob import glob
 from collections import defaultdict
 import json
+import base64
+import tempfile
 
+import numpy as np
 import mrcfile
 from emtools.utils import Path, Timer, Pretty
 from emtools.metadata import StarFile, EPU, SqliteFile
@@ -33,6 +36,94 @@ def hours(tsFirst, tsLast):
     return d.days * 24 + d.seconds / 3600
 
 
+def app_config():
+    """ Return the current app config, or an empty dict if
+    there is no app context (e.g. reading projects from scripts). """
+    import flask
+    return flask.current_app.config if flask.has_app_context() else {}
+
+
+def cache_dir(*paths):
+    """ Writable folder for processing side files (PROCESSING_CACHE_DIR),
+    by default 'cache/processing' in the instance folder. """
+    import flask
+    default = (os.path.join(flask.current_app.instance_path, 'cache', 'processing')
+               if flask.has_app_context() else
+               os.path.join(tempfile.gettempdir(), 'emhub-processing-cache'))
+    return os.path.join(app_config().get('PROCESSING_CACHE_DIR', default), *paths)
+
+
+def gridsquare_ids(micNames):
+    """ Return a NumPy array with the GridSquare id of each micrograph,
+    as given by EPU.get_movie_location. Folders are only parsed once. """
+    folders = {}
+
+    def _gs(name):
+        if '_Data_FoilHole_' in name:
+            return EPU.get_movie_location(name)['gs']
+        folder, base = os.path.split(name)
+        gs = EPU.get_movie_location(base)['gs']
+        if gs is None:
+            if folder not in folders:
+                folders[folder] = EPU.get_movie_location(folder)['gs']
+            gs = folders[folder]
+        return gs
+
+    return np.array([_gs(n) for n in micNames], dtype=object)
+
+
+def round_array(values, decimals):
+    """ Same as Python round for each value. np.round differs for values
+    close to a half (e.g. 2.4715), so these are rounded with Python. """
+    result = np.round(values, decimals)
+    scaled = values * 10 ** decimals
+    ties = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+    if ties.any():
+        result[ties] = [round(v, decimals) for v in values[ties].tolist()]
+    return result
+
+
+def bins_list(values, delimiters):
+    """ Count values in the ranges defined by the delimiters, with the
+    same output as emtools.metadata.Bins.toList. """
+    n = len(values)
+    if not n:
+        return []
+    counts = np.bincount(np.digitize(values, delimiters),
+                         minlength=len(delimiters) + 1)
+    result = []
+    for i, b in enumerate(counts.tolist()):
+        if i == 0:
+            label = "< %s" % delimiters[0]
+        elif i == len(delimiters):
+            label = "> %s" % delimiters[i - 1]
+        else:
+            label = "> %s and < %s" % (delimiters[i - 1], delimiters[i])
+        result.append((label, b, round((b * 100.0) / n, 2)))
+    return result
+
+
+def pack_array(values, scale=None, labels=None):
+    """ Pack an array as base64 of int32 values, to reduce the size and
+    encoding time of long series in JSON responses. Float values are stored
+    in fixed point (multiplied by scale) and strings as indexes in labels.
+    """
+    if labels is not None:
+        index = {label: i for i, label in enumerate(labels)}
+        values = np.fromiter((index[v] for v in values), dtype=np.int32,
+                             count=len(values))
+    elif scale:
+        values = np.rint(np.asarray(values) * scale)
+    packed = {'packed': 'int32',
+              'data': base64.b64encode(
+                  np.asarray(values, dtype='<i4').tobytes()).decode()}
+    if scale:
+        packed['scale'] = scale
+    if labels is not None:
+        packed['labels'] = list(labels)
+    return packed
+
+
 class SessionRun:
     """ Group functions related to a run in a Session. """
     def __init__(self, project, path):
@@ -95,6 +186,14 @@ class SessionData:
         """ Deprecated, just for backward compatibility. """
         pass
 
+    def cache_size(self):
+        """ Approximate memory (in bytes) used by this reader and the data
+        cached in it. Used to bound the memory of the readers cache. """
+        size = 4096
+        if self._epuData:
+            size += 256 * self._epuData.moviesTable.size()
+        return size
+
     # ------------ Functions to override in subclasses ---------------------
     def get_stats(self):
         return {'movies': {'count': 0}, 'ctfs': {'count': 0}}
@@ -102,6 +201,82 @@ class SessionData:
     def get_micrographs(self):
         return []
 
+    def get_micrograph_table(self):
+        """ Return the micrographs' CTF information as a dict of NumPy
+        arrays (all of the same length):
+            micrograph, micName, defocus, defocusAngle, astigmatism,
+            resolution and gridsquare (None if unknown)
+        Subclasses can override it to avoid creating one dict per
+        micrograph with get_micrographs.
+        """
+        mics = list(self.get_micrographs())
+
+        def _array(key):
+            return np.array([m[key] for m in mics], dtype=np.float64)
+
+        micNames = [m.get('micName', m['micrograph']) for m in mics]
+        return {
+            'micrograph': np.array([m['micrograph'] for m in mics], dtype=object),
+            'micName': np.array(micNames, dtype=object),
+            'defocus': _array('ctfDefocus'),
+            'defocusAngle': _array('ctfDefocusAngle'),
+            'astigmatism': _array('ctfAstigmatism'),
+            'resolution': _array('ctfResolution'),
+            'gridsquare': gridsquare_ids(micNames)
+        }
+
+    def get_micrograph_images(self):
+        """ Iterate over (micrograph, psd) image paths of all micrographs. """
+        for mic in self.get_micrographs():
+            psd = mic.get('ctfImage', None)
+            yield (self.join(mic['micrograph']),
+                   self.join(psd).replace(':mrc', '') if psd else None)
+
+    def get_ctf_series(self, packed=False):
+        """ Return the CTF values of all micrographs (defocus and
+        astigmatism in microns, resolution in A) to be plotted in the
+        session view, together with their distribution in bins and
+        an estimated timestamp range.
+        If packed, the series are encoded with pack_array.
+        """
+        mics = self.get_micrograph_table()
+        n = len(mics['micrograph'])
+        defocus = round_array(mics['defocus'] * 0.0001, 3)
+        resolution = round_array(mics['resolution'], 3)
+        astigmatism = round_array(mics['astigmatism'] * 0.0001, 3)
+
+        if n:
+            tsFirst, tsLast = [os.path.getmtime(self.join(mics['micrograph'][i]))
+                               for i in (0, -1)]
+            step = (tsLast - tsFirst) / n
+        else:
+            tsFirst = dt.datetime.timestamp(dt.datetime.now())
+            step = 1000
+            tsLast = tsFirst
+
+        def _series(values):
+            return pack_array(values, scale=1000) if packed else values.tolist()
+
+        gridsquares = mics['gridsquare']
+        if packed:
+            labels = list(dict.fromkeys(gridsquares.tolist()))
+            gridsquares = pack_array(gridsquares, labels=labels)
+        else:
+            gridsquares = gridsquares.tolist()
+
+        return {
+            'defocus': _series(defocus),
+            'defocusAngle': _series(mics['defocusAngle']),
+            'astigmatism': _series(astigmatism),
+            'resolution': _series(resolution),
+            'defocus_bins': bins_list(defocus, [1, 2, 3]),
+            'resolution_bins': bins_list(resolution, [3, 4, 6]),
+            'gridsquares': gridsquares,
+            'tsRange': {'first': tsFirst * 1000,  # Timestamp in milliseconds
+                        'last': tsLast * 1000,
+                        'step': step * 1000}
+        }
+
     def get_micrograph_data(self):
         return {}
 
@@ -131,19 +306,13 @@ class SessionData:
                 }
                 break
 
-        def _microns(v):
-            return round(v * 0.0001, 3)
-
-        defocus = []
-        resolution = []
+        mics = self.get_micrograph_table()
+        mask = mics['gridsquare'] == gsId
+        defocus = round_array(mics['defocus'][mask] * 0.0001, 3).tolist()
+        resolution = round_array(mics['resolution'][mask], 3).tolist()
         particles = 0
-        for mic in self.get_micrographs():
-            micName = mic.get('micName', mic['micrograph'])
-            loc = EPU.get_movie_location(micName)
-            if loc['gs'] == gsId:
-                defocus.append(_microns(mic['ctfDefocus']))
-                resolution.append(round(mic['ctfResolution'], 3))
-                particles += len(self.get_micrograph_coordinates(micName))
+        for micName in mics['micName'][mask]:
+            particles += len(self.get_micrograph_coordinates(micName))
 
         locData.update({'defocus': defocus,
                         'resolution': resolution,
@@ -0,0 +1,119 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. de la Rosa Trevin (delarosatrevin@gmail.com)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# **************************************************************************
+"""
+Persistent index of the coordinate files of a Relion picking job.
+
+For each row of the job's coordinate_files table, the index stores the
+number of particles and the average FOM of the micrograph coordinates,
+so summary plots do not need to open thousands of STAR files.
+The index is written in the job folder (if writable) and only the
+coordinate files of new (or modified) micrographs are read when the
+job grows.
+"""
+
+import os
+
+import numpy as np
+
+from emhub.utils.cache import LRUCache
+from ..star_tables import StarTable, get_star_table
+
+
+INDEX_NAME = 'emhub_coordinates_index.star'
+INDEX_TABLE = 'coordinates_index'
+INDEX_COLUMNS = ['rlnMicrographCoordinates', 'emhubFileSize', 'emhubFileMtime',
+                 'emhubParticles', 'emhubAverageFOM']
+
+# coordinates STAR file -> (coordinate_files table, index arrays, index rows)
+_indexes = LRUCache(max_items=64)
+
+
+def _file_stats(path):
+    """ Return (size, mtime, particles, average FOM) of a coordinates file. """
+    st = os.stat(path)
+    t = StarTable.load(path, '')  # Not kept in the tables cache
+    n = t.size()
+    fom = float(t.column('rlnAutopickFigureOfMerit').sum()) / n if n else 0.0
+    return st.st_size, st.st_mtime_ns, n, fom
+
+
+def _read_index(indexFn):
+    """ Read the index rows from the file, if exists. """
+    if not os.path.exists(indexFn):
+        return []
+    try:
+        return list(get_star_table(indexFn, INDEX_TABLE))
+    except Exception:
+        return []  # Corrupted index, it will be written again
+
+
+def _write_index(indexFn, rows):
+    """ Write the index rows, replacing the file in a single step.
+    Return False if the job folder is not writable. """
+    tmpFn = f'{indexFn}.{os.getpid()}.tmp'
+    try:
+        with open(tmpFn, 'w') as f:
+            f.write(f"\ndata_{INDEX_TABLE}\n\nloop_\n")
+            for i, c in enumerate(INDEX_COLUMNS):
+                f.write(f"_{c} #{i + 1}\n")
+            for r in rows:
+                f.write(f"{r[0]} {r[1]} {r[2]} {r[3]} {float(r[4])!r}\n")
+            f.write('\n')
+        os.replace(tmpFn, indexFn)
+        return True
+    except OSError:
+        if os.path.exists(tmpFn):
+            os.remove(tmpFn)
+        return False
+
+
+def get_coordinates_index(projectPath, coordStar):
+    """ Return a dict with the arrays 'file', 'particles' and 'fom',
+    with one value per row of the coordinate_files table of coordStar.
+    """
+    table = get_star_table(coordStar, 'coordinate_files')
+    cached = _indexes.get(coordStar)
+    if cached and cached[0] is table:
+        return cached[1]
+
+    files = table.column('rlnMicrographCoordinates').tolist()
+    indexFn = os.path.join(os.path.dirname(coordStar), INDEX_NAME)
+    # Use the rows in memory if the index could not be written
+    oldRows = _read_index(indexFn) or (cached[2] if cached else [])
+    rows = []
+    changed = len(oldRows) != len(files)
+
+    for i, fn in enumerate(files):
+        path = os.path.join(projectPath, fn)
+        row = oldRows[i] if i < len(oldRows) else None
+        if row is not None and row[0] == fn:
+            st = os.stat(path)
+            if (row[1], row[2]) == (st.st_size, st.st_mtime_ns):
+                rows.append(tuple(row))
+                continue
+        rows.append((fn,) + _file_stats(path))
+        changed = True
+
+    if changed:
+        _write_index(indexFn, rows)
+
+    index = {
+        'file': np.array(files, dtype=object),
+        'particles': np.array([r[3] for r in rows], dtype=np.int64),
+        'fom': np.array([r[4] for r in rows], dtype=np.float64)
+    }
+    _indexes.put(coordStar, (table, index, rows))
+    return index
@@ -24,7 +24,10 @@ from emtools.utils import Path, Timer, Pretty
 from emtools.metadata import StarFile, EPU, SqliteFile
 from emtools.image import Thumbnail
 
-from ..base import SessionRun, SessionData, hours
+from ..base import SessionRun, SessionData, hours, gridsquare_ids
+from ..star_tables import get_star_table
+from .. import thumbnails, volumes
+from .coords_index import get_coordinates_index
 from .runs import RelionRun
 
 location = os.path.dirname(__file__)
@@ -34,30 +37,37 @@ class RelionSessionData(SessionData):
     """
     Adapter class for reading Session data from Relion OTF
     """
+    def cache_size(self):
+        size = SessionData.cache_size(self)
+        if cached := getattr(self, '_micTable', None):
+            mics = cached[1]
+            # Object arrays also reference one string per micrograph
+            size += sum(a.nbytes for a in mics.values()) + 100 * len(mics['micrograph'])
+        return size
+
     def get_stats(self):
 
         def _stats_from_star(jobType, starFn, tableName, attribute):
             fn = self.get_last_star(jobType, starFn)
             if not fn or not os.path.exists(fn):
                 return {'count': 0}
-            with StarFile(fn) as sf:
-                if attribute == 'count':
-                    return {'count': sf.getTableSize(tableName)}
-                t = sf.getTable(tableName)
-                firstRow, lastRow = t[0], t[-1]
-                try:
-                    first = self.mtime(getattr(firstRow, attribute))
-                    last = self.mtime(getattr(lastRow, attribute))
-                    h = hours(first, last)
-                except:
-                    first = last = h = 0
-
-                return {
-                    'hours': h,
-                    'count': t.size(),
-                    'first': first,
-                    'last': last,
-                }
+            t = get_star_table(fn, tableName)
+            if attribute == 'count':
+                return {'count': t.size()}
+            firstRow, lastRow = t[0], t[-1]
+            try:
+                first = self.mtime(getattr(firstRow, attribute))
+                last = self.mtime(getattr(lastRow, attribute))
+                h = hours(first, last)
+            except:
+                first = last = h = 0
+
+            return {
+                'hours': h,
+                'count': t.size(),
+                'first': first,
+                'last': last,
+            }
 
         moviesStar = self.get_last_star('Import', 'movies.star')
         if not moviesStar:
@@ -96,54 +106,82 @@ class RelionSessionData(SessionData):
         if not micFn:
             return []
 
-        with StarFile(micFn) as sf:
-            for row in sf.iterTable('micrographs'):
-                micData = {
-                    'micrograph': row.rlnMicrographName,
-                    'ctfImage': row.rlnCtfImage,
-                    'ctfDefocus': row.rlnDefocusU,
-                    'ctfResolution': min(row.rlnCtfMaxResolution, 10),
-                    'ctfDefocusAngle': row.rlnDefocusAngle,
-                    'ctfAstigmatism': row.rlnCtfAstigmatism
-                }
-                yield micData
+        for row in get_star_table(micFn, 'micrographs'):
+            micData = {
+                'micrograph': row.rlnMicrographName,
+                'ctfImage': row.rlnCtfImage,
+                'ctfDefocus': row.rlnDefocusU,
+                'ctfResolution': min(row.rlnCtfMaxResolution, 10),
+                'ctfDefocusAngle': row.rlnDefocusAngle,
+                'ctfAstigmatism': row.rlnCtfAstigmatism
+            }
+            yield micData
+
+    def get_micrograph_table(self):
+        """ Columnar version of get_micrographs (see SessionData).
+        The result is kept until the micrographs table changes. """
+        micFn = self._last_micFn()
+        if not micFn:
+            return super().get_micrograph_table()
+
+        t = get_star_table(micFn, 'micrographs')
+        cached = getattr(self, '_micTable', None)
+        if cached is None or cached[0] is not t:
+            names = t.column('rlnMicrographName').astype(object)
+            mics = {
+                'micrograph': names,
+                'micName': names,
+                'defocus': t.column('rlnDefocusU').astype(np.float64),
+                'defocusAngle': t.column('rlnDefocusAngle').astype(np.float64),
+                'astigmatism': t.column('rlnCtfAstigmatism').astype(np.float64),
+                'resolution': np.minimum(t.column('rlnCtfMaxResolution'), 10).astype(np.float64),
+            }
+            # Only compute gridsquares of new rows if the table has grown
+            prev = cached[1] if cached else None
+            k = len(prev['micrograph']) if prev else 0
+            if k and k <= len(names) and (prev['micrograph'] == names[:k]).all():
+                mics['gridsquare'] = np.concatenate(
+                    [prev['gridsquare'], gridsquare_ids(names[k:].tolist())])
+            else:
+                mics['gridsquare'] = gridsquare_ids(names.tolist())
+            self._micTable = cached = (t, mics)
+        return cached[1]
 
     def get_micrograph_data(self, micId):
         micFn = self._last_micFn()
         data = {}
         if micFn:
-            with StarFile(micFn) as sf:
-                otable = sf.getTable('optics')
-                row = sf.getTableRow('micrographs', micId - 1)
-                micThumb = Thumbnail.Micrograph()
-                psdThumb = Thumbnail.Psd()
-                micFn = self.join(row.rlnMicrographName)
-                micThumbBase64 = micThumb.from_mrc(micFn)
-                psdFn = self.join(row.rlnCtfImage).replace(':mrc', '')
-                pixelSize = otable[0].rlnMicrographPixelSize
-
-                loc = EPU.get_movie_location(micFn)
-
-                if pickStar := self.get_last_star('*Pick', '*pick.star'):
-                    coords = self.get_micrograph_coordinates(pickStar, micId)
-                else:
-                    coords = []
-
-                data = {
-                    'micThumbData': micThumbBase64,
-                    'psdData': psdThumb.from_mrc(psdFn),
-                    # 'shiftPlotData': None,
-                    'ctfDefocusU': round(row.rlnDefocusU/10000., 2),
-                    'ctfDefocusV': round(row.rlnDefocusV/10000., 2),
-                    'ctfDefocusAngle': round(row.rlnDefocusAngle, 2),
-                    'ctfAstigmatism': round(row.rlnCtfAstigmatism/10000, 2),
-                    'ctfResolution': round(row.rlnCtfMaxResolution, 2),
-                    'coordinates': coords,
-                    'micThumbPixelSize': pixelSize * micThumb.scale,
-                    'pixelSize': pixelSize,
-                    'gridSquare': loc['gs'],
-                    'foilHole': loc['fh']
-                }
+            otable = get_star_table(micFn, 'optics')
+            row = get_star_table(micFn, 'micrographs')[micId - 1]
+            micThumb = Thumbnail.Micrograph()
+            psdThumb = Thumbnail.Psd()
+            micFn = self.join(row.rlnMicrographName)
+            micThumbBase64 = thumbnails.from_mrc(micThumb, micFn)
+            psdFn = self.join(row.rlnCtfImage).replace(':mrc', '')
+            pixelSize = otable[0].rlnMicrographPixelSize
+
+            loc = EPU.get_movie_location(micFn)
+
+            if pickStar := self.get_last_star('*Pick', '*pick.star'):
+                coords = self.get_micrograph_coordinates(pickStar, micId)
+            else:
+                coords = []
+
+            data = {
+                'micThumbData': micThumbBase64,
+                'psdData': thumbnails.from_mrc(psdThumb, psdFn),
+                # 'shiftPlotData': None,
+                'ctfDefocusU': round(row.rlnDefocusU/10000., 2),
+                'ctfDefocusV': round(row.rlnDefocusV/10000., 2),
+                'ctfDefocusAngle': round(row.rlnDefocusAngle, 2),
+                'ctfAstigmatism': round(row.rlnCtfAstigmatism/10000, 2),
+                'ctfResolution': round(row.rlnCtfMaxResolution, 2),
+                'coordinates': coords,
+                'micThumbPixelSize': pixelSize * micThumb.scale,
+                'pixelSize': pixelSize,
+                'gridSquare': loc['gs'],
+                'foilHole': loc['fh']
+            }
         return data
 
     def get_workflow(self):
@@ -238,59 +276,60 @@ class RelionSessionData(SessionData):
     def coords_from_row(self, row):
         """ Iterate coordinates from a row containing the STAR file
          path with the coordinates. """
-        coordStar = self.join(row.rlnMicrographCoordinates)
-        with StarFile(coordStar) as sf:
-            for c in sf.iterTable(''):
-                yield c
+        return iter(self._coords_table(row))
+
+    def _coords_table(self, row):
+        return get_star_table(self.join(row.rlnMicrographCoordinates), '')
 
     def load_micrograph_data(self, micId, micsStar):
-        with StarFile(micsStar) as sf:
-            otable = sf.getTable('optics')
-            row = sf.getTableRow('micrographs', micId - 1)
-            micThumb = Thumbnail.Micrograph()
-            micFn = self.join(row.rlnMicrographName)
-            micThumbBase64 = micThumb.from_mrc(micFn)
-            pixelSize = otable[0].rlnMicrographPixelSize
+        otable = get_star_table(micsStar, 'optics')
+        row = get_star_table(micsStar, 'micrographs')[micId - 1]
+        micThumb = Thumbnail.Micrograph()
+        micFn = self.join(row.rlnMicrographName)
+        micThumbBase64 = thumbnails.from_mrc(micThumb, micFn)
+        pixelSize = otable[0].rlnMicrographPixelSize
+
+        micData = {
+            'micThumbData': micThumbBase64,
+            'coordinates': [],  # Check for picking
+            'micThumbPixelSize': pixelSize * micThumb.scale,
+            'pixelSize': pixelSize,
+            'gridSquare': '',
+            'foilHole': ''
+        }
 
-            micData = {
-                'micThumbData': micThumbBase64,
-                'coordinates': [],  # Check for picking
-                'micThumbPixelSize': pixelSize * micThumb.scale,
-                'pixelSize': pixelSize,
-                'gridSquare': '',
-                'foilHole': ''
-            }
+        if hasattr(row, 'rlnCtfImage'):
+            psdThumb = Thumbnail.Psd()
+            psdFn = self.join(row.rlnCtfImage).replace(":mrc", "")
+            ctfProfile = psdFn.replace('.ctf', '_avrot.txt')
 
-            if hasattr(row, 'rlnCtfImage'):
-                psdThumb = Thumbnail.Psd()
-                psdFn = self.join(row.rlnCtfImage).replace(":mrc", "")
-                ctfProfile = psdFn.replace('.ctf', '_avrot.txt')
-
-                if os.path.exists(ctfProfile) and ctfProfile.endswith('_avrot.txt'):
-                    with open(ctfProfile) as f:
-                        ctfPlot = [line.split() for line in f
-                                   if not line.startswith('#')]
-                else:
-                    ctfPlot = []
-
-                micData.update({
-                    'psdData': psdThumb.from_mrc(psdFn),
-                    'ctfDefocusU': round(row.rlnDefocusU / 10000., 2),
-                    'ctfDefocusV': round(row.rlnDefocusV / 10000., 2),
-                    'ctfDefocusAngle': round(row.rlnDefocusAngle, 2),
-                    'ctfAstigmatism': round(row.rlnCtfAstigmatism / 10000, 2),
-                    'ctfResolution': round(row.rlnCtfMaxResolution, 2),
-                    'ctfPlot': ctfPlot
-                })
-
-            return micData
+            if os.path.exists(ctfProfile) and ctfProfile.endswith('_avrot.txt'):
+                with open(ctfProfile) as f:
+                    ctfPlot = [line.split() for line in f
+                               if not line.startswith('#')]
+            else:
+                ctfPlot = []
+
+            micData.update({
+                'psdData': thumbnails.from_mrc(psdThumb, psdFn),
+                'ctfDefocusU': round(row.rlnDefocusU / 10000., 2),
+                'ctfDefocusV': round(row.rlnDefocusV / 10000., 2),
+                'ctfDefocusAngle': round(row.rlnDefocusAngle, 2),
+                'ctfAstigmatism': round(row.rlnCtfAstigmatism / 10000, 2),
+                'ctfResolution': round(row.rlnCtfMaxResolution, 2),
+                'ctfPlot': ctfPlot
+            })
+
+        return micData
 
     def get_micrograph_coordinates(self, pickStar, micId):
-        with StarFile(self.join(pickStar)) as sf:
-            for i, row in enumerate(sf.iterTable('coordinate_files')):
-                if i == micId - 1:
-                    return [(round(c.rlnCoordinateX), round(c.rlnCoordinateY))
-                            for c in self.coords_from_row(row)]
+        table = get_star_table(self.join(pickStar), 'coordinate_files')
+        if 0 < micId <= table.size():
+            t = self._coords_table(table[micId - 1])
+            if t.size() == 0:  # no picked particles, columns are not typed
+                return []
+            return list(zip(np.rint(t.column('rlnCoordinateX')).astype(int).tolist(),
+                            np.rint(t.column('rlnCoordinateY')).astype(int).tolist()))
         return []
 
     def load_coordinates_values(self, coordStar, index=False):
@@ -307,21 +346,10 @@ class RelionSessionData(SessionData):
             'default_color': 'averageFOM',
             'has_particles': True
         }
-        # TODO: Write this info in a star file to avoid recalculating all the time
-        pts = data_values['numberOfParticles']['data']
-        fom = data_values['averageFOM']['data']
-        indexes = []
-
-        with StarFile(coordStar) as sf:
-            for i, row in enumerate(sf.iterTable('coordinate_files')):
-                indexes.append(i + 1)
-                n = 0
-                fomSum = 0
-                for c in self.coords_from_row(row):
-                    n += 1
-                    fomSum += c.rlnAutopickFigureOfMerit
-                pts.append(n)
-                fom.append(fomSum / n)
+        coordsIndex = get_coordinates_index(self.path, coordStar)
+        data_values['numberOfParticles']['data'] = coordsIndex['particles'].tolist()
+        data_values['averageFOM']['data'] = coordsIndex['fom'].tolist()
+        indexes = list(range(1, len(coordsIndex['file']) + 1))
 
         if index:
             data_values.update({
@@ -367,20 +395,13 @@ class RelionSessionData(SessionData):
             'default_x': '',
             'has_ctf': True
         }
-        indexes = []
-        with StarFile(ctfStar) as sf:
-            ti = sf.getTableInfo('micrographs')
-            for k, v in possible_labels.items():
-                if ti.hasColumn(k):
-                    data_values[k] = v
-
-            for i, row in enumerate(sf.iterTable('micrographs')):
-                indexes.append(i + 1)
-                rowDict = row._asdict()
-                for k, v in data_values.items():
-                    if isinstance(v, dict):
-                        scale = v.get('scale', 1)
-                        v['data'].append(rowDict[k] * scale)
+        t = get_star_table(ctfStar, 'micrographs')
+        for k, v in possible_labels.items():
+            if t.hasColumn(k):
+                v['data'] = (t.column(k) * v.get('scale', 1)).tolist()
+                data_values[k] = v
+        indexes = list(range(1, t.size() + 1))
+
         if index:
             data_values.update({
                 'index': {'label': 'Index', 'data': indexes},
@@ -398,42 +419,23 @@ class RelionSessionData(SessionData):
         data = {}
         volume_data = kwargs.get('volume_data', 'info')
 
-        mrc = mrcfile.open(volPath, permissive=True)
-        zdim, ydim, xdim = mrc.data.shape
+        stats = volumes.get_volume_stats(volPath)
+        dimensions = stats['dimensions']
         data['path'] = volPath
-        data['dimensions'] = [xdim, ydim, zdim]
+        data['dimensions'] = dimensions
 
         if volume_data == "info":
             return data
 
         if "slices" in volume_data:
             axis = kwargs.get('axis', 'z')
-
             slice_dim = kwargs.get('slice_dim', 128)
-            volThumb = Thumbnail(max_size=(slice_dim, slice_dim),
-                                 output_format='base64',
-                                 min_max=(mrc.data.min(), mrc.data.max()))
-            if slice_number := kwargs.get('slice_number', None):
-                # Do not take slices from star/end since they are usually empty
-                n4 = np.round(xdim / 4)
-                idx = np.round(np.linspace(n4, xdim - n4, slice_number)).astype(int)
-                pass
-            else:
-                slice_number = min(xdim, slice_dim)
-                idx = np.round(np.linspace(0, xdim - 1, slice_number)).astype(int)
-
+            slice_number = kwargs.get('slice_number', None)
             slices = {}
-
-            if 'x' in axis:
-                slices['x'] = {int(i): volThumb.from_array(mrc.data[:, :, i])
-                               for i in idx}
-            if 'y' in axis:
-                slices['y'] = {int(i): volThumb.from_array(mrc.data[:, i, :])
-                               for i in idx}
-
-            if 'z' in axis:
-                slices['z'] = {int(i): volThumb.from_array(mrc.data[i, :, :])
-                               for i in idx}
+            for i, a in enumerate('xyz'):
+                if a in axis:
+                    idx = volumes.slice_indexes(dimensions[i], slice_number, slice_dim)
+                    slices[a] = volumes.get_volume_slices(volPath, a, idx, slice_dim)
 
             data.update({
                 'slices': slices,
@@ -441,15 +443,9 @@ class RelionSessionData(SessionData):
             })
 
         if 'array' in volume_data:
-            iMax = mrc.data.max()  # min(imean + 10 * isd, imageArray.max())
-            iMin = mrc.data.min()  # max(imean - 10 * isd, imageArray.min())
-            im255 = ((mrc.data - iMin) / (iMax - iMin) * 255).astype(np.uint8)
+            im255 = b''.join(volumes.iter_volume_uint8(volPath))
             data['array'] = base64.b64encode(im255).decode("utf-8")
 
-        #
-        # else:
-        #     raise Exception('Unknown volume_data value: %s' % volume_data)
-
         return data
 
     # ----------------------- UTILS ---------------------------
@@ -29,6 +29,7 @@ from emtools.metadata import StarFile, EPU, SqliteFile
 from emtools.image import Thumbnail
 
 from ..base import SessionRun, SessionData, hours
+from ..star_tables import get_star_table
 
 location = os.path.dirname(__file__)
 
@@ -169,13 +170,9 @@ class RelionRun(SessionRun):
                 }
 
             #mics = self.join('corrected_micrographs.star')
-            with StarFile(mics) as sf:
-                for row in sf.iterTable('micrographs'):
-                    print(row, type(row))
-
-                    for col in columns:
-                        d = row._asdict()
-                        data_values[col]['data'].append(d[col])
+            t = get_star_table(mics, 'micrographs')
+            for col in columns:
+                data_values[col]['data'] = t.column(col).tolist()
 
         #elif self.className == 'ctffind':
         elif micsCtf is not None:
@@ -333,7 +330,7 @@ class RelionRun(SessionRun):
         result = {
             'template': 'processing_volume_card.html',
             'data': self.project.get_volume_data(volumeFile,
-                                                 volume_data='slices array',
+                                                 volume_data='slices',
                                                  axis='zyx',
                                                  slice_number=32)
         }
@@ -17,15 +17,15 @@
 import os
 import datetime as dt
 from glob import glob
-from collections import defaultdict
 import json
 
 import mrcfile
-from emtools.utils import Path, Timer, Pretty
+from emtools.utils import Path, Pretty
 from emtools.metadata import StarFile, EPU, SqliteFile
 from emtools.image import Thumbnail
 
 from .base import SessionRun, SessionData, hours
+from . import scipion_coords, thumbnails
 from ..processing.processing_relion import RelionSessionData
 
 
@@ -304,7 +304,7 @@ class ScipionSessionData(SessionData):
                 psdThumb = Thumbnail.Psd()
                 micName = row['_micObj._micName']
                 micFn = self.join(row['_micObj._filename'])
-                micThumbBase64 = micThumb.from_mrc(micFn)
+                micThumbBase64 = thumbnails.from_mrc(micThumb, micFn)
                 psdFn = self.join(row['_psdFile']).replace(':mrc', '')
                 pixelSize = row['_micObj._samplingRate']
 
@@ -320,8 +320,7 @@ class ScipionSessionData(SessionData):
                 data = ScipionSessionData.ctf_from_row(row)
                 data.update({
                     'micThumbData': micThumbBase64,
-                    'psdData': psdThumb.from_mrc(psdFn),
-                    # TODO: Retrieving coordinates from multiple micrographs is very slow now
+                    'psdData': thumbnails.from_mrc(psdThumb, psdFn),
                     'coordinates': self.get_micrograph_coordinates(row['_micObj._micName']),
                     'micThumbPixelSize': pixelSize * micThumb.scale,
                     'pixelSize': pixelSize,
@@ -383,17 +382,9 @@ class ScipionSessionData(SessionData):
         return classes2d
 
     def get_micrograph_coordinates(self, micFn):
-        self.all_coords = getattr(self, 'all_coords', None)
-        if self.all_coords is None:
-            coords = defaultdict(lambda: [])
-            with Timer():
-                if coordSqlite := self.outputs.get('coordinates', None):
-                    with SqliteFile(coordSqlite) as sf:
-                        for row in sf.iterTable('Objects', classes='Classes'):
-                            coords[row['_micName']].append((row['_x'], row['_y']))
-            self.all_coords = coords
-
-        return self.all_coords[micFn]
+        if coordSqlite := self.outputs.get('coordinates', None):
+            return scipion_coords.get_micrograph_coordinates(coordSqlite, micFn)
+        return []
 
     def get_workflow(self):
         protList = []
@@ -0,0 +1,149 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. de la Rosa Trevin (delarosatrevin@gmail.com)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# **************************************************************************
+"""
+Per-micrograph lookup of coordinates from Scipion coordinates.sqlite files.
+
+Scipion sets do not have an index by micrograph name (and should not be
+modified), so coordinates are copied into a side database with an index
+on the micrograph name. The side database is stored in a writable cache
+folder (PROCESSING_CACHE_DIR, by default 'cache/processing' in the
+instance folder) and only the new rows are copied when the set grows.
+Results are also kept per micrograph in a LRU cache (COORDS_CACHE_ITEMS).
+"""
+
+import os
+import hashlib
+import sqlite3
+import threading
+
+from emhub.utils.cache import LRUCache
+from .base import app_config, cache_dir
+
+
+_coords = None
+_checked = {}  # source path -> (size, mtime, generation) of the last update
+_lock = threading.Lock()
+
+
+def _coords_cache():
+    global _coords
+    if _coords is None:
+        _coords = LRUCache(max_items=app_config().get('COORDS_CACHE_ITEMS', 256))
+    return _coords
+
+
+def _columns(con, db):
+    """ Return the Objects column names for micName, x and y. """
+    labels = {label: column for column, label in
+              con.execute(f"SELECT column_name, label_property FROM {db}.Classes")}
+    return labels['_micName'], labels['_x'], labels['_y']
+
+
+def _connect_source(coordSqlite):
+    return sqlite3.connect(f"file:{coordSqlite}?mode=ro", uri=True)
+
+
+def _update_index(indexFn, coordSqlite):
+    """ Copy new coordinates from the Scipion set into the index db.
+    Return the index generation, that changes if the set is rewritten. """
+    con = sqlite3.connect(f"file:{indexFn}", uri=True, timeout=60)
+    try:
+        con.execute("CREATE TABLE IF NOT EXISTS meta "
+                    "(key TEXT PRIMARY KEY, value)")
+        con.execute("CREATE TABLE IF NOT EXISTS coords "
+                    "(id INTEGER PRIMARY KEY, mic TEXT, x, y)")
+        con.execute("CREATE INDEX IF NOT EXISTS coords_mic ON coords (mic)")
+        con.commit()
+        con.execute("ATTACH DATABASE ? AS src",
+                    (f"file:{coordSqlite}?mode=ro",))
+        con.execute("BEGIN IMMEDIATE")  # Only one process updates the index
+        micCol, xCol, yCol = _columns(con, 'src')
+        meta = dict(con.execute("SELECT key, value FROM meta"))
+        generation = meta.get('generation', 0)
+        lastId, lastMic = con.execute("SELECT id, mic FROM coords "
+                                      "ORDER BY id DESC LIMIT 1").fetchone() or (0, None)
+        if lastId:
+            row = con.execute(f"SELECT {micCol} FROM src.Objects WHERE id = ?",
+                              (lastId,)).fetchone()
+            if row is None or row[0] != lastMic:  # The set was written again
+                con.execute("DELETE FROM coords")
+                lastId = 0
+                generation += 1
+
+        con.execute(f"INSERT INTO coords SELECT id, {micCol}, {xCol}, {yCol} "
+                    f"FROM src.Objects WHERE id > ?", (lastId,))
+        con.execute("INSERT OR REPLACE INTO meta VALUES ('generation', ?)",
+                    (generation,))
+        con.commit()
+        con.execute("DETACH DATABASE src")
+        return generation
+    finally:
+        con.close()
+
+
+def _index_file(coordSqlite):
+    """ Return the index db for this set (updated if the set changed)
+    and its generation, or None if the cache folder is not writable. """
+    st = os.stat(coordSqlite)
+    key = os.path.abspath(coordSqlite)
+    with _lock:
+        checked = _checked.get(key, None)
+
+    folder = cache_dir()
+    indexFn = os.path.join(folder, hashlib.sha1(key.encode()).hexdigest() + '.sqlite')
+
+    if checked and checked[:2] == (st.st_size, st.st_mtime_ns):
+        return indexFn, checked[2]
+
+    try:
+        os.makedirs(folder, exist_ok=True)
+        generation = _update_index(indexFn, coordSqlite)
+    except (OSError, sqlite3.OperationalError):
+        return None, None
+
+    with _lock:
+        _checked[key] = (st.st_size, st.st_mtime_ns, generation)
+    return indexFn, generation
+
+
+def get_micrograph_coordinates(coordSqlite, micName):
+    """ Return the list of (x, y) coordinates of this micrograph. """
+    indexFn, generation = _index_file(coordSqlite)
+    coords = _coords_cache()
+    key = (os.path.abspath(coordSqlite), os.path.getsize(coordSqlite),
+           generation, micName)
+
+    def _load():
+        if indexFn:
+            con = sqlite3.connect(indexFn)
+            query = "SELECT x, y FROM coords WHERE mic = ? ORDER BY id"
+        else:  # No index db, filter in the set without loading all rows
+            con = _connect_source(coordSqlite)
+            micCol, xCol, yCol = _columns(con, 'main')
+            query = (f"SELECT {xCol}, {yCol} FROM Objects "
+                     f"WHERE {micCol} = ? ORDER BY id")
+        try:
+            return con.execute(query, (micName,)).fetchall()
+        finally:
+            con.close()
+
+    return coords.get_or_create(key, _load)
+
+
+def clear_coords_cache():
+    _coords_cache().clear()
+    with _lock:
+        _checked.clear()
@@ -0,0 +1,295 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. de la Rosa Trevin (delarosatrevin@gmail.com)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# **************************************************************************
+"""
+Cache of parsed STAR tables shared by all processing readers.
+
+Tables are stored in columnar form (one NumPy array per column) and
+identified by the file path, size and modification time, so a modified
+file is read again. The cache is bounded by the memory used by the
+arrays (STAR_CACHE_SIZE in MB, 256 by default) with LRU eviction.
+
+Files written during on-the-fly processing (e.g. movies.star or
+micrographs_ctf.star) usually only grow, so when the header and the
+last parsed row of a table are unchanged, only the appended rows are
+parsed. Otherwise (e.g. the file was rewritten), the table is reloaded.
+"""
+
+import os
+import re
+import threading
+
+import numpy as np
+from emtools.metadata import StarFile
+from emtools.metadata.table import ColumnList, Column
+
+from emhub.utils.cache import LRUCache
+
+
+_DTYPES = {int: np.int64, float: np.float64}
+_SPLIT_RE = re.compile(r'"[^"]*"|[^"\s]+')
+
+
+def _str(s):
+    """ String value stripping quotes if present (as in emtools). """
+    return s[1:-1] if s.startswith('"') and s.endswith('"') else s
+
+
+def _guessType(strValue):
+    """ Type of the column (int, float or str) from one of its values. """
+    for t in [int, float]:
+        try:
+            t(strValue)
+            return t
+        except ValueError:
+            pass
+    return _str
+
+
+def _split(line):
+    """ Split a data line taking into account string literals. """
+    return _SPLIT_RE.findall(line) if '"' in line else line.split()
+
+
+def _read_rows(f, offset, ncols, last=b''):
+    """ Read the data lines of a table from the offset, until an empty
+    line, a new data block or the end of the file. A last line without
+    newline is only read if it has all the columns (the file can be
+    finished or the line still being written), and it is not included
+    in the returned offset, so it is read again if the file grows.
+    Return the lines, the offset after the last complete line, the bytes
+    of that line and if the last returned line is unterminated. """
+    f.seek(offset)
+    lines = []
+    pending = False
+    while raw := f.readline():
+        line = raw.strip()
+        if not line or line.startswith(b'data_'):
+            break
+        if not raw.endswith(b'\n'):
+            line = line.decode()
+            if len(_split(line)) == ncols:
+                lines.append(line)
+                pending = True
+            break
+        lines.append(line.decode())
+        offset += len(raw)
+        last = raw
+    return lines, offset, last, pending
+
+
+class StarTable:
+    """ Columnar (read-only) version of an emtools Table.
+    Rows are created on demand with the same Row class of the Table.
+    """
+    def __init__(self, columns, arrays, tail=None):
+        self._columns = ColumnList(columns)
+        self.Row = self._columns.createRowClass()
+        self._arrays = arrays
+        self._size = len(next(iter(arrays.values()))) if arrays else 0
+        # (head, end, last, pending) to read appended rows: the file bytes
+        # before the first row, the offset after the last complete row,
+        # the bytes of that row and if the last row is unterminated
+        self._tail = tail
+
+    @staticmethod
+    def from_table(table):
+        columns = list(table.getColumns())
+        arrays = {c.getName(): StarTable._array(table.getColumnValues(c.getName()),
+                                                c.getType())
+                  for c in columns}
+        return StarTable(columns, arrays)
+
+    @staticmethod
+    def _array(values, colType):
+        dtype = _DTYPES.get(colType, None)
+        return np.array(values, dtype=dtype) if dtype else np.array(values, dtype=str)
+
+    @staticmethod
+    def _columns_arrays(names, types, lines):
+        rows = [_split(line) for line in lines]
+        values = list(zip(*rows)) if rows else [[] for _ in names]
+        arrays = {n: StarTable._array([t(v) for v in vs], t)
+                  for n, t, vs in zip(names, types, values)}
+        return arrays
+
+    @staticmethod
+    def load(path, tableName):
+        """ Read the table from a STAR file, keeping the information
+        to read appended rows later. Tables without loop_ are read with
+        emtools StarFile. """
+        with open(path, 'rb') as f:
+            target = f'data_{tableName}'.encode()
+            while raw := f.readline():
+                if raw.strip() == target:
+                    break
+            else:
+                raise Exception(f"'data_{tableName}' block was not found")
+
+            names = []
+            loop = False
+            offset = f.tell()
+            while raw := f.readline():
+                line = raw.strip()
+                if line.startswith(b'_'):
+                    names.append(line.split()[0][1:].decode())
+                elif names:
+                    break
+                elif line.startswith(b'loop_'):
+                    loop = True
+                offset = f.tell()
+
+            if not loop:
+                with StarFile(path) as sf:
+                    return StarTable.from_table(sf.getTable(tableName))
+
+            lines, end, last, pending = _read_rows(f, offset, len(names))
+            types = ([_guessType(v) for v in _split(lines[0])] if lines
+                     else [_str] * len(names))
+            try:
+                arrays = StarTable._columns_arrays(names, types, lines)
+            except ValueError:
+                if not pending:
+                    raise
+                # The unterminated row is not complete yet
+                lines, pending = lines[:-1], False
+                types = ([_guessType(v) for v in _split(lines[0])] if lines
+                         else [_str] * len(names))
+                arrays = StarTable._columns_arrays(names, types, lines)
+            f.seek(0)
+            head = f.read(offset)
+
+        columns = [Column(n, t) for n, t in zip(names, types)]
+        return StarTable(columns, arrays, tail=(head, end, last, pending))
+
+    def update(self, path):
+        """ Return a new table with the rows appended to the file since
+        this table was read, or None if the table should be read again. """
+        if self._tail is None:
+            return None
+        head, end, last, pending = self._tail
+        columns = list(self._columns.getColumns())
+        with open(path, 'rb') as f:
+            if f.read(len(head)) != head:
+                return None
+            f.seek(end - len(last))
+            if f.read(len(last)) != last:
+                return None
+            lines, newEnd, newLast, newPending = _read_rows(f, end, len(columns),
+                                                            last)
+
+        # The unterminated row is read again from the file
+        size = self._size - 1 if pending else self._size
+        arrays = ({n: a[:size] for n, a in self._arrays.items()} if pending
+                  else self._arrays)
+        if not lines:
+            return StarTable(columns, arrays, tail=(head, end, last, False))
+
+        names = [c.getName() for c in columns]
+        if size:
+            types = [c.getType() for c in columns]
+        else:  # types were not known without rows
+            types = [_guessType(v) for v in _split(lines[0])]
+            columns = [Column(n, t) for n, t in zip(names, types)]
+        try:
+            new = self._columns_arrays(names, types, lines)
+        except ValueError:  # types guessed from the first row do not match
+            return None
+        arrays = ({n: np.concatenate([arrays[n], new[n]]) for n in names}
+                  if size else new)
+        return StarTable(columns, arrays,
+                         tail=(head, newEnd, newLast, newPending))
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in self._arrays.values())
+
+    def size(self):
+        return self._size
+
+    def __len__(self):
+        return self._size
+
+    def hasColumn(self, colName):
+        return self._columns.hasColumn(colName)
+
+    def getColumnNames(self):
+        return self._columns.getColumnNames()
+
+    def column(self, colName):
+        """ Return the NumPy array with the values of this column. """
+        return self._arrays[colName]
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._size
+        if not 0 <= index < self._size:
+            raise IndexError('StarTable index out of range')
+        return self.Row(*[a[index].item() for a in self._arrays.values()])
+
+    def __iter__(self):
+        for values in zip(*[a.tolist() for a in self._arrays.values()]):
+            yield self.Row(*values)
+
+
+_tables = None
+_versions = {}  # (path, tableName) -> key of the last version in the cache
+_lock = threading.Lock()
+
+
+def _tables_cache():
+    global _tables
+    if _tables is None:
+        import flask
+        config = flask.current_app.config if flask.has_app_context() else {}
+        _tables = LRUCache(
+            max_items=None,
+            max_size=config.get('STAR_CACHE_SIZE', 256) * 1024 * 1024,
+            sizeof=lambda t: t.nbytes)
+    return _tables
+
+
+def file_key(path):
+    """ Return (path, size, mtime) used to identify a file version. """
+    st = os.stat(path)
+    return os.path.abspath(path), st.st_size, st.st_mtime_ns
+
+
+def get_star_table(path, tableName):
+    """ Return the StarTable for this table name in the STAR file.
+    The file is only read if it is not in the cache and only the new
+    rows are parsed if a previous version of the table is cached. """
+    key = file_key(path) + (tableName,)
+    tables = _tables_cache()
+    table = tables.get(key)
+
+    if table is None:
+        with _lock:
+            prevKey = _versions.get((key[0], tableName), None)
+        prev = tables.pop(prevKey) if prevKey else None
+        table = prev.update(path) if prev is not None else None
+        if table is None:
+            table = StarTable.load(path, tableName)
+        tables.put(key, table)
+        with _lock:
+            _versions[(key[0], tableName)] = key
+
+    return table
+
+
+def clear_star_cache():
+    _tables_cache().clear()
+    with _lock:
+        _versions.clear()
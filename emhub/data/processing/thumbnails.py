@@ -0,0 +1,211 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. de la Rosa Trevin (delarosatrevin@gmail.com)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# **************************************************************************
+"""
+On-disk cache of micrograph and PSD thumbnails.
+
+Thumbnails are stored by a hash of the source file (path, size and
+modification time) and the Thumbnail parameters, so a modified image or
+different settings produce a new entry. The cache folder is
+THUMBNAILS_CACHE_DIR (by default 'thumbnails' in PROCESSING_CACHE_DIR)
+and its size is bounded by THUMBNAILS_CACHE_SIZE (in MB, 1024 by default)
+removing the least recently used files.
+
+If THUMBNAILS_PREGENERATE is True, thumbnails of new micrographs are
+created in a background thread while the session is being processed.
+"""
+
+import os
+import json
+import hashlib
+import threading
+import traceback
+
+from emhub.utils.cache import LRUCache
+from emhub.utils.image import read_mrc_reduced
+from .base import app_config, cache_dir
+
+EXTENSION = '.thumb'
+
+
+class ThumbnailCache:
+    """ Folder with thumbnails files (first line is the scale and
+    the second one the encoded image) with LRU eviction based on the
+    files modification time, updated on every hit. """
+    def __init__(self, folder, max_size):
+        self.folder = folder
+        self.max_size = max_size
+        self._size = None  # Total size, computed on first write
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(path, thumb):
+        st = os.stat(path)
+        params = {k: v for k, v in vars(thumb).items() if k != 'scale'}
+        data = json.dumps([os.path.abspath(path), st.st_size, st.st_mtime_ns,
+                           params], sort_keys=True, default=str)
+        return hashlib.sha1(data.encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.folder, key[:2], key + EXTENSION)
+
+    def exists(self, key):
+        return os.path.exists(self._path(key))
+
+    def get(self, key):
+        """ Return (scale, data) or None if not in the cache. """
+        fn = self._path(key)
+        try:
+            with open(fn) as f:
+                scale, data = f.read().split('\n', 1)
+            os.utime(fn)  # Mark as recently used
+            return float(scale), data
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key, scale, data):
+        fn = self._path(key)
+        tmpFn = f'{fn}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            os.makedirs(os.path.dirname(fn), exist_ok=True)
+            with open(tmpFn, 'w') as f:
+                f.write(f'{scale!r}\n{data}')
+            size = os.path.getsize(tmpFn)
+            os.replace(tmpFn, fn)
+        except OSError:  # Not writable cache, just do not store it
+            if os.path.exists(tmpFn):
+                os.remove(tmpFn)
+            return
+
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan()[1]
+            else:
+                self._size += size
+            if self._size > self.max_size:
+                self._evict()
+
+    def _scan(self):
+        """ Return the list of (mtime, size, path) of all files and the total size. """
+        files = []
+        for root, _, names in os.walk(self.folder):
+            for name in names:
+                if name.endswith(EXTENSION):
+                    fn = os.path.join(root, name)
+                    try:
+                        st = os.stat(fn)
+                        files.append((st.st_mtime_ns, st.st_size, fn))
+                    except OSError:
+                        pass
+        return files, sum(f[1] for f in files)
+
+    def _evict(self):
+        """ Remove least recently used files until the cache size is
+        under 90% of the limit (to avoid scanning on every write). """
+        files, self._size = self._scan()
+        for _, size, fn in sorted(files):
+            if self._size <= 0.9 * self.max_size:
+                break
+            try:
+                os.remove(fn)
+                self._size -= size
+            except OSError:
+                pass
+
+    def clear(self):
+        with self._lock:
+            for _, _, fn in self._scan()[0]:
+                os.remove(fn)
+            self._size = 0
+
+
+_caches = {}
+_cachesLock = threading.Lock()
+
+
+def get_thumbnails_cache():
+    config = app_config()
+    folder = config.get('THUMBNAILS_CACHE_DIR', None) or cache_dir('thumbnails')
+    with _cachesLock:
+        if folder not in _caches:
+            maxSize = config.get('THUMBNAILS_CACHE_SIZE', 1024) * 1024 * 1024
+            _caches[folder] = ThumbnailCache(folder, maxSize)
+        return _caches[folder]
+
+
+def from_mrc(thumb, path):
+    """ Same as thumb.from_mrc(path) (also setting thumb.scale), but reading
+    a reduced image and storing the thumbnail in the cache, or reading
+    it from there if it was already created. """
+    cache = get_thumbnails_cache()
+    try:
+        key = ThumbnailCache.key(path, thumb)
+    except OSError:
+        return thumb.from_mrc(path)  # Let Thumbnail handle the error
+
+    if cached := cache.get(key):
+        thumb.scale, data = cached
+        return data
+
+    scale, data = _create(thumb, path)
+    cache.put(key, scale, data)
+    return data
+
+
+_pregenerating = set()
+_pregenerated = LRUCache(max_items=256)  # session path -> micrographs done
+
+
+def pregenerate(sdata, micThumb, psdThumb, count=None):
+    """ Create in a background thread the thumbnails of the session
+    micrographs (newest first) that are not in the cache. If the number
+    of micrographs (count) is given, nothing is done when it is the same
+    as in the last completed run. """
+    key = sdata.path
+    cache = get_thumbnails_cache()  # app config is needed, not in the thread
+    with _cachesLock:
+        if key in _pregenerating or (count is not None and
+                                     _pregenerated.get(key) == count):
+            return
+        _pregenerating.add(key)
+
+    def _run():
+        try:
+            images = list(sdata.get_micrograph_images())
+            for micFn, psdFn in reversed(images):
+                for thumb, fn in [(micThumb, micFn), (psdThumb, psdFn)]:
+                    if fn and os.path.exists(fn):
+                        k = ThumbnailCache.key(fn, thumb)
+                        if not cache.exists(k):
+                            cache.put(k, *_create(thumb, fn))
+            _pregenerated.put(key, len(images))
+        except Exception:
+            traceback.print_exc()
+        finally:
+            with _cachesLock:
+                _pregenerating.discard(key)
+
+    threading.Thread(target=_run, daemon=True,
+                     name='emhub-thumbnails').start()
+
+
+def _create(thumb, fn):
+    """ Create the thumbnail from a reduced version of the image
+    (see read_mrc_reduced), so large micrographs are not completely
+    loaded in memory. The scale is relative to the original image. """
+    reduced, factor = read_mrc_reduced(fn, thumb.max_size)
+    data = thumb.from_array(reduced)
+    thumb.scale *= factor
+    return thumb.scale, data
@@ -0,0 +1,134 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. de la Rosa Trevin (delarosatrevin@gmail.com)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# **************************************************************************
+"""
+Volume slices and data read on demand from memory-mapped MRC files.
+
+Statistics (dimensions, min and max) are computed once per volume
+version (path, size and modification time) reading it by slabs, and
+rendered slices are kept in a LRU cache bounded by VOLUME_SLICES_CACHE_SIZE
+(in MB, 64 by default).
+"""
+
+import numpy as np
+import mrcfile
+from emtools.image import Thumbnail
+
+from emhub.utils.cache import LRUCache
+from .base import app_config
+from .star_tables import file_key
+
+AXES = {'z': 0, 'y': 1, 'x': 2}
+SLAB_BYTES = 16 * 1024 * 1024
+
+_stats = LRUCache(max_items=256)
+_slices = None
+
+
+def _slices_cache():
+    global _slices
+    if _slices is None:
+        _slices = LRUCache(
+            max_items=None,
+            max_size=app_config().get('VOLUME_SLICES_CACHE_SIZE', 64) * 1024 * 1024,
+            sizeof=len)
+    return _slices
+
+
+def _open(path):
+    return mrcfile.mmap(path, mode='r', permissive=True)
+
+
+def _slabs(data):
+    """ Iterate over (start, end) ranges of z slices of about SLAB_BYTES. """
+    zdim = data.shape[0]
+    n = max(1, SLAB_BYTES // max(1, data[0].nbytes))
+    for z in range(0, zdim, n):
+        yield z, min(zdim, z + n)
+
+
+def get_volume_stats(path):
+    """ Return a dict with the volume 'dimensions' (x, y, z), 'min' and 'max'. """
+    def _compute():
+        with _open(path) as mrc:
+            data = mrc.data
+            zdim, ydim, xdim = data.shape
+            iMin = min(data[z1:z2].min() for z1, z2 in _slabs(data))
+            iMax = max(data[z1:z2].max() for z1, z2 in _slabs(data))
+        return {'dimensions': [xdim, ydim, zdim], 'min': iMin, 'max': iMax}
+
+    return _stats.get_or_create(file_key(path), _compute)
+
+
+def _min_max(stats):
+    """ Range of values used to convert to uint8. For constant volumes
+    the range is extended, so all values are 0 (avoiding division by zero). """
+    iMin, iMax = stats['min'], stats['max']
+    return iMin, (iMax if iMax > iMin else iMin + 1)
+
+
+def slice_indexes(dim, slice_number=None, slice_dim=128):
+    """ Indexes of the slices to show along an axis of size dim.
+    If slice_number is given, slices from start/end are not included
+    since they are usually empty. """
+    if slice_number:
+        n4 = np.round(dim / 4)
+        return np.round(np.linspace(n4, dim - n4, slice_number)).astype(int)
+    slice_number = min(dim, slice_dim)
+    return np.round(np.linspace(0, dim - 1, slice_number)).astype(int)
+
+
+def get_volume_slices(path, axis, indexes, slice_dim=128):
+    """ Return a dict {index: base64 PNG} with the slices of the volume
+    along the given axis ('x', 'y' or 'z'). """
+    stats = get_volume_stats(path)
+    key = file_key(path)
+    cache = _slices_cache()
+    result = {}
+    missing = []
+    for i in indexes:
+        i = int(i)
+        data = cache.get((key, axis, i, slice_dim))
+        if data is None:
+            missing.append(i)
+        else:
+            result[i] = data
+
+    if missing:
+        thumb = Thumbnail(max_size=(slice_dim, slice_dim), output_format='base64',
+                          min_max=_min_max(stats))
+        a = AXES[axis]
+        with _open(path) as mrc:
+            for i in missing:
+                data = thumb.from_array(np.take(mrc.data, i, axis=a))
+                cache.put((key, axis, i, slice_dim), data)
+                result[i] = data
+
+    return {int(i): result[int(i)] for i in indexes}
+
+
+def iter_volume_uint8(path):
+    """ Iterate over the volume data (z, y, x order) converted to uint8
+    using the volume min and max, by slabs of z slices. """
+    iMin, iMax = _min_max(get_volume_stats(path))
+    with _open(path) as mrc:
+        data = mrc.data
+        for z1, z2 in _slabs(data):
+            yield ((data[z1:z2] - iMin) / (iMax - iMin) * 255).astype(np.uint8).tobytes()
+
+
+def clear_volumes_cache():
+    _stats.clear()
+    _slices_cache().clear()
@@ -0,0 +1,205 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *
+# * [1] SciLifeLab, Stockholm University
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'delarosatrevin@scilifelab.se'
+# *
+# **************************************************************************
+
+import re
+import logging
+import contextlib
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LIST_RE = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_SPACES_RE = re.compile(r"\s+")
+
+
+def fingerprint(statement):
+    """ Normalize an SQL statement, replacing literal values by ?,
+    so similar queries with different values are grouped together.
+    """
+    fp = _STRING_RE.sub('?', statement)
+    fp = _NUMBER_RE.sub('?', fp)
+    fp = _IN_LIST_RE.sub('(...)', fp)
+    return _SPACES_RE.sub(' ', fp).strip()
+
+
+def query_source():
+    """ Return the content_id or API endpoint that originated the query
+    in the current Flask request, or empty string if not in a request.
+    """
+    try:
+        import flask
+        if not flask.has_request_context():
+            return ''
+        request = flask.request
+        if content_id := request.values.get('content_id', None):
+            # Only registered content ids, to keep the number of sources bounded
+            dc = getattr(flask.current_app, 'dc', None)
+            if dc is not None:
+                content_id = dc.content_label(content_id)
+            return f'content:{content_id}'
+        return f'endpoint:{request.endpoint}'
+    except Exception:
+        return ''
+
+
+class QueryStats:
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.slow = 0
+        self.sources = {}
+        self.last_slow = None
+
+    @property
+    def avg(self):
+        return self.total / self.count if self.count else 0
+
+    def copy(self):
+        stats = QueryStats(self.fingerprint)
+        stats.count = self.count
+        stats.total = self.total
+        stats.max = self.max
+        stats.slow = self.slow
+        stats.sources = dict(self.sources)
+        stats.last_slow = dict(self.last_slow) if self.last_slow else None
+        return stats
+
+
+class QueryLog:
+    """ Keep statistics of executed SQL statements grouped by fingerprint,
+    and log the ones slower than a threshold (in seconds) with parameters.
+    It should be registered as a query listener in the DbManager.
+    """
+    SORT_KEYS = ('total', 'max', 'count', 'avg')
+
+    def __init__(self, threshold=0.5, max_fingerprints=1000):
+        self.threshold = threshold
+        self.max_fingerprints = max_fingerprints
+        self._stats = {}
+        self._fingerprints = {}  # cache statement -> fingerprint
+        self._lock = threading.Lock()
+
+    def _fingerprint(self, statement):
+        fp = self._fingerprints.get(statement, None)
+        if fp is None:
+            fp = fingerprint(statement)
+            if len(self._fingerprints) < 10 * self.max_fingerprints:
+                self._fingerprints[statement] = fp
+        return fp
+
+    def record(self, statement, parameters, elapsed):
+        fp = self._fingerprint(statement)
+        source = query_source()
+
+        with self._lock:
+            stats = self._stats.get(fp, None)
+            if stats is None:
+                if len(self._stats) >= self.max_fingerprints:
+                    return
+                stats = self._stats[fp] = QueryStats(fp)
+            stats.count += 1
+            stats.total += elapsed
+            stats.max = max(stats.max, elapsed)
+            stats.sources[source] = stats.sources.get(source, 0) + 1
+
+            slow = elapsed >= self.threshold
+            if slow:
+                stats.slow += 1
+                stats.last_slow = {'statement': statement,
+                                   'parameters': str(parameters),
+                                   'elapsed': elapsed,
+                                   'source': source}
+        if slow:
+            logger.warning("Slow query (%0.3f s) from '%s': %s, parameters: %s",
+                           elapsed, source, statement, parameters)
+
+    def top(self, n=50, key='total'):
+        """ Return the top n fingerprints sorted by the given key,
+        that can be: total, max, count or avg. Returned values are copies,
+        so they are not modified by queries recorded later. """
+        if key not in self.SORT_KEYS:
+            raise Exception("Invalid sort key '%s', expected one of: %s"
+                            % (key, ', '.join(self.SORT_KEYS)))
+        with self._lock:
+            stats = [s.copy() for s in self._stats.values()]
+        return sorted(stats, key=lambda s: getattr(s, key), reverse=True)[:n]
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+
+class RepeatedQueryError(Exception):
+    pass
+
+
+class RepeatedQueryDetector:
+    """ Detect N+1 query patterns: count the SELECT statements executed
+    while computing some content (grouped by fingerprint) and warn, or
+    raise RepeatedQueryError if fail=True, when the same fingerprint is
+    repeated more than threshold times.
+    It should be registered as a query listener in the DbManager.
+    """
+    def __init__(self, threshold=50, fail=False):
+        self.threshold = threshold
+        self.fail = fail
+        self._local = threading.local()
+
+    def record(self, statement, parameters, elapsed):
+        counts = getattr(self._local, 'counts', None)
+        if counts is not None and statement.lstrip()[:6].upper() == 'SELECT':
+            fp = fingerprint(statement)
+            counts[fp] = counts.get(fp, 0) + 1
+
+    def repeated(self, counts):
+        return {fp: n for fp, n in counts.items() if n > self.threshold}
+
+    @contextlib.contextmanager
+    def check(self, name):
+        """ Count queries executed inside this context. Nested checks
+        (e.g. content functions calling other content) are counted
+        by the outer one. """
+        if getattr(self._local, 'counts', None) is not None:
+            yield
+            return
+
+        self._local.counts = counts = {}
+        try:
+            yield
+        finally:
+            self._local.counts = None
+
+        if repeated := self.repeated(counts):
+            msg = f"Repeated queries (N+1) in '{name}':\n"
+            msg += '\n'.join(f"  {n} times: {fp}" for fp, n in repeated.items())
+            if self.fail:
+                raise RepeatedQueryError(msg)
+            logger.warning(msg)
@@ -0,0 +1,109 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *
+# * [1] SciLifeLab, Stockholm University
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'delarosatrevin@scilifelab.se'
+# *
+# **************************************************************************
+
+import threading
+import contextlib
+import traceback
+
+
+class TaskWaiter:
+    """ Shared Redis reader that multiplexes all workers waiting for tasks.
+
+    Instead of each request doing a blocking XREADGROUP (holding a Redis
+    connection for up to a minute), waiting requests register here for
+    their stream and wait on an Event. A single background thread does a
+    blocking XREAD on all registered streams and wakes up the waiters of
+    streams that got new entries.
+    """
+    def __init__(self, redis, block=1000):
+        self.r = redis
+        self.block = block  # ms, to check for new registered streams
+        self._streams = {}  # stream -> [last_id, set of events]
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    @property
+    def waiting(self):
+        """ Number of requests waiting for tasks. """
+        with self._lock:
+            return sum(len(w[1]) for w in self._streams.values())
+
+    def _last_id(self, stream):
+        last = self.r.xrevrange(stream, count=1)
+        return last[0][0] if last else '0-0'
+
+    @contextlib.contextmanager
+    def wait_for(self, stream):
+        """ Register for new entries in the stream. The returned Event
+        will be set when new entries are added after registration. """
+        event = threading.Event()
+        with self._lock:
+            if stream not in self._streams:
+                self._streams[stream] = [self._last_id(stream), set()]
+            self._streams[stream][1].add(event)
+            self._start()
+        self._wakeup.set()
+        try:
+            yield event
+        finally:
+            with self._lock:
+                waiters = self._streams.get(stream, None)
+                if waiters:
+                    waiters[1].discard(event)
+                    if not waiters[1]:
+                        del self._streams[stream]
+
+    def _start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, daemon=True,
+                                            name='emhub-task-waiter')
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                streams = {s: w[0] for s, w in self._streams.items()}
+
+            if not streams:
+                self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+
+            try:
+                results = self.r.xread(streams, block=self.block)
+            except Exception:
+                traceback.print_exc()
+                self._wakeup.wait(self.block / 1000)
+                continue
+
+            with self._lock:
+                for stream, entries in results or []:
+                    waiters = self._streams.get(stream, None)
+                    if waiters and entries:
+                        waiters[0] = entries[-1][0]
+                        for event in waiters[1]:
+                            event.set()
@@ -0,0 +1,212 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *
+# * [1] SciLifeLab, Stockholm University
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'delarosatrevin@scilifelab.se'
+# *
+# **************************************************************************
+"""
+Run expensive reports in background threads.
+
+Each job renders the report content in its own request, created from
+the url of the request that submitted it, so it uses a separate DB
+session (sessions are scoped per thread) and does not block the web
+worker. Results are cached by (report, params, user,
+data-version) so opening again the same report (without changes in the
+database) is instant.
+"""
+
+import time
+import uuid
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import flask
+import flask_login
+from werkzeug.test import EnvironBuilder
+
+from emhub.utils.cache import LRUCache
+
+
+class ReportJob:
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, content_id, params, user_id, key, base_url=None):
+        self.id = uuid.uuid4().hex
+        self.content_id = content_id
+        self.params = params
+        self.user_id = user_id
+        self.key = key
+        self.base_url = base_url
+        self.status = self.PENDING
+        self.progress = 0.0
+        self.message = ''
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.cached = False
+        self._event = threading.Event()
+
+    @property
+    def is_finished(self):
+        return self.status in [self.DONE, self.FAILED]
+
+    def update(self, progress=None, message=None):
+        if progress is not None:
+            self.progress = max(0.0, min(1.0, float(progress)))
+        if message is not None:
+            self.message = message
+        self._event.set()
+
+    def wait_change(self, timeout):
+        """ Wait until the job is updated or the timeout expires. """
+        self._event.wait(timeout)
+        self._event.clear()
+
+    def json(self, result=False):
+        elapsed = None
+        if self.started:
+            elapsed = (self.finished or time.time()) - self.started
+        job = {
+            'id': self.id,
+            'content_id': self.content_id,
+            'status': self.status,
+            'progress': self.progress,
+            'message': self.message,
+            'error': self.error,
+            'cached': self.cached,
+            'elapsed': elapsed
+        }
+        if result and self.status == self.DONE:
+            job['result'] = self.result
+        return job
+
+
+class ReportJobManager:
+    """ Keep track of report jobs submitted by users.
+
+    The following variables in config.py can be used:
+        REPORT_JOBS_WORKERS: number of threads used to compute reports (2)
+        REPORT_JOBS_CACHE: number of report results kept in memory (32)
+    """
+    REPORTS = ['report_microscopes_usage',
+               'report_sessions_distribution',
+               'report_projects_overview',
+               'reports_invoices']
+
+    def __init__(self, app):
+        self.app = app
+        workers = app.config.get('REPORT_JOBS_WORKERS', 2)
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix='emhub-report')
+        self._jobs = LRUCache(max_items=256)
+        self._active = {}  # key -> job, for jobs not yet finished
+        self._results = LRUCache(max_items=app.config.get('REPORT_JOBS_CACHE', 32))
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _job_key(self, content_id, params, user_id):
+        items = tuple(sorted((k, str(v)) for k, v in params.items()))
+        return content_id, items, user_id, self.app.dm.data_version()
+
+    def submit(self, content_id, params, user):
+        """ Submit a new report job, or return an existing one if the same
+        report is being computed or its result is already cached.
+        """
+        if content_id not in self.REPORTS:
+            raise Exception(f"Invalid report '{content_id}' for background jobs.")
+
+        params = {k: v for k, v in params.items() if k != 'content_id'}
+        key = self._job_key(content_id, params, user.id)
+        # Urls in the rendered report are relative to the submitting request
+        base_url = flask.request.url_root if flask.has_request_context() else None
+
+        with self._lock:
+            if key in self._active:
+                return self._active[key]
+
+            job = ReportJob(content_id, params, user.id, key, base_url=base_url)
+            self._jobs.put(job.id, job)
+            result = self._results.get(key)
+
+            if result is not None:
+                job.result = result
+                job.cached = True
+                job.status = ReportJob.DONE
+                job.update(progress=1.0)
+            else:
+                self._active[key] = job
+                self._executor.submit(self._run, job)
+
+        return job
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def progress(self, progress=None, message=None):
+        """ Report progress from the running job in the current thread.
+        Nothing is done if the code is not running inside a job.
+        """
+        job = getattr(self._local, 'job', None)
+        if job is not None:
+            job.update(progress, message)
+
+    def _run(self, job):
+        app = self.app
+        job.status = ReportJob.RUNNING
+        job.started = time.time()
+        job.update(message='Started')
+        self._local.job = job
+
+        try:
+            # Templates need a request (e.g. for url_for or request.args),
+            # so the job renders the content in a new request to the same
+            # url root of the submitting one. The job user is logged in only
+            # for this request: login_user sets the current_user of the
+            # request, and its session is not saved anywhere.
+            environ = EnvironBuilder(
+                path='/get_content', base_url=job.base_url,
+                query_string=dict(job.params, content_id=job.content_id)
+            ).get_environ()
+            with app.request_context(environ):
+                user = app.dm.get_user_by(id=job.user_id)
+                flask_login.login_user(user)
+                job.result = app.render_content(dict(job.params,
+                                                     content_id=job.content_id),
+                                                raiseError=True)
+            self._results.put(job.key, job.result)
+            job.status = ReportJob.DONE
+            job.update(progress=1.0, message='Done')
+        except Exception as e:
+            job.error = str(e)
+            job.status = ReportJob.FAILED
+            job.update(message=traceback.format_exc())
+        finally:
+            job.finished = time.time()
+            self._local.job = None
+            with self._lock:
+                self._active.pop(job.key, None)
@@ -0,0 +1,297 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *
+# * [1] SciLifeLab, Stockholm University
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'delarosatrevin@scilifelab.se'
+# *
+# **************************************************************************
+"""
+Columnar snapshot of bookings to compute report aggregates with NumPy,
+without creating Booking objects and evaluating their properties.
+"""
+
+import datetime as dt
+import numpy as np
+
+
+EPOCH = dt.datetime(1970, 1, 1, tzinfo=dt.timezone.utc)
+ONE_US = dt.timedelta(microseconds=1)
+US_PER_DAY = 86400 * 1000000
+
+
+def _us(d):
+    """ Exact number of microseconds since epoch. """
+    return (d - EPOCH) // ONE_US
+
+
+def _extra_cost(extra):
+    """ Sum of extra costs (same as in Booking.total_cost). """
+    cost = 0
+    for _, _, c in (extra or {}).get('costs', []):
+        try:
+            cost += int(c)
+        except:
+            pass
+    return cost
+
+
+class BookingList:
+    """ Sequence of bookings from a snapshot, the Booking objects are only
+    loaded from the database when iterated. """
+    def __init__(self, snapshot, indexes):
+        self._snapshot = snapshot
+        self.ids = snapshot.id[indexes].tolist()
+        self._items = None
+
+    def _load(self):
+        if self._items is None:
+            self._items = self._snapshot.load_bookings(self.ids)
+        return self._items
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __bool__(self):
+        return bool(self.ids)
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __getitem__(self, item):
+        return self._load()[item]
+
+
+class BookingSnapshot:
+    """ Load bookings in a date range into NumPy arrays (one per column).
+
+    Ids of related objects are 0 when not set. The following arrays are
+    available (all of the same length):
+        id, resource_id, owner_id, operator_id, application_id, project_id,
+        type (index in Booking.TYPES), pi_id (owner's PI),
+        project_pi_id (PI of the project's user), daily_cost, extra_cost,
+        days, hours, end_ts (end timestamp in seconds)
+    """
+    COLUMNS = ['start', 'end', 'id', 'type', 'resource_id', 'owner_id',
+               'operator_id', 'application_id', 'project_id', 'extra']
+
+    def __init__(self, dm, start, end):
+        self.dm = dm
+        self.TYPES = list(dm.Booking.TYPES)
+        rows = dm.get_bookings_range_rows(start, end, self.COLUMNS)
+        n = len(rows)
+
+        def _array(values, dtype=np.int64):
+            return np.fromiter(values, dtype=dtype, count=n)
+
+        types = {t: i for i, t in enumerate(self.TYPES)}
+        self.id = _array(r[2] for r in rows)
+        self.type = _array((types.get(r[3], -1) for r in rows), np.int8)
+        self.resource_id = _array(r[4] or 0 for r in rows)
+        self.owner_id = _array(r[5] or 0 for r in rows)
+        self.operator_id = _array(r[6] or 0 for r in rows)
+        self.application_id = _array(r[7] or 0 for r in rows)
+        self.project_id = _array(r[8] or 0 for r in rows)
+        self.extra_cost = _array(_extra_cost(r[9]) for r in rows)
+        self.end_ts = _array((r[1].timestamp() for r in rows), np.float64)
+
+        start_us = _array(_us(r[0]) for r in rows)
+        end_us = _array(_us(r[1]) for r in rows)
+        # Same as Booking.days and Booking.hours properties
+        self.days = end_us // US_PER_DAY - start_us // US_PER_DAY + 1
+        seconds = (end_us - start_us) // 1000000
+        self.hours = -(-seconds // 3600)
+
+        self._load_users()
+        self._load_resources()
+        self._load_projects()
+        self._sizes = None
+        self._bookings = {}
+
+    def __len__(self):
+        return len(self.id)
+
+    def _lookup(self, mapping, keys, dtype=np.int64):
+        """ Map an array of ids to values using a lookup table. """
+        size = max(max(mapping, default=0), int(keys.max(initial=0))) + 1
+        table = np.zeros(size, dtype=dtype)
+        for k, v in mapping.items():
+            table[k] = v
+        return table[keys]
+
+    def _load_users(self):
+        self.users = {}
+        user_pi = {}
+        for uid, name, email, roles, pi_id in self.dm.get_rows(
+                self.dm.User, ['id', 'name', 'email', 'roles', 'pi_id']):
+            self.users[uid] = {'name': name, 'email': email}
+            user_pi[uid] = uid if 'pi' in (roles or []) else (pi_id or 0)
+        self._user_pi = user_pi
+        self.pi_id = self._lookup(user_pi, self.owner_id)
+
+    def _load_resources(self):
+        costs = {rid: (extra or {}).get('daily_cost', 0)
+                 for rid, extra in self.dm.get_rows(self.dm.Resource,
+                                                    ['id', 'extra'])}
+        dtype = np.array(list(costs.values()) or [0]).dtype
+        self.daily_cost = self._lookup(costs, self.resource_id, dtype)
+
+    def _load_projects(self):
+        project_pi = {pid: self._user_pi.get(uid, 0)
+                      for pid, uid in self.dm.get_rows(self.dm.Project,
+                                                       ['id', 'user_id'])}
+        self.project_pi_id = self._lookup(project_pi, self.project_id)
+
+    def type_in(self, *types):
+        return np.isin(self.type, [self.TYPES.index(t) for t in types])
+
+    def units(self, hours=24):
+        """ Number of 'invoiceable units' (see Booking.units). """
+        return -(-self.hours // hours)
+
+    @property
+    def total_cost(self):
+        return self.days * self.daily_cost + self.extra_cost
+
+    @property
+    def total_size(self):
+        """ Data size of the sessions of each booking (loaded on demand). """
+        if self._sizes is None:
+            sizes = {}
+            for bid, extra in self.dm.get_rows(self.dm.Session,
+                                               ['booking_id', 'extra']):
+                if bid:
+                    files = (extra or {}).get('raw', {}).get('files', {})
+                    sizes[bid] = sizes.get(bid, 0) + sum(f['size'] for f in files.values())
+            self._sizes = self._lookup(sizes, self.id)
+        return self._sizes
+
+    def user_names(self, ids):
+        return np.array([self.users.get(uid, {}).get('name', '') for uid in ids.tolist()],
+                        dtype=object)
+
+    def bookings(self, indexes):
+        return BookingList(self, indexes)
+
+    def load_bookings(self, ids):
+        """ Load Booking objects for the given ids (keeping the order). """
+        missing = [i for i in ids if i not in self._bookings]
+        for i in range(0, len(missing), 500):
+            chunk = ','.join(str(bid) for bid in missing[i:i + 500])
+            for b in self.dm.get_bookings(condition=f"id IN ({chunk})"):
+                self._bookings[b.id] = b
+        return [self._bookings[bid] for bid in ids]
+
+
+class SessionSnapshot:
+    """ Load the metrics of all sessions into NumPy arrays.
+
+    The following arrays are available (all of the same length):
+        id, resource_id, booking_id (0 if not set), owner_id (booking's owner),
+        month (year * 12 + month - 1 of the session start),
+        movies, size (bytes), booking_start_us, booking_end_us
+    """
+    def __init__(self, dm):
+        rows = dm.get_rows(dm.Session, ['id', 'resource_id', 'booking_id',
+                                        'start', 'extra'])
+        bookings = {bid: (start, end, owner_id) for bid, start, end, owner_id in
+                    dm.get_rows(dm.Booking, ['id', 'start', 'end', 'owner_id'])}
+        n = len(rows)
+
+        def _array(values, dtype=np.int64):
+            return np.fromiter(values, dtype=dtype, count=n)
+
+        def _raw(extra):
+            return (extra or {}).get('raw', {})
+
+        def _booking(bid):
+            return bookings.get(bid, None) if bid else None
+
+        self.id = _array(r[0] for r in rows)
+        self.resource_id = _array(r[1] or 0 for r in rows)
+        self.month = _array((r[3].year * 12 + r[3].month - 1) if r[3] else 0
+                            for r in rows)
+        self.movies = _array(_raw(r[4]).get('movies', 0) for r in rows)
+        self.size = _array(sum(f['size'] for f in _raw(r[4]).get('files', {}).values())
+                           for r in rows)
+
+        session_bookings = [_booking(r[2]) for r in rows]
+        self.booking_id = _array(r[2] if b else 0
+                                 for r, b in zip(rows, session_bookings))
+        self.owner_id = _array(b[2] if b else 0 for b in session_bookings)
+        self.booking_start_us = _array(_us(b[0]) if b else 0
+                                       for b in session_bookings)
+        self.booking_end_us = _array(_us(b[1]) if b else 0
+                                     for b in session_bookings)
+
+    def __len__(self):
+        return len(self.id)
+
+    def select(self, resources, start, end):
+        """ Mask of sessions with movies, from the given resources and
+        with a booking inside the (start, end) range. """
+        return (np.isin(self.resource_id, list(resources)) &
+                (self.movies > 0) & (self.booking_id > 0) &
+                (self.booking_start_us >= _us(start)) &
+                (self.booking_end_us <= _us(end)))
+
+    def monthly(self, mask):
+        """ Return a list of ('YYYY-MM-01', sessions, size, movies) with
+        months in order of first appearance. """
+        result = []
+        for month, indexes in group_by(self.month, mask):
+            year, m = divmod(month, 12)
+            result.append(('%04d-%02d-01' % (year, m + 1), len(indexes),
+                           self.size[indexes].sum().item(),
+                           self.movies[indexes].sum().item()))
+        return result
+
+    def biggest(self, mask):
+        """ Return (movies, size) of the first session with most movies. """
+        idx = np.nonzero(mask)[0]
+        if not len(idx):
+            return 0, 0
+        i = idx[np.argmax(self.movies[idx])]
+        return self.movies[i].item(), self.size[i].item()
+
+
+def group_by(keys, mask=None):
+    """ Group the indexes of keys (optionally only where mask is True).
+    Return a list of (key, indexes) in order of first appearance,
+    with indexes in increasing order.
+    """
+    idx = np.arange(len(keys)) if mask is None else np.nonzero(mask)[0]
+    if not len(idx):
+        return []
+    values = keys[idx]
+    uniq, first, inverse = np.unique(values, return_index=True,
+                                     return_inverse=True)
+    perm = np.argsort(inverse, kind='stable')
+    groups = np.split(idx[perm], np.cumsum(np.bincount(inverse))[:-1])
+    return [(uniq[g].item() if hasattr(uniq[g], 'item') else uniq[g], groups[g])
+            for g in np.argsort(first, kind='stable')]
+
+
+def sum_by(keys, values):
+    """ Sum values grouped by keys, returning a dict (first appearance order)."""
+    result = {}
+    for key, idx in group_by(keys):
+        result[key] = values[idx].sum().item()
+    return result
@@ -18,12 +18,16 @@ class Counter:
     def _filter_by_name(self, b):
         return self._name.lower() in b['title'].lower()
 
+    def add(self, b):
+        """ Count the booking without checking the filter. """
+        self.counter += 1
+        self.cost += b['total_cost']
+        self.days += b['days']
+        self.bookings.append(b)
+
     def count(self, b):
         if self._filter(b):
-            self.counter += 1
-            self.cost += b['total_cost']
-            self.days += b['days']
-            self.bookings.append(b)
+            self.add(b)
             return True
         return False
 
@@ -44,6 +48,9 @@ class CounterList:
     def __getitem__(self, item):
         return self._countersDict[item]
 
+    def __contains__(self, item):
+        return item in self._countersDict
+
     def addCounter(self, counter):
         c = counter if isinstance(counter, Counter) else Counter(str(counter))
         self._counters.insert(-1, c)
@@ -62,6 +69,17 @@ class CounterList:
             self.reminder.append(b)
             self._counters[-1].count(b)  # Count reminder
 
+    def add(self, b, name):
+        """ Count the booking in Total and in the counter with that name
+        (already known by the caller), or in Reminder if name is None.
+        """
+        self._counters[0].add(b)
+        if name is None:
+            self.reminder.append(b)
+            self._counters[-1].add(b)
+        else:
+            self._countersDict[name].add(b)
+
     def data(self):
         total = self._counters[0].days
         if total > 0:
@@ -88,27 +106,33 @@ MAINTENANCE_LIST = ['cycle', 'installation', 'maintenance', 'afis']
 DEVELOPMENT_LIST = ['method', 'research', 'test', 'mikroed', 'microed', 'devel']
 DOWNTIME_LIST = ['downtime', 'down']
 
-def _match_title(b, keywords):
-    t = b['title'].lower()
-    return any(k in t for k in keywords)
+
+def _keywords_re(keywords):
+    return re.compile('|'.join(re.escape(k) for k in keywords))
+
+
+MAINTENANCE_RE = _keywords_re(MAINTENANCE_LIST)
+DEVELOPMENT_RE = _keywords_re(DEVELOPMENT_LIST)
+DOWNTIME_RE = _keywords_re(DOWNTIME_LIST)
+CEM_RE = re.compile("(CEM([0-9]+))")
+
 
 def is_maintenance(b):
-    return b['type'] == 'maintenance' or _match_title(b, MAINTENANCE_LIST)
+    return b['type'] == 'maintenance' or bool(MAINTENANCE_RE.search(b['title'].lower()))
 
 
 def is_development(b):
-    return _match_title(b, DEVELOPMENT_LIST)
+    return bool(DEVELOPMENT_RE.search(b['title'].lower()))
 
 def is_downtime(b):
-    return b['type'] == 'downtime' or _match_title(b, DOWNTIME_LIST)
+    return b['type'] == 'downtime' or bool(DOWNTIME_RE.search(b['title'].lower()))
 
 
-def get_cem(b):
-    title = b['title'].upper()
-
+def _cem_code(title):
+    """ Find the CEM code in the (upper case) title. """
     # Take only the first part of the application label
     # (because it can contains the alias in parenthesis)
-    m = re.search("(CEM([0-9]+))", title)
+    m = CEM_RE.search(title)
 
     if m is not None:
         # Enforce numeric part is exactly 5 digits
@@ -124,11 +148,37 @@ def get_cem(b):
     return None
 
 
+def get_cem(b):
+    return _cem_code(b['title'].upper())
+
+
 class CemCounter(Counter):
     def _filter_by_name(self, b):
         return self._name.upper() == get_cem(b)
 
 
+def get_category(btype, title, cem):
+    """ Return the name of the first matching category counter
+    (same order as in get_booking_counters) or None.
+
+    Args:
+        btype: booking type
+        title: booking title in lower case
+        cem: CEM code of the booking (or None)
+    """
+    if btype == 'downtime' or DOWNTIME_RE.search(title):
+        return 'Downtime'
+    if btype == 'maintenance' or MAINTENANCE_RE.search(title):
+        return 'Maintenance'
+    if 'dbb' in title:
+        return 'DBB'
+    if cem is not None:
+        return 'CEM'
+    if DEVELOPMENT_RE.search(title):
+        return 'Development'
+    return None
+
+
 def get_booking_counters(bookings):
     maintenance = Counter('Maintenance', is_maintenance)
     development = Counter('Development', is_development)
@@ -138,26 +188,21 @@ def get_booking_counters(bookings):
     counters = CounterList(downtime, maintenance, 'DBB', CEM, development)
     cem_counters = CounterList()
 
-    cem_dict = {}
-
+    # The category and CEM code of each booking are computed once and the
+    # booking is added to its counters by name, instead of testing every
+    # counter filter (and there is one counter per CEM code)
     for b in bookings:
         title = b['title']
 
         if 'Ume' in title:
             continue
 
-        counters.count(b)
-
-        cem = get_cem(b)
+        cem = _cem_code(title.upper())
+        counters.add(b, get_category(b['type'], title.lower(), cem))
 
         if cem is not None:
-            c = cem_dict.get(cem, 0)
-            cem_dict[cem] = c + 1
-            if not c:
+            if cem not in cem_counters:
                 cem_counters.addCounter(CemCounter(cem))
-            cem_counters.count(b)
+            cem_counters.add(b, cem)
 
     return counters, cem_counters
-
-
-
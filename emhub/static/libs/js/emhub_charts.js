@@ -602,8 +602,9 @@ function createVolume(array, dimensions) {
 
 
 function renderVolume3D(containerId, arrayJson, dimensions) {
-    //var data = JSON.parse(dataJson);
-    var array = new Uint8Array(atob(arrayJson).split("").map(function (c) {
+    // Volume data can be a Uint8Array or a base64 string
+    var array = arrayJson instanceof Uint8Array ? arrayJson :
+        new Uint8Array(atob(arrayJson).split("").map(function (c) {
             return c.charCodeAt(0);
         }));
         const nx = dimensions[0], ny = dimensions[1], nz = dimensions[2];
@@ -905,6 +906,18 @@ class PlotCard extends Card {
 }  // class GridSquareCard
 
 /* --------------------------- Session Live functions ------------------------*/
+function unpackArray(value) {
+    // Decode arrays packed as base64 int32 values (see pack_array in Python)
+    if (value == null || value.packed === undefined)
+        return value;
+    const bytes = Uint8Array.from(atob(value.data), c => c.charCodeAt(0));
+    const ints = new Int32Array(bytes.buffer);
+    if (value.labels !== undefined)
+        return Array.from(ints, i => value.labels[i]);
+    const scale = value.scale || 1;
+    return Array.from(ints, i => i / scale);
+}
+
 function session_getData2D(run_id){
     overlay_2d.show("Loading Class2D, run " + run_id);
     return session_getData({result: 'classes2d', run_id: run_id})
@@ -985,6 +998,9 @@ function session_getData(attrs) {
                     overlay_2d.hide();
                 }
                 else if ('defocus' in jsonResponse) {
+                    for (const key of ['defocus', 'defocusAngle', 'astigmatism',
+                                       'resolution', 'gridsquares'])
+                        jsonResponse[key] = unpackArray(jsonResponse[key]);
                     var count = session_data == null ? 0 : session_data.resolution.length;
                     session_data = jsonResponse;
                     // TODO: Update Defocus plot with new values since last time
@@ -1008,7 +1024,7 @@ function session_getData(attrs) {
 
 
 function session_reload() {
-    session_getData({result: 'micrographs'});
+    session_getData({result: 'micrographs', packed: true});
 }
 
 
@@ -29,3 +29,12 @@
 from .test_data import *
 from .test_api import *
 from .test_string import *
+from .test_jobs import *
+from .test_content import *
+from .test_imports import *
+from .test_reports import *
+from .test_aggregates import *
+from .test_processing import *
+from .test_metrics import *
+from .test_tasks import *
+from .test_admission import *
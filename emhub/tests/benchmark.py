@@ -0,0 +1,476 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *
+# * [1] SciLifeLab, Stockholm University
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'delarosatrevin@scilifelab.se'
+# *
+# **************************************************************************
+
+"""
+Benchmarks for some performance sensitive parts of EMhub.
+
+Usage:
+    python -m emhub.tests.benchmark time_distribution [--bookings N]
+    python -m emhub.tests.benchmark booking_events [--bookings N]
+    python -m emhub.tests.benchmark session_data [--micrographs N]
+    python -m emhub.tests.benchmark mrc_thumbnail [--size N]
+"""
+
+import time
+import random
+import argparse
+
+
+def timeit(label, func, *args, repeat=3):
+    """ Run func several times, print and return the best time. """
+    best = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - t
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"{label:>30}: {best * 1000:10.2f} ms")
+    return best, result
+
+
+# ------------------------- Time distribution ---------------------------------
+def synthetic_bookings(n=5000, n_apps=400, seed=0):
+    """ Generate bookings dicts (as used by reports.time_distribution)
+    similar to one year of a busy facility with many applications. """
+    rnd = random.Random(seed)
+    apps = ['CEM%05d' % rnd.randint(0, 99999) for _ in range(n_apps)]
+    users = ['%s %s' % (rnd.choice('ABCDEFGH'), rnd.choice('IJKLMNOP'))
+             for _ in range(200)]
+    other = ['Maintenance', 'Afis', 'Cycle', 'Testing new detector',
+             'Downtime: vacuum', 'DBB project', 'Method development',
+             'MicroED', 'Training', 'Ume collaboration', '']
+    types = ['booking'] * 20 + ['downtime', 'maintenance', 'special']
+
+    bookings = []
+    for i in range(n):
+        r = rnd.random()
+        if r < 0.7:
+            app = rnd.choice(apps)
+            # Sometimes the number has fewer digits or an alias
+            if rnd.random() < 0.1:
+                app = 'CEM' + app[3:].lstrip('0')
+            title = 'Krios (%s, %s) %s' % (rnd.choice(users), app,
+                                           rnd.choice(other[-3:]))
+        else:
+            title = 'Talos (%s) %s' % (rnd.choice(users), rnd.choice(other))
+        days = rnd.randint(1, 3)
+        bookings.append({'id': i, 'title': title, 'type': rnd.choice(types),
+                         'days': days, 'total_cost': days * 1000})
+    return bookings
+
+
+def legacy_booking_counters(bookings):
+    """ Previous implementation, testing every counter filter
+    (with keywords and CEM code matched again in every filter). """
+    import re
+    from emhub.reports.time_distribution import (
+        Counter, CounterList, MAINTENANCE_LIST, DEVELOPMENT_LIST, DOWNTIME_LIST)
+
+    def _match_title(b, keywords):
+        t = b['title'].lower()
+        return any(k in t for k in keywords)
+
+    def is_maintenance(b):
+        return b['type'] == 'maintenance' or _match_title(b, MAINTENANCE_LIST)
+
+    def is_development(b):
+        return _match_title(b, DEVELOPMENT_LIST)
+
+    def is_downtime(b):
+        return b['type'] == 'downtime' or _match_title(b, DOWNTIME_LIST)
+
+    def get_cem(b):
+        m = re.search("(CEM([0-9]+))", b['title'].upper())
+        if m is None:
+            return None
+        cemNumber = m.group(2)
+        n = len(cemNumber)
+        if n < 5:
+            cemNumber = "0" * (5 - n) + cemNumber
+        else:
+            cemNumber = cemNumber[-5:]
+        return 'CEM' + cemNumber
+
+    class CemCounter(Counter):
+        def _filter_by_name(self, b):
+            return self._name.upper() == get_cem(b)
+
+    counters = CounterList(Counter('Downtime', is_downtime),
+                           Counter('Maintenance', is_maintenance), 'DBB',
+                           Counter('CEM', lambda b: get_cem(b) is not None),
+                           Counter('Development', is_development))
+    cem_counters = CounterList()
+    cem_dict = {}
+
+    for b in bookings:
+        if 'Ume' in b['title']:
+            continue
+        counters.count(b)
+        cem = get_cem(b)
+        if cem is not None:
+            c = cem_dict.get(cem, 0)
+            cem_dict[cem] = c + 1
+            if not c:
+                cem_counters.addCounter(CemCounter(cem))
+            cem_counters.count(b)
+
+    return counters, cem_counters
+
+
+def benchmark_time_distribution(n):
+    from emhub.reports.time_distribution import get_booking_counters
+
+    bookings = synthetic_bookings(n)
+    print(f"Counting {n} bookings")
+    t_old, old = timeit('legacy counters', legacy_booking_counters, bookings)
+    t_new, new = timeit('get_booking_counters', get_booking_counters, bookings)
+    same = all(o.data() == n.data() for o, n in zip(old, new))
+    print(f"{'speedup':>30}: {t_old / t_new:10.1f}x (same results: {same})")
+
+
+# ------------------------- Booking events ------------------------------------
+def legacy_booking_to_event(dc, booking, **kwargs):
+    """ Previous implementation of DataContent.booking_to_event,
+    querying configuration and permissions for every booking. """
+    from emhub.utils import pretty_datetime, datetime_to_isoformat, shortname
+
+    resource = booking.resource
+    # Bookings should have resources, just in case an erroneous one
+    if resource is None:
+        resource = dc.app.dm.Resource(
+            name='Error: MISSING',
+            status='inactive',
+            tags='',
+            image='',
+            color='rgba(256, 256, 256, 1.0)',
+            extra={})
+
+    owner = booking.owner
+    operator = booking.operator  # shortcut
+    a = booking.application
+    user = dc.app.user
+    dm = dc.app.dm
+    b_title = booking.title
+
+    can_modify_list = [owner.id]
+
+    if a is not None:
+        can_modify_list.append(a.creator.id)
+
+    if user.is_manager and (a is None or a.allows_access(user)):
+        can_modify_list.append(user.id)
+
+    pi = owner.get_pi()
+    if pi is not None:
+        can_modify_list.append(pi.id)
+
+    user_can_modify = user.id in can_modify_list
+    user_can_view = user_can_modify or user.same_pi(owner)
+    color = resource.color if resource else 'grey'
+
+    if booking.type == 'special':
+        color = 'rgba(98,50,45,1.0)'
+        title = "%s (SPECIAL): %s" % (resource.name, b_title)
+    if booking.type == 'downtime':
+        color = 'rgba(181,4,0,1.0)'
+        title = "%s (DOWNTIME): %s" % (resource.name, b_title)
+    if booking.type == 'maintenance' or any(k in b_title for k in ['cycle', 'installation', 'maintenance', 'afis']):
+        color = 'rgba(255,107,53,1.0)'
+        title = "%s (MAINTENANCE): %s" % (resource.name, b_title)
+    elif booking.type == 'slot':
+        color = color.replace('1.0', '0.5')  # transparency for slots
+        title = "%s (SLOT): %s" % (resource.name,
+                                   booking.slot_auth.get('applications', ''))
+    else:
+        # Show all booking information in title in some cases only
+        display = dm.get_config('bookings')['display']
+        emptyApp = a is None or not display['show_application']
+        appStr = '' if emptyApp else ', %s' % a.code
+        emptyPi = (owner.is_manager or owner.is_pi or
+                   pi is None or not display.get('show_pi', False))
+        piStr = '' if emptyPi else shortname(pi) + '/'
+        emptyOp = operator is None or not display.get('show_operator', False)
+        opStr = '' if emptyOp else ' -> ' + shortname(operator)
+
+        extra = "%s%s%s%s" % (piStr, shortname(owner), appStr, opStr)
+        if user_can_view:
+            title = "%s (%s) %s" % (resource.name, extra, b_title)
+        else:
+            title = "%s (%s)" % (resource.name, extra)
+            b_title = "Hidden title"
+
+    bd = {
+        'id': booking.id,
+        'title': title,
+        'resource': {'id': resource.id},
+        'start': datetime_to_isoformat(booking.start),
+        'end': datetime_to_isoformat(booking.end),
+        'color': color,
+        'textColor': 'white',
+        'booking_title': b_title,
+    }
+
+    if kwargs.get('prettyDate', False):
+        bd['pretty_start'] = pretty_datetime(booking.start)
+        bd['pretty_end'] = pretty_datetime(booking.end)
+
+    if kwargs.get('piApp', False):
+        if pi is not None:
+            bd['pi_id'] = pi.id
+            bd['pi_name'] = pi.name
+
+        app = booking.application
+        if app is not None:
+            bd['app_id'] = app.id
+
+    return bd
+
+
+def benchmark_booking_events(n):
+    """ Compare the previous booking_to_event (one call per booking) with
+    the bookings_to_events batch serializer, using the bookings of a test
+    instance repeated up to n bookings. """
+    import os
+    import shutil
+    import tempfile
+    import flask_login
+    from emhub import create_app
+    from emhub.data.imports.test import create_instance
+
+    instance_path = tempfile.mkdtemp(prefix='emhub-benchmark-')
+    try:
+        create_instance(instance_path, None, True)
+        os.environ['EMHUB_INSTANCE'] = instance_path
+        app = create_app({'TESTING': True, 'QUERY_DETECTOR_THRESHOLD': 0})
+        with app.test_request_context('/'):
+            dc, dm = app.dc, app.dm
+            flask_login.login_user(dm.get_user_by(id=1))
+            all_bookings = dm.get_bookings()
+            bookings = [all_bookings[i % len(all_bookings)] for i in range(n)]
+            print(f"Serializing {n} bookings")
+
+            def _single():
+                return [legacy_booking_to_event(dc, b, prettyDate=True,
+                                                piApp=True)
+                        for b in bookings]
+
+            def _batch():
+                return dc.bookings_to_events(bookings, prettyDate=True,
+                                             piApp=True)
+
+            t_old, old = timeit('legacy booking_to_event', _single)
+            t_new, new = timeit('bookings_to_events', _batch)
+            print(f"{'speedup':>30}: {t_old / t_new:10.1f}x "
+                  f"(same results: {old == new})")
+    finally:
+        os.environ.pop('EMHUB_INSTANCE', None)
+        shutil.rmtree(instance_path, ignore_errors=True)
+
+
+# ------------------------- Session CTF data ----------------------------------
+def legacy_ctf_series(sdata):
+    """ Previous implementation of get_session_data CTF values,
+    iterating over the micrographs dicts. """
+    import os
+    from emtools.metadata import Bins, EPU
+
+    defocus, defocusAngle, resolution, astigmatism = [], [], [], []
+    gridsquares = []
+    firstMic = lastMic = None
+    dbins = Bins([1, 2, 3])
+    rbins = Bins([3, 4, 6])
+
+    def _microns(v):
+        return round(v * 0.0001, 3)
+
+    for mic in sdata.get_micrographs():
+        micFn = mic['micrograph']
+        loc = EPU.get_movie_location(mic.get('micName', micFn))
+        gridsquares.append(loc['gs'])
+        if not defocus:
+            firstMic = micFn
+        lastMic = micFn
+        d = _microns(mic['ctfDefocus'])
+        defocus.append(d)
+        dbins.addValue(d)
+        defocusAngle.append(mic['ctfDefocusAngle'])
+        astigmatism.append(_microns(mic['ctfAstigmatism']))
+        r = round(mic['ctfResolution'], 3)
+        resolution.append(r)
+        rbins.addValue(r)
+
+    tsFirst = os.path.getmtime(sdata.join(firstMic))
+    tsLast = os.path.getmtime(sdata.join(lastMic))
+    step = (tsLast - tsFirst) / len(defocus)
+    return {
+        'defocus': defocus,
+        'defocusAngle': defocusAngle,
+        'astigmatism': astigmatism,
+        'resolution': resolution,
+        'defocus_bins': dbins.toList(),
+        'resolution_bins': rbins.toList(),
+        'gridsquares': gridsquares,
+        'tsRange': {'first': tsFirst * 1000, 'last': tsLast * 1000,
+                    'step': step * 1000}
+    }
+
+
+def benchmark_session_data(n):
+    """ Compare the CTF series of a Relion OTF project with n micrographs
+    computed from micrographs dicts (legacy) or from NumPy columns. """
+    import os
+    import json
+    import shutil
+    import tempfile
+    from emhub.data.processing import get_processing_project
+    from emhub.tests.test_processing import (write_star, CTF_COLUMNS,
+                                             create_relion_project)
+
+    path = tempfile.mkdtemp(prefix='emhub-benchmark-')
+    try:
+        create_relion_project(path, n=1)
+        rnd = random.Random(0)
+        rows = []
+        for i in range(n):
+            gs = 'GridSquare_%d' % (1000 + i // 400)
+            fn = (f'MotionCorr/job002/Movies/{gs}/Data/'
+                  f'FoilHole_{i // 8}_Data_{i}_20230101_{i:06d}_fractions.mrc')
+            dU = rnd.uniform(5000, 35000)
+            rows.append((fn, fn.replace('.mrc', '.ctf:mrc'), round(dU, 6),
+                         round(dU + 200, 6), round(rnd.uniform(-90, 90), 6),
+                         round(rnd.uniform(0, 800), 6),
+                         round(rnd.uniform(2, 12), 6), 0.1, 1))
+        ctfStar = os.path.join(path, 'CtfFind', 'job003', 'micrographs_ctf.star')
+        write_star(ctfStar, [('optics', ['rlnOpticsGroup', 'rlnMicrographPixelSize'],
+                              [[1, 1.1]]),
+                             ('micrographs', CTF_COLUMNS, rows)])
+        for row in (rows[0], rows[-1]):
+            os.makedirs(os.path.dirname(os.path.join(path, row[0])), exist_ok=True)
+            open(os.path.join(path, row[0]), 'w').close()
+
+        print(f"CTF series of {n} micrographs")
+        get_processing_project(path).get_stats()  # Parse STAR files
+
+        def _cold(func):
+            return lambda: func(get_processing_project(path, cache=False))
+
+        t_old, old = timeit('legacy', _cold(legacy_ctf_series))
+        t_new, new = timeit('get_ctf_series', _cold(lambda s: s.get_ctf_series()))
+        sdata = get_processing_project(path)
+        sdata.get_ctf_series()
+        t_cached, _ = timeit('get_ctf_series (cached)', sdata.get_ctf_series)
+        t_json, packed = timeit('get_ctf_series (packed)',
+                                lambda: sdata.get_ctf_series(packed=True))
+        print(f"{'speedup':>30}: {t_old / t_new:10.1f}x "
+              f"(same results: {old == new})")
+        print(f"{'JSON size':>30}: {len(json.dumps(new)) / 1024:10.1f} KB, "
+              f"packed: {len(json.dumps(packed)) / 1024:0.1f} KB")
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+# ------------------------- MRC thumbnails ------------------------------------
+def legacy_mrc_thumbnail(converter, path):
+    """ Previous Base64Converter.from_mrc, reading and normalizing
+    the full image before resizing it with PIL. """
+    import mrcfile
+
+    with mrcfile.open(path, permissive=True) as mrc:
+        data = mrc.data[0, :, :] if mrc.is_volume() else mrc.data
+        return converter.from_array(data)
+
+
+def benchmark_mrc_thumbnail(size):
+    """ Compare time and peak memory of creating a 512px thumbnail from
+    a size x size float32 micrograph. """
+    import os
+    import shutil
+    import tempfile
+    import tracemalloc
+    import numpy as np
+    import mrcfile
+    from emtools.image import Thumbnail
+    from emhub.utils.image import Base64Converter
+    from emhub.data.processing import thumbnails
+
+    folder = tempfile.mkdtemp(prefix='emhub-benchmark-')
+    try:
+        path = os.path.join(folder, 'micrograph.mrc')
+        with mrcfile.new_mmap(path, shape=(size, size), mrc_mode=2) as mrc:
+            for r in range(0, size, 1024):
+                mrc.data[r:r + 1024] = np.random.rand(min(1024, size - r), size)
+        print(f"Thumbnail of a {size}x{size} micrograph")
+
+        converter = Base64Converter(max_size=(512, 512))
+
+        def _measure(label, func):
+            tracemalloc.start()
+            t, _ = timeit(label, func, converter, path, repeat=1)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f"{'peak memory':>30}: {peak / 1024 ** 2:10.1f} MB")
+            return t
+
+        t_old = _measure('legacy from_mrc', legacy_mrc_thumbnail)
+        t_new = _measure('from_mrc (mmap + reduce)',
+                         lambda c, p: c.from_mrc(p))
+        print(f"{'speedup':>30}: {t_old / t_new:10.1f}x")
+
+        # Micrograph thumbnails created by the processing readers
+        converter = Thumbnail.Micrograph()
+        t_old = _measure('Thumbnail.from_mrc', lambda c, p: c.from_mrc(p))
+        t_new = _measure('thumbnails._create (reduce)', thumbnails._create)
+        print(f"{'speedup':>30}: {t_old / t_new:10.1f}x")
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def main():
+    p = argparse.ArgumentParser(prog='emhub.tests.benchmark')
+    sub = p.add_subparsers(dest='benchmark', required=True)
+    td = sub.add_parser('time_distribution')
+    td.add_argument('--bookings', type=int, default=5000)
+    be = sub.add_parser('booking_events')
+    be.add_argument('--bookings', type=int, default=5000)
+    sd = sub.add_parser('session_data')
+    sd.add_argument('--micrographs', type=int, default=20000)
+    mt = sub.add_parser('mrc_thumbnail')
+    mt.add_argument('--size', type=int, default=8192)
+
+    args = p.parse_args()
+
+    if args.benchmark == 'time_distribution':
+        benchmark_time_distribution(args.bookings)
+    elif args.benchmark == 'booking_events':
+        benchmark_booking_events(args.bookings)
+    elif args.benchmark == 'session_data':
+        benchmark_session_data(args.micrographs)
+    elif args.benchmark == 'mrc_thumbnail':
+        benchmark_mrc_thumbnail(args.size)
+
+
+if __name__ == '__main__':
+    main()
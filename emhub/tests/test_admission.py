@@ -0,0 +1,176 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *
+# * [1] SciLifeLab, Stockholm University
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'delarosatrevin@scilifelab.se'
+# *
+# **************************************************************************
+
+
+
+import time
+import threading
+import unittest
+
+import flask
+import flask_login
+
+from emhub.utils.admission import AdmissionController, admission_control
+from emhub.utils.metrics import Metrics
+
+
+class TestAdmission(unittest.TestCase):
+    def _samples(self, metrics, name):
+        for m in metrics._metrics:
+            if m.name == name:
+                return {n: v for n, _, v in m.samples()}
+        return {}
+
+    def _wait_queued(self, controller, n, timeout=2):
+        t0 = time.time()
+        while controller._queued != n and time.time() - t0 < timeout:
+            time.sleep(0.01)
+        self.assertEqual(controller._queued, n)
+
+    def test_fair_queues(self):
+        metrics = Metrics()
+        controller = AdmissionController(max_active=1, max_queue=10,
+                                         max_wait=10, metrics=metrics)
+        self.assertTrue(controller.acquire('admin'))
+        order = []
+        threads = []
+
+        def _request(user, label):
+            if controller.acquire(user):
+                order.append(label)
+                time.sleep(0.01)
+                controller.release()
+
+        # User 'a' opens many images before user 'b' requests one
+        for user, label in [('a', 'a1'), ('a', 'a2'), ('a', 'a3'),
+                            ('b', 'b1')]:
+            t = threading.Thread(target=_request, args=(user, label))
+            t.start()
+            threads.append(t)
+            self._wait_queued(controller, len(threads))
+
+        self.assertEqual(self._samples(metrics, 'emhub_admission_active'),
+                         {'emhub_admission_active': 1})
+        self.assertEqual(self._samples(metrics, 'emhub_admission_queue_depth'),
+                         {'emhub_admission_queue_depth': 4})
+        self.assertEqual(order, [])
+
+        time.sleep(0.1)
+        controller.release()
+        for t in threads:
+            t.join(5)
+
+        # Users are served in round-robin
+        self.assertEqual(order, ['a1', 'b1', 'a2', 'a3'])
+        self.assertEqual(controller._active, 0)
+        self.assertEqual(self._samples(metrics, 'emhub_admission_queue_depth'),
+                         {'emhub_admission_queue_depth': 0})
+        wait = self._samples(metrics, 'emhub_admission_wait_seconds')
+        self.assertEqual(wait['emhub_admission_wait_seconds_count'], 5)
+        self.assertGreaterEqual(wait['emhub_admission_wait_seconds_sum'], 0.4)
+
+    def test_reject(self):
+        metrics = Metrics()
+        controller = AdmissionController(max_active=2, max_queue=1,
+                                         max_wait=0.2, metrics=metrics)
+        self.assertTrue(controller.acquire('a'))
+        self.assertTrue(controller.acquire('a'))
+
+        # Waiting for longer than max_wait
+        t0 = time.time()
+        self.assertFalse(controller.acquire('b'))
+        self.assertGreaterEqual(time.time() - t0, 0.2)
+        self.assertEqual(controller._queued, 0)
+
+        # Queue is full
+        result = []
+        t = threading.Thread(target=lambda: result.append(controller.acquire('b')))
+        t.start()
+        self._wait_queued(controller, 1)
+        self.assertFalse(controller.acquire('c'))
+        controller.release()
+        t.join(5)
+        self.assertEqual(result, [True])
+
+        self.assertEqual(self._samples(metrics, 'emhub_admission_rejected_total'),
+                         {'emhub_admission_rejected_total': 2})
+        controller.release()
+        controller.release()
+        self.assertEqual(self._samples(metrics, 'emhub_admission_active'),
+                         {'emhub_admission_active': 0})
+
+    def test_decorator(self):
+        app = flask.Flask(__name__)
+        app.config['ADMISSION_RETRY_AFTER'] = 7
+        login_manager = flask_login.LoginManager(app)
+        login_manager.user_loader(lambda user_id: None)
+        app.admission = controller = AdmissionController(max_active=1,
+                                                         max_queue=0,
+                                                         max_wait=0)
+        chunks = threading.Event()
+
+        @app.route('/image')
+        @admission_control
+        def image():
+            return 'image'
+
+        @app.route('/stream')
+        @admission_control
+        def stream():
+            def _chunks():
+                yield 'a'
+                chunks.wait(5)
+                yield 'b'
+            return flask.Response(_chunks())
+
+        client = app.test_client()
+        r = client.get('/image')
+        self.assertEqual(r.data, b'image')
+        self.assertEqual(controller._active, 0)
+
+        # The slot is kept while the streamed body is being sent
+        r = client.get('/stream', buffered=False)
+        body = r.response
+        self.assertEqual(next(body), b'a')
+        self.assertEqual(controller._active, 1)
+
+        busy = client.get('/image')
+        self.assertEqual(busy.status_code, 503)
+        self.assertEqual(busy.headers['Retry-After'], '7')
+        self.assertIn('busy', busy.json['error'])
+
+        chunks.set()
+        self.assertEqual(list(body), [b'b'])
+        r.close()
+        self.assertEqual(controller._active, 0)
+        self.assertEqual(client.get('/image').status_code, 200)
+
+        # Also released if the client disconnects before the end
+        chunks.clear()
+        r = client.get('/stream', buffered=False)
+        self.assertEqual(controller._active, 1)
+        r.close()
+        self.assertEqual(controller._active, 0)
@@ -0,0 +1,116 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *
+# * [1] SciLifeLab, Stockholm University
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'delarosatrevin@scilifelab.se'
+# *
+# **************************************************************************
+
+
+import os
+import shutil
+import tempfile
+import unittest
+import datetime as dt
+from collections import defaultdict
+
+from emhub.data.data_manager import DataManager
+from emhub.data.imports.test import create_instance
+
+
+class TestUsageAggregates(unittest.TestCase):
+    """ Check that monthly usage aggregates are kept up to date when
+    bookings and sessions change, and match the values from Booking objects.
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.instance_path = tempfile.mkdtemp(prefix='emhub-test-')
+        create_instance(cls.instance_path, None, True)
+        cls.dm = DataManager(cls.instance_path, usageAggregates=True)
+        cls.dm._user = cls.dm.get_user_by(id=1)  # admin, for updates
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.instance_path, ignore_errors=True)
+
+    def _rows(self):
+        fields = ['bookings', 'days', 'hours', 'cost',
+                  'sessions', 'movies', 'bytes']
+        return {(r.month, r.resource_id, r.pi_id, r.application_id,
+                 r.booking_type): tuple(getattr(r, f) for f in fields)
+                for r in self.dm.get_usage_aggregates()}
+
+    def _reference(self):
+        dm = self.dm
+        rows = defaultdict(lambda: [0] * 7)
+        for b in dm.get_bookings():
+            pi = b.owner.get_pi()
+            key = (dm.dt_as_local(b.start).strftime('%Y-%m'), b.resource_id,
+                   pi.id if pi else 0, b.application_id or 0, b.type)
+            r = rows[key]
+            for i, v in enumerate([1, b.days, b.hours, b.total_cost,
+                                   len(b.session),
+                                   sum(s.total_movies for s in b.session),
+                                   b.total_size]):
+                r[i] += v
+        return {k: tuple(v) for k, v in rows.items()}
+
+    def test_aggregates(self):
+        dm = self.dm
+        self.assertTrue(dm.usage_aggregates.tracking)
+        # Changes are not tracked by default (test data was created so)
+        self.assertFalse(DataManager(self.instance_path).usage_aggregates.tracking)
+
+        # The empty table was filled when tracking started
+        rebuilt = self._rows()
+        self.assertGreater(len(rebuilt), 0)
+        self.assertEqual(rebuilt, self._reference())
+
+        # Move a booking to another month and add an extra cost
+        b = dm.get_bookings(orderBy='start')[0]
+        old_month = dm.dt_as_local(b.start).strftime('%Y-%m')
+        delta = dt.timedelta(days=62)
+        dm.update_booking(id=b.id, start=b.start + delta, end=b.end + delta,
+                          costs=[['Extra', 'Test', '100']])
+        rows = self._rows()
+        self.assertEqual(rows, self._reference())
+        self.assertNotEqual(rows, rebuilt)
+        self.assertTrue(any(k[0] == old_month for k in rebuilt))
+
+        # Session changes are also reflected
+        s = dm.get_sessions()[0]
+        raw = dict(s.extra.get('raw', {}), movies=1234)
+        dm.update_session_extra(id=s.id, extra={'raw': raw})
+        self.assertEqual(self._rows(), self._reference())
+
+        months = sorted({k[0] for k in rows})
+        selected = dm.get_usage_aggregates(start=months[1], end=months[-2])
+        self.assertTrue(all(months[1] <= r.month <= months[-2] for r in selected))
+
+        # Changes in PIs or resources cost affect all months
+        user = next(b.owner for b in dm.get_bookings()
+                    if b.owner.pi is not None and not b.owner.is_pi)
+        pi = next(u for u in dm.get_users() if u.is_pi and u != user.pi)
+        dm.update_user(id=user.id, pi_id=pi.id)
+        self.assertEqual(self._rows(), self._reference())
+        r = next(r for r in dm.get_resources() if r.daily_cost > 0)
+        dm.update_resource(id=r.id, daily_cost=r.daily_cost + 1000)
+        self.assertEqual(self._rows(), self._reference())
@@ -0,0 +1,149 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *
+# * [1] SciLifeLab, Stockholm University
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'delarosatrevin@scilifelab.se'
+# *
+# **************************************************************************
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import flask_login
+
+from emhub import create_app
+from emhub.data.imports.test import create_instance
+from emhub.data.query_log import RepeatedQueryError
+
+
+class TestContentQueries(unittest.TestCase):
+    """ Run every registered content function against the test instance
+    data and check that there are no repeated queries (N+1).
+    """
+    # Maximum number of times the same SELECT can be executed per content
+    THRESHOLD = 50
+
+    # Content functions with known N+1 problems, remove from here when fixed
+    KNOWN_REPEATED = [
+        'booking_form',
+        'dashboard',
+        'invoice_period',
+        'invoices_lab_list',
+        'logs',
+        'project_details',
+        'projects_list',
+        'projects_list_table',
+        'raw_projects_list',
+        'report_projects_overview',
+        'reports_time_distribution',
+    ]
+
+    # Content functions that can not be computed from the test instance
+    # data, since they need files on disk, a Redis server or have known
+    # errors. Only for these, exceptions are reported as skipped subtests.
+    REQUIRE_EXTERNAL = {
+        'create_session_form': 'sessions creation defined in the extras',
+        'pages': 'page files in the PAGES folder',
+        'processing_content': 'a processing project on disk',
+        'processing_flowchart': 'a processing project on disk',
+        'processing_run_overview': 'a processing project on disk',
+        'processing_run_summary': 'a processing project on disk',
+        'session_flowchart': 'session data on disk',
+        'session_live': 'session data on disk',
+        'session_micrographs': 'session data on disk',
+        'task_history': 'a Redis server',
+        'reports_bookings_extracosts': "known error, no 'costs' in bookings",
+        'reports_invoices_lab': 'known error, missing get_reports_invoices',
+        'session_gridsquares': 'known error, missing DataManager.load_session',
+        'session_hourly_plots': 'known error, missing DataManager.load_session',
+    }
+
+    @classmethod
+    def setUpClass(cls):
+        cls.instance_path = tempfile.mkdtemp(prefix='emhub-test-')
+        create_instance(cls.instance_path, None, True)
+        os.environ['EMHUB_INSTANCE'] = cls.instance_path
+        cls.app = create_app({'TESTING': True,
+                              'QUERY_DETECTOR_THRESHOLD': cls.THRESHOLD,
+                              'QUERY_DETECTOR_FAIL': True})
+
+    @classmethod
+    def tearDownClass(cls):
+        os.environ.pop('EMHUB_INSTANCE', None)
+        shutil.rmtree(cls.instance_path, ignore_errors=True)
+
+    def _default_kwargs(self, dm):
+        def _first(items):
+            return items[0].id if items else None
+
+        pis = [u for u in dm.get_users() if u.is_pi and u.get_applications()]
+        entries = [e for e in dm.get_entries()
+                   if 'report' in dm.get_entry_config(e.type)]
+
+        kwargs = {
+            'start': '2020-01-01',
+            'end': '2030-01-01',
+            'user_id': 1,
+            'pi_id': _first(pis),
+            'booking_id': _first(dm.get_bookings()),
+            'session_id': _first(dm.get_sessions()),
+            'project_id': _first(dm.get_projects()),
+            'entry_id': _first(entries),
+            'resource_id': _first(dm.get_resources()),
+            'template_id': _first(dm.get_templates()),
+            'transaction_id': _first(dm.get_transactions()),
+            'invoice_period_id': _first(dm.get_invoice_periods()),
+            'period': _first(dm.get_invoice_periods()),
+        }
+        return {k: v for k, v in kwargs.items() if v is not None}
+
+    def test_repeated_queries(self):
+        app = self.app
+        detector = app.query_detector
+        self.assertIsNotNone(detector)
+
+        with app.test_request_context('/'):
+            dm = app.dm
+            flask_login.login_user(dm.get_user_by(id=1))
+            # There are no transactions in the test data
+            pi = next(u for u in dm.get_users() if u.is_pi)
+            dm.create_transaction(user_id=pi.id, amount=-1000, comment='Test',
+                                  date=dm.now())
+            kwargs = self._default_kwargs(dm)
+
+            for content_id in sorted(app.dc._contentDict):
+                with self.subTest(content_id=content_id):
+                    try:
+                        app.dc.get(content_id=content_id, **kwargs)
+                    except RepeatedQueryError as e:
+                        if content_id not in self.KNOWN_REPEATED:
+                            self.fail(str(e))
+                    except Exception as e:
+                        if content_id not in self.REQUIRE_EXTERNAL:
+                            raise
+                        self.skipTest(f"{content_id} requires "
+                                      f"{self.REQUIRE_EXTERNAL[content_id]}: {e}")
+                    else:
+                        self.assertNotIn(content_id, self.KNOWN_REPEATED,
+                                         "No longer repeated queries, remove "
+                                         "it from KNOWN_REPEATED")
@@ -0,0 +1,102 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *
+# * [1] SciLifeLab, Stockholm University
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'delarosatrevin@scilifelab.se'
+# *
+# **************************************************************************
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+from emhub.data.imports.test import create_instance
+
+
+HEAVY_MODULES = ['numpy', 'PIL', 'mrcfile', 'emtools.metadata',
+                 'emtools.image', 'emhub.data.processing']
+
+
+class TestImportTime(unittest.TestCase):
+    """ Check that heavy scientific modules are not loaded when creating
+    the app or using the client, and that import time is within budget.
+    Budgets (in seconds) can be changed with EMHUB_IMPORT_BUDGET_APP and
+    EMHUB_IMPORT_BUDGET_CLIENT environment variables.
+    """
+    APP_BUDGET = float(os.environ.get('EMHUB_IMPORT_BUDGET_APP', 3))
+    CLIENT_BUDGET = float(os.environ.get('EMHUB_IMPORT_BUDGET_CLIENT', 1))
+
+    @classmethod
+    def setUpClass(cls):
+        cls.instance_path = tempfile.mkdtemp(prefix='emhub-test-')
+        create_instance(cls.instance_path, None, True)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.instance_path, ignore_errors=True)
+
+    def _run(self, code):
+        """ Run the code in a new Python process with -X importtime,
+        return the elapsed time, loaded heavy modules and slowest imports.
+        """
+        script = f"""
+import sys, time, json
+t = time.perf_counter()
+{code}
+elapsed = time.perf_counter() - t
+heavy = [m for m in {HEAVY_MODULES} if m in sys.modules]
+print(json.dumps({{'elapsed': elapsed, 'heavy': heavy}}))
+"""
+        here = os.path.dirname(os.path.abspath(__file__))
+        env = dict(os.environ, EMHUB_INSTANCE=self.instance_path,
+                   PYTHONPATH=os.path.dirname(os.path.dirname(here)))
+        p = subprocess.run([sys.executable, '-X', 'importtime', '-c', script],
+                           capture_output=True, text=True, env=env)
+        self.assertEqual(p.returncode, 0, p.stderr)
+        result = json.loads(p.stdout.strip().splitlines()[-1])
+
+        imports = []
+        for line in p.stderr.splitlines():
+            if line.startswith('import time:') and '|' in line:
+                _, cumulative, name = line.split('|')
+                if cumulative.strip().isdigit():
+                    imports.append((int(cumulative), name.strip()))
+        result['slowest'] = sorted(imports, reverse=True)[:10]
+        return result
+
+    def _check(self, result, budget):
+        self.assertEqual(result['heavy'], [],
+                         f"Heavy modules loaded: {result['heavy']}")
+        slowest = '\n'.join(f"  {us / 1e6:0.3f}s {name}"
+                            for us, name in result['slowest'])
+        self.assertLess(result['elapsed'], budget,
+                        f"Import time over budget, slowest imports:\n{slowest}")
+
+    def test_create_app(self):
+        self._check(self._run("from emhub import create_app\n"
+                              "app = create_app()"), self.APP_BUDGET)
+
+    def test_client(self):
+        self._check(self._run("import emhub.client"), self.CLIENT_BUDGET)
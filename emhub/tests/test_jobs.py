@@ -0,0 +1,139 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *              Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk) [2]
+# *
+# * [1] SciLifeLab, Stockholm University
+# * [2] MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'delarosatrevin@scilifelab.se'
+# *
+# **************************************************************************
+
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import flask
+import flask_login
+
+from emhub import create_app
+from emhub.data.imports.test import create_instance
+from emhub.reports.jobs import ReportJob
+
+
+class TestReportJobs(unittest.TestCase):
+    """ Check that reports rendered in background jobs report their
+    progress and are cached until the database changes.
+    """
+    RANGE = {'start': '2020/01/01', 'end': '2030/01/01'}
+
+    @classmethod
+    def setUpClass(cls):
+        cls.instance_path = tempfile.mkdtemp(prefix='emhub-test-')
+        create_instance(cls.instance_path, None, True)
+        os.environ['EMHUB_INSTANCE'] = cls.instance_path
+        cls.app = create_app({'TESTING': True})
+
+    @classmethod
+    def tearDownClass(cls):
+        os.environ.pop('EMHUB_INSTANCE', None)
+        shutil.rmtree(cls.instance_path, ignore_errors=True)
+
+    def setUp(self):
+        self.ctx = self.app.test_request_context('/')
+        self.ctx.push()
+        self.dm = self.app.dm
+        flask_login.login_user(self.dm.get_user_by(id=1))
+
+    def tearDown(self):
+        self.ctx.pop()
+
+    def _wait_job(self, job, timeout=60):
+        t0 = time.time()
+        while not job.is_finished and time.time() - t0 < timeout:
+            job.wait_change(timeout=0.5)
+        self.assertTrue(job.is_finished, "Report job did not finish")
+        self.assertEqual(job.status, ReportJob.DONE, job.message)
+
+    def test_report_jobs(self):
+        dm, jobs = self.dm, self.app.jobs
+        user = dm.get_user_by(id=1)
+        params = dict(self.RANGE, metric='days')
+        updates = []
+        update = ReportJob.update
+
+        def _update(job, progress=None, message=None):
+            updates.append((progress, message))
+            update(job, progress, message)
+
+        with mock.patch.object(ReportJob, 'update', _update):
+            job = jobs.submit('report_sessions_distribution', params, user)
+            self._wait_job(job)
+
+        self.assertFalse(job.cached)
+        self.assertEqual(job.progress, 1.0)
+        self.assertTrue(job.result)
+        self.assertIs(jobs.get(job.id), job)
+        # Progress reported from the content functions in the job thread
+        progress = [p for p, _ in updates if p is not None]
+        self.assertIn(0.6, progress)
+        self.assertEqual(progress, sorted(progress))
+        self.assertIn('result', job.json(result=True))
+
+        with self.assertRaises(Exception):
+            jobs.submit('dashboard', params, user)
+
+        # Same report without changes in the database: cached result
+        job2 = jobs.submit('report_sessions_distribution', params, user)
+        self.assertTrue(job2.cached)
+        self.assertEqual(job2.status, ReportJob.DONE)
+        self.assertEqual(job2.result, job.result)
+
+        # After a commit that modifies the database the result is computed again
+        version = dm.data_version()
+        form = dm.create_form(name='report_jobs_test', definition={})
+        try:
+            self.assertNotEqual(dm.data_version(), version)
+            job3 = jobs.submit('report_sessions_distribution', params, user)
+            self.assertFalse(job3.cached)
+            self._wait_job(job3)
+            self.assertEqual(job3.result, job.result)
+        finally:
+            dm.delete_form(id=form.id)
+
+        # Jobs render in a request for the job user and the same url root
+        other = next(u for u in dm.get_users() if u.is_manager and u.id != 1)
+        rendered = []
+
+        def _render(kwargs, raiseError=False):
+            rendered.append((flask.request.url_root, flask.request.args.to_dict(),
+                             self.app.user.id))
+            return 'html'
+
+        with self.app.test_request_context('/', base_url='https://emhub.org/hub/'):
+            with mock.patch.object(self.app, 'render_content', _render):
+                self._wait_job(jobs.submit('reports_invoices', params, other))
+        self.assertEqual(rendered, [('https://emhub.org/hub/',
+                                     dict(params, content_id='reports_invoices'),
+                                     other.id)])
@@ -0,0 +1,207 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *
+# * [1] SciLifeLab, Stockholm University
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'delarosatrevin@scilifelab.se'
+# *
+# **************************************************************************
+
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import flask_login
+
+from emhub import create_app
+from emhub.data.imports.test import create_instance
+from emhub.data import DataManager
+from emhub.data.query_log import QueryLog, fingerprint
+from emhub.utils.metrics import Counter, Gauge, Histogram, Metrics
+
+
+class TestMetrics(unittest.TestCase):
+    """ Check metrics collection and the /api/metrics endpoint. """
+    @classmethod
+    def setUpClass(cls):
+        cls.instance_path = tempfile.mkdtemp(prefix='emhub-test-')
+        create_instance(cls.instance_path, None, True)
+        os.environ['EMHUB_INSTANCE'] = cls.instance_path
+        cls.app = create_app({'TESTING': True, 'QUERY_DETECTOR_THRESHOLD': 0,
+                              'EMHUB_METRICS_TOKEN': 'secret',
+                              'EMHUB_SLOW_QUERY': 0.25})
+        cls.dm = cls.app.dm
+
+    @classmethod
+    def tearDownClass(cls):
+        os.environ.pop('EMHUB_INSTANCE', None)
+        shutil.rmtree(cls.instance_path, ignore_errors=True)
+
+    def _login(self, client, username):
+        user = self.dm.get_user_by(username=username)
+        with client.session_transaction() as session:
+            session['_user_id'] = str(user.id)
+        return user
+
+    def test_metrics(self):
+        c = Counter('test_total', 'Test counter', ('name',))
+        c.inc('a')
+        c.inc('a', value=2)
+        c.inc('b"')
+        self.assertEqual(sorted(c.samples()),
+                         [('test_total', 'name="a"', 3),
+                          ('test_total', 'name="b\\""', 1)])
+        g = Gauge('test_gauge', 'Test gauge')
+        g.set(value=5)
+        g.set(value=2)
+        self.assertEqual(list(g.samples()), [('test_gauge', '', 2)])
+
+        h = Histogram('test_seconds', 'Test histogram', buckets=(1, 10))
+        for v in [0.5, 5, 50]:
+            h.observe(value=v)
+        self.assertEqual(list(h.samples()),
+                         [('test_seconds_bucket', 'le="1"', 1),
+                          ('test_seconds_bucket', 'le="10"', 2),
+                          ('test_seconds_bucket', 'le="+Inf"', 3),
+                          ('test_seconds_sum', '', 55.5),
+                          ('test_seconds_count', '', 3)])
+
+        m = Metrics()
+        m.add(c)
+        # Ignored if start_request was not called
+        m.end_request('main', 'GET', 200)
+        self.assertEqual(list(m.requests.samples()), [])
+
+        m.start_request()
+        m.record_sql('SELECT 1', (), 0.1)
+        m.record_sql('SELECT 2', (), 0.2)
+        m.end_request('main', 'GET', 200, size=100, content_id='dashboard')
+        self.assertEqual(list(m.requests.samples()),
+                         [('emhub_requests_total',
+                           'endpoint="main",method="GET",status="200"', 1)])
+        counts = {labels: v for name, labels, v in m.sql_queries.samples()
+                  if name.endswith('_count')}
+        self.assertEqual(counts, {'endpoint="main"': 1})
+        sums = {labels: v for name, labels, v in m.sql_queries.samples()
+                if name.endswith('_sum')}
+        self.assertEqual(sums, {'endpoint="main"': 2})
+
+        text = m.render()
+        self.assertIn('# TYPE emhub_requests_total counter', text)
+        self.assertIn('# TYPE test_total counter', text)
+        self.assertIn('emhub_content_duration_seconds_count{content_id="dashboard"} 1',
+                      text)
+
+    def test_content_labels(self):
+        app = self.app
+        self.assertEqual(app.dc.content_label('dashboard'), 'dashboard')
+        self.assertEqual(app.dc.content_label('booking-calendar'),
+                         'booking-calendar')
+        self.assertEqual(app.dc.content_label('random_123'), 'other')
+        self.assertEqual(app.dc.content_label(None), 'other')
+
+        client = app.test_client()
+        for i in range(5):
+            client.get('/main', query_string={'content_id': f'missing_{i}'})
+
+        labels = {labels for _, labels, _ in app.metrics.content_time.samples()}
+        self.assertFalse(any('missing_' in l for l in labels))
+        self.assertIn('content_id="other"', labels)
+
+    def test_endpoint(self):
+        app = self.app
+
+        with app.test_client() as client:
+            r = client.get('/api/metrics')
+            self.assertEqual(r.status_code, 401)
+            r = client.get('/api/metrics',
+                           headers={'Authorization': 'Bearer wrong'})
+            self.assertEqual(r.status_code, 401)
+            r = client.get('/api/metrics',
+                           headers={'Authorization': 'Bearer secret'})
+            self.assertEqual(r.status_code, 200)
+            self.assertIn(b'# TYPE emhub_requests_total counter', r.data)
+
+        # Users need to be admin
+        with app.test_client() as client:
+            user = next(u for u in self.dm.get_users()
+                        if not u.is_admin and u.is_active)
+            self._login(client, user.username)
+            self.assertEqual(client.get('/api/metrics').status_code, 401)
+
+        with app.test_client() as client:
+            self._login(client, 'admin')
+            r = client.get('/api/metrics')
+            self.assertEqual(r.status_code, 200)
+            self.assertIn(b'emhub_requests_total', r.data)
+
+    def test_query_log(self):
+        app = self.app
+        self.assertEqual(app.dm.query_log.threshold, 0.25)
+        self.assertIsNone(DataManager(self.instance_path).query_log)
+
+        self.assertEqual(fingerprint("SELECT * FROM users WHERE id = 5 "
+                                     "AND name = 'x' AND pi_id IN (1, 2, 3)"),
+                         "SELECT * FROM users WHERE id = ? "
+                         "AND name = ? AND pi_id IN (...)")
+
+        log = QueryLog(threshold=0.5, max_fingerprints=1)
+        with self.assertLogs('emhub.data.query_log', level='WARNING'):
+            log.record('SELECT 1', (), 0.1)
+            log.record('SELECT 2', (), 1.0)
+        log.record('SELECT * FROM users', (), 0.3)  # over max_fingerprints
+        top = log.top()
+        self.assertEqual([(s.fingerprint, s.count, s.slow) for s in top],
+                         [('SELECT ?', 2, 1)])
+        self.assertAlmostEqual(top[0].avg, 0.55)
+        self.assertEqual(top[0].last_slow['elapsed'], 1.0)
+
+        # Returned stats are copies, not modified by new queries
+        log.record('SELECT 3', (), 0.1)
+        self.assertEqual(top[0].count, 2)
+        self.assertEqual(top[0].sources, {'': 2})
+        self.assertEqual(log.top()[0].count, 3)
+        for key in ['foo', 'fingerprint', 'record']:
+            with self.assertRaises(Exception):
+                log.top(key=key)
+        log.reset()
+        self.assertEqual(log.top(), [])
+
+        # Sources in requests are bounded to registered content ids
+        for content_id in ['dashboard', 'missing_1', 'missing_2']:
+            with app.test_request_context('/main',
+                                          query_string={'content_id': content_id}):
+                log.record('SELECT 1', (), 0.1)
+        with app.test_request_context('/api/get_users', method='POST'):
+            log.record('SELECT 1', (), 0.1)
+        self.assertEqual(log.top()[0].sources,
+                         {'content:dashboard': 1, 'content:other': 2,
+                          'endpoint:api.get_users': 1})
+
+        # Content only accepts valid sort keys
+        with app.test_request_context('/'):
+            flask_login.login_user(self.dm.get_user_by(username='admin'))
+            for sort, expected in [('max', 'max'), ('foo', 'total'),
+                                   ('fingerprint', 'total')]:
+                data = app.dc.get(content_id='slow_queries', sort=sort)
+                self.assertEqual(data['sort'], expected)
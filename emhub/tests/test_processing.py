@@ -0,0 +1,669 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *
+# * [1] SciLifeLab, Stockholm University
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'delarosatrevin@scilifelab.se'
+# *
+# **************************************************************************
+
+
+import os
+import time
+import shutil
+import tempfile
+import io
+import json
+import base64
+import sqlite3
+import unittest
+import warnings
+from unittest import mock
+
+import numpy as np
+import flask_login
+from PIL import Image
+from emtools.metadata import StarFile
+
+from emhub import create_app
+from emhub.data.imports.test import create_instance
+from emhub.data.processing import (get_processing_project,
+                                   clear_processing_cache)
+from emhub.data.processing.star_tables import (StarTable, get_star_table,
+                                               clear_star_cache)
+
+
+def write_star(path, tables):
+    """ Write a STAR file from a list of (tableName, columns, rows). """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        for name, columns, rows in tables:
+            f.write(f"\ndata_{name}\n\nloop_\n")
+            for c in columns:
+                f.write(f"_{c}\n")
+            for row in rows:
+                f.write(' '.join(str(v) for v in row) + '\n')
+            f.write('\n')
+
+
+def ctf_rows(first, last):
+    return [(f'MotionCorr/job002/Movies/mic{i:05d}.mrc',
+             f'CtfFind/job003/Movies/mic{i:05d}.ctf:mrc',
+             10000 + i, 11000 + i, 45.0 + i % 10, 100 + i % 7,
+             3.0 + (i % 20) / 10, 0.1, 1)
+            for i in range(first, last)]
+
+
+CTF_COLUMNS = ['rlnMicrographName', 'rlnCtfImage', 'rlnDefocusU',
+               'rlnDefocusV', 'rlnDefocusAngle', 'rlnCtfAstigmatism',
+               'rlnCtfMaxResolution', 'rlnCtfFigureOfMerit', 'rlnOpticsGroup']
+
+
+def create_relion_project(path, n=100):
+    """ Create a minimal Relion project with Import and CtfFind jobs. """
+    write_star(os.path.join(path, 'default_pipeline.star'),
+               [('pipeline_general', ['rlnPipeLineJobCounter'], [[4]])])
+    write_star(os.path.join(path, 'Import', 'job001', 'movies.star'),
+               [('optics', ['rlnOpticsGroup', 'rlnMicrographPixelSize'], [[1, 1.1]]),
+                ('movies', ['rlnMicrographMovieName', 'rlnOpticsGroup'],
+                 [(f'Movies/mic{i:05d}.tiff', 1) for i in range(n)])])
+    write_star(os.path.join(path, 'CtfFind', 'job003', 'micrographs_ctf.star'),
+               [('optics', ['rlnOpticsGroup', 'rlnMicrographPixelSize'], [[1, 1.1]]),
+                ('micrographs', CTF_COLUMNS, ctf_rows(0, n))])
+
+    pick = os.path.join('AutoPick', 'job004')
+    coordFiles = []
+    for i in range(n):
+        coordStar = os.path.join(pick, 'Movies', f'mic{i:05d}_autopick.star')
+        coordFiles.append((f'MotionCorr/job002/Movies/mic{i:05d}.mrc', coordStar))
+        write_star(os.path.join(path, coordStar),
+                   [('', ['rlnCoordinateX', 'rlnCoordinateY',
+                          'rlnAutopickFigureOfMerit'],
+                     [(10.5 * j + i, 20.25 * j, 0.5 + j / 10)
+                      for j in range(1 + i % 5)])])
+    write_star(os.path.join(path, pick, 'autopick.star'),
+               [('coordinate_files', ['rlnMicrographName',
+                                      'rlnMicrographCoordinates'], coordFiles)])
+
+
+class TestProcessing(unittest.TestCase):
+    """ Check processing project readers and their caches using
+    a small synthetic Relion project.
+    """
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='emhub-processing-')
+        create_relion_project(self.path)
+        clear_processing_cache()
+        clear_star_cache()
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def _touch(self, *paths):
+        """ Update modification time (in the future to avoid timestamp
+        resolution problems). """
+        t = time.time() + 10
+        os.utime(os.path.join(self.path, *paths), (t, t))
+
+    def test_readers_cache(self):
+        pp = get_processing_project(self.path)
+        self.assertIs(get_processing_project(self.path), pp)
+        self.assertIsNot(get_processing_project(self.path, cache=False), pp)
+
+        # Changes in the main project files create a new reader
+        self._touch('default_pipeline.star')
+        pp2 = get_processing_project(self.path)
+        self.assertIsNot(pp2, pp)
+        self.assertIs(get_processing_project(self.path), pp2)
+
+        # Also new jobs
+        os.makedirs(os.path.join(self.path, 'CtfFind', 'job004'))
+        self._touch('CtfFind')
+        self.assertIsNot(get_processing_project(self.path), pp2)
+
+    def test_star_tables(self):
+        ctfStar = os.path.join(self.path, 'CtfFind', 'job003', 'micrographs_ctf.star')
+        t = get_star_table(ctfStar, 'micrographs')
+        self.assertIs(get_star_table(ctfStar, 'micrographs'), t)
+
+        with StarFile(ctfStar) as sf:
+            table = sf.getTable('micrographs')
+        self.assertEqual(t.size(), table.size())
+        self.assertEqual(list(t), list(table))
+        self.assertEqual(t[-1], table[-1])
+        self.assertEqual(t.column('rlnDefocusU').tolist(),
+                         table.getColumnValues('rlnDefocusU'))
+
+        # A modified file is parsed again
+        write_star(ctfStar, [('micrographs', CTF_COLUMNS, ctf_rows(0, 101))])
+        self._touch(ctfStar)
+        t2 = get_star_table(ctfStar, 'micrographs')
+        self.assertIsNot(t2, t)
+        self.assertEqual(t2.size(), t.size() + 1)
+
+        # Readers methods give the same result than parsing the files
+        pp = get_processing_project(self.path)
+        mics = list(pp.get_micrographs())
+        self.assertEqual([m['micrograph'] for m in mics],
+                         t2.column('rlnMicrographName').tolist())
+        self.assertEqual(pp.get_stats()['ctfs']['count'], t2.size())
+        coords = pp.get_micrograph_coordinates(
+            os.path.join('AutoPick', 'job004', 'autopick.star'), 3)
+        self.assertEqual(coords, [(round(10.5 * j + 2), round(20.25 * j))
+                                  for j in range(3)])
+
+        # Micrograph without picked particles (only the table header)
+        coordStar = os.path.join(self.path, 'AutoPick', 'job004', 'Movies',
+                                 'mic00004_autopick.star')
+        write_star(coordStar, [('', ['rlnCoordinateX', 'rlnCoordinateY'], [])])
+        self._touch(coordStar)
+        self.assertEqual(get_star_table(coordStar, '').size(), 0)
+        self.assertEqual(pp.get_micrograph_coordinates(
+            os.path.join('AutoPick', 'job004', 'autopick.star'), 5), [])
+
+    def test_star_tail(self):
+        """ Rows appended to a STAR file are parsed without reading
+        the whole file again. """
+        moviesStar = os.path.join(self.path, 'Import', 'job002', 'movies.star')
+        os.makedirs(os.path.dirname(moviesStar))
+
+        def _append(text):
+            with open(moviesStar, 'a') as f:
+                f.write(text)
+            self._touch(moviesStar)
+
+        def _row(i):
+            return f'Movies/mic{i:05d}.tiff 1 {i * 0.5}\n'
+
+        _append("\ndata_movies\n\nloop_\n_rlnMicrographMovieName #1\n"
+                "_rlnOpticsGroup #2\n_rlnAccumMotionTotal #3\n")
+        self.assertEqual(get_star_table(moviesStar, 'movies').size(), 0)
+
+        _append(''.join(_row(i) for i in range(10)))
+        t = get_star_table(moviesStar, 'movies')
+        self.assertEqual(t.size(), 10)
+
+        with mock.patch.object(StarTable, 'load', wraps=StarTable.load) as load:
+            # The incomplete last line is not read until it is finished
+            _append(''.join(_row(i) for i in range(10, 15)) + 'Movies/mic')
+            t2 = get_star_table(moviesStar, 'movies')
+            self.assertEqual(t2.size(), 15)
+            _append(_row(15)[10:])
+            t3 = get_star_table(moviesStar, 'movies')
+            self.assertEqual(t3.size(), 16)
+            load.assert_not_called()
+
+            with StarFile(moviesStar) as sf:
+                table = sf.getTable('movies')
+            self.assertEqual(list(t3), list(table))
+            self.assertEqual(t3.column('rlnAccumMotionTotal').tolist(),
+                             table.getColumnValues('rlnAccumMotionTotal'))
+
+            # A rewritten file is read again
+            write_star(moviesStar, [('movies', CTF_COLUMNS, ctf_rows(0, 20))])
+            self._touch(moviesStar)
+            self.assertEqual(get_star_table(moviesStar, 'movies').size(), 20)
+            load.assert_called_once()
+
+        # A last row without newline is read if it has all the columns
+        os.remove(moviesStar)
+        _append("data_movies\n\nloop_\n_rlnMicrographMovieName #1\n"
+                "_rlnOpticsGroup #2\n_rlnAccumMotionTotal #3\n"
+                + _row(0) + _row(1)[:-2])
+        t = get_star_table(moviesStar, 'movies')
+        with StarFile(moviesStar) as sf:
+            self.assertEqual(list(t), list(sf.getTable('movies')))
+        self.assertEqual(t.column('rlnAccumMotionTotal').tolist(), [0.0, 0.0])
+
+        # and it is read again when the line is finished
+        with mock.patch.object(StarTable, 'load', wraps=StarTable.load) as load:
+            _append('5\n' + _row(2))
+            t = get_star_table(moviesStar, 'movies')
+            self.assertEqual(t.column('rlnAccumMotionTotal').tolist(),
+                             [0.0, 0.5, 1.0])
+            _append(_row(3))
+            self.assertEqual(get_star_table(moviesStar, 'movies').size(), 4)
+            load.assert_not_called()
+
+    def test_ctf_series(self):
+        """ CTF series computed from NumPy columns are the same than
+        iterating over the micrographs. """
+        from emhub.tests.benchmark import legacy_ctf_series
+
+        ctfStar = os.path.join(self.path, 'CtfFind', 'job003', 'micrographs_ctf.star')
+        rows = [(f'MotionCorr/job002/Movies/GridSquare_{i // 40}/Data/'
+                 f'FoilHole_{i}_Data_1_2_3.mrc',) + r[1:]
+                for i, r in enumerate(ctf_rows(0, 100))]
+        write_star(ctfStar, [('optics', ['rlnOpticsGroup', 'rlnMicrographPixelSize'],
+                              [[1, 1.1]]),
+                             ('micrographs', CTF_COLUMNS, rows)])
+        for row in (rows[0], rows[-1]):
+            micFn = os.path.join(self.path, row[0])
+            os.makedirs(os.path.dirname(micFn), exist_ok=True)
+            open(micFn, 'w').close()
+
+        pp = get_processing_project(self.path)
+        series = pp.get_ctf_series()
+        self.assertEqual(series, legacy_ctf_series(pp))
+        self.assertEqual(series['gridsquares'][-1], 'GridSquare_2')
+        self.assertEqual(sum(b[1] for b in series['resolution_bins']), 100)
+
+        packed = pp.get_ctf_series(packed=True)
+        data = base64.b64decode(packed['resolution']['data'])
+        self.assertEqual((np.frombuffer(data, dtype='<i4') / 1000).tolist(),
+                         series['resolution'])
+        gs = packed['gridsquares']
+        self.assertEqual([gs['labels'][i] for i in
+                          np.frombuffer(base64.b64decode(gs['data']), dtype='<i4')],
+                         series['gridsquares'])
+
+    def test_coordinates_index(self):
+        from emhub.data.processing.processing_relion import coords_index
+
+        pick = os.path.join('AutoPick', 'job004')
+        pickStar = os.path.join(self.path, pick, 'autopick.star')
+        pp = get_processing_project(self.path)
+        values = pp.load_coordinates_values(pickStar)
+        indexFn = os.path.join(self.path, pick, coords_index.INDEX_NAME)
+        self.assertTrue(os.path.exists(indexFn))
+        self.assertEqual(values['numberOfParticles']['data'],
+                         [1 + i % 5 for i in range(100)])
+        self.assertAlmostEqual(values['averageFOM']['data'][3], 0.65)
+
+        def _index():
+            coords_index._indexes.clear()
+            return coords_index.get_coordinates_index(self.path, pickStar)
+
+        with mock.patch.object(coords_index, '_file_stats',
+                               wraps=coords_index._file_stats) as stats:
+            # Values are read from the index file
+            index = _index()
+            stats.assert_not_called()
+            self.assertEqual(index['particles'].tolist(),
+                             values['numberOfParticles']['data'])
+            self.assertEqual(index['fom'].tolist(), values['averageFOM']['data'])
+
+            # Only new or modified coordinate files are read
+            with StarFile(pickStar) as sf:
+                rows = list(sf.getTable('coordinate_files'))
+            newStar = os.path.join(pick, 'Movies', 'mic00100_autopick.star')
+            write_star(os.path.join(self.path, newStar),
+                       [('', ['rlnCoordinateX', 'rlnCoordinateY',
+                              'rlnAutopickFigureOfMerit'], [(1, 2, 0.25)])])
+            write_star(pickStar, [('coordinate_files',
+                                   ['rlnMicrographName', 'rlnMicrographCoordinates'],
+                                   rows + [('MotionCorr/job002/Movies/mic00100.mrc',
+                                            newStar)])])
+            self._touch(pickStar)
+            self._touch(rows[0].rlnMicrographCoordinates)
+            index = _index()
+            self.assertEqual(stats.call_count, 2)
+            self.assertEqual(index['particles'].tolist()[-1], 1)
+            self.assertEqual(index['fom'].tolist()[-1], 0.25)
+            self.assertEqual(len(index['file']), 101)
+
+    def test_scipion_coordinates(self):
+        from emhub.data.processing import scipion_coords
+
+        path = os.path.join(self.path, 'scipion')
+        runDir = os.path.join(path, 'Runs', '000123_ProtCryoloPicking')
+        os.makedirs(runDir)
+        open(os.path.join(path, 'project.sqlite'), 'w').close()
+        coordSqlite = os.path.join(runDir, 'coordinates.sqlite')
+
+        def _write(first, last):
+            con = sqlite3.connect(coordSqlite)
+            con.execute("CREATE TABLE IF NOT EXISTS Classes "
+                        "(id INTEGER PRIMARY KEY, label_property TEXT, column_name TEXT)")
+            con.execute("DELETE FROM Classes")
+            con.executemany("INSERT INTO Classes VALUES (?, ?, ?)",
+                            [(1, '_x', 'c01'), (2, '_y', 'c02'), (3, '_micName', 'c03')])
+            con.execute("CREATE TABLE IF NOT EXISTS Objects "
+                        "(id INTEGER PRIMARY KEY, c01 INTEGER, c02 INTEGER, c03 TEXT)")
+            con.executemany("INSERT INTO Objects VALUES (?, ?, ?, ?)",
+                            [(i + 1, i, 2 * i, f'mic{i // 10:03d}')
+                             for i in range(first, last)])
+            con.commit()
+            con.close()
+            self._touch(coordSqlite)
+
+        _write(0, 1000)
+        cacheDir = os.path.join(self.path, 'cache')
+        with mock.patch.object(scipion_coords, 'cache_dir', return_value=cacheDir):
+            scipion_coords.clear_coords_cache()
+            pp = get_processing_project(path)
+            coords = pp.get_micrograph_coordinates('mic005')
+            self.assertEqual(coords, [(i, 2 * i) for i in range(50, 60)])
+            self.assertEqual(len(os.listdir(cacheDir)), 1)
+            self.assertEqual(pp.get_micrograph_coordinates('mic999'), [])
+
+            # New rows are added to the index
+            _write(1000, 1005)
+            self.assertEqual(pp.get_micrograph_coordinates('mic100'),
+                             [(i, 2 * i) for i in range(1000, 1005)])
+
+            # A rewritten set is indexed again
+            os.remove(coordSqlite)
+            _write(0, 5)
+            self.assertEqual(pp.get_micrograph_coordinates('mic000'),
+                             [(i, 2 * i) for i in range(5)])
+            self.assertEqual(pp.get_micrograph_coordinates('mic005'), [])
+
+        # Without a writable cache folder, the set is queried directly
+        with mock.patch.object(scipion_coords, 'cache_dir', return_value='/proc/emhub'):
+            scipion_coords.clear_coords_cache()
+            self.assertEqual(pp.get_micrograph_coordinates('mic000'),
+                             [(i, 2 * i) for i in range(5)])
+
+    def test_thumbnails_cache(self):
+        import mrcfile
+        from emtools.image import Thumbnail
+        from emhub.data.processing import thumbnails
+
+        micFn = os.path.join(self.path, 'mic.mrc')
+        with mrcfile.new(micFn) as mrc:
+            mrc.set_data(np.random.rand(1024, 1024).astype(np.float32))
+
+        cache = thumbnails.ThumbnailCache(os.path.join(self.path, 'thumbs'),
+                                          max_size=1024 * 1024)
+        with mock.patch.object(thumbnails, 'get_thumbnails_cache',
+                               return_value=cache):
+            thumb = Thumbnail.Micrograph()
+            data = thumbnails.from_mrc(thumb, micFn)
+            self.assertEqual(thumb.scale, 2)
+
+            with mock.patch.object(thumbnails, '_create',
+                                   return_value=(1.0, '')) as create:
+                thumb2 = Thumbnail.Micrograph()
+                self.assertEqual(thumbnails.from_mrc(thumb2, micFn), data)
+                self.assertEqual(thumb2.scale, 2)
+                create.assert_not_called()
+
+                # Other parameters or a modified file are not in the cache
+                thumbnails.from_mrc(Thumbnail.Micrograph(max_size=(256, 256)), micFn)
+                self._touch(micFn)
+                thumbnails.from_mrc(Thumbnail.Micrograph(), micFn)
+                self.assertEqual(create.call_count, 2)
+
+            # Large images are reduced before creating the thumbnail
+            thumb = Thumbnail.Micrograph(max_size=(256, 256))
+            with mock.patch.object(Thumbnail, 'from_mrc') as from_mrc:
+                scale, data = thumbnails._create(thumb, micFn)
+                from_mrc.assert_not_called()
+            self.assertEqual(scale, 4)
+            image = Image.open(io.BytesIO(base64.b64decode(data)))
+            self.assertEqual(image.size, (256, 256))
+
+            # Least recently used thumbnails are removed
+            cache.clear()
+            cache.max_size = 3500
+            for i, key in enumerate(['a' * 40, 'b' * 40, 'c' * 40]):
+                cache.put(key, 1.0, 'x' * 1000)
+                t = time.time() - 100 + i
+                os.utime(cache._path(key), (t, t))
+            cache.get('a' * 40)
+            cache.put('d' * 40, 1.0, 'x' * 1000)
+            self.assertEqual([cache.exists(k * 40) for k in 'abcd'],
+                             [True, False, True, True])
+
+            # Thumbnails of new micrographs created in background
+            cache.clear()
+            cache.max_size = 1024 * 1024
+            thumbnails._pregenerated.clear()
+
+            class _SessionData:
+                path = self.path
+                listed = 0
+                error = None
+
+                def get_micrograph_images(self):
+                    self.listed += 1
+                    if self.error:
+                        raise self.error
+                    return [(micFn, None)]
+
+            def _pregenerate(sdata, count):
+                thumbnails.pregenerate(sdata, Thumbnail.Micrograph(),
+                                       Thumbnail.Psd(), count=count)
+                t0 = time.time()
+                while (self.path in thumbnails._pregenerating and
+                       time.time() - t0 < 10):
+                    time.sleep(0.01)
+                self.assertNotIn(self.path, thumbnails._pregenerating)
+
+            sdata = _SessionData()
+            sdata.error = OSError('Missing file')
+            with mock.patch('traceback.print_exc'):
+                _pregenerate(sdata, 1)
+            self.assertEqual(sdata.listed, 1)
+            self.assertIsNone(thumbnails._pregenerated.get(self.path))
+
+            sdata.error = None
+            _pregenerate(sdata, 1)
+            self.assertEqual(sdata.listed, 2)
+            key = thumbnails.ThumbnailCache.key(micFn, Thumbnail.Micrograph())
+            self.assertTrue(cache.exists(key))
+
+            # Images are not listed again until the count changes
+            _pregenerate(sdata, 1)
+            self.assertEqual(sdata.listed, 2)
+            _pregenerate(sdata, 2)
+            self.assertEqual(sdata.listed, 3)
+
+    def test_mrc_reduced(self):
+        import mrcfile
+        from emhub.utils.image import read_mrc_reduced, Base64Converter
+
+        micFn = os.path.join(self.path, 'mic.mrc')
+        data = np.random.rand(1000, 1500).astype(np.float32)
+        with mrcfile.new(micFn) as mrc:
+            mrc.set_data(data)
+
+        # The reduced image is not smaller than max_size
+        reduced, factor = read_mrc_reduced(micFn, (512, 512))
+        self.assertEqual(factor, 2)
+        self.assertEqual(reduced.shape, (500, 750))
+        self.assertAlmostEqual(float(reduced[1, 2]),
+                               float(data[2:4, 4:6].mean()), places=5)
+        self.assertEqual(read_mrc_reduced(micFn, (256, 256))[1], 5)
+        self.assertEqual(read_mrc_reduced(micFn, (2000, 2000))[1], 1)
+        # Reading by small chunks of rows gives the same result
+        chunked, _ = read_mrc_reduced(micFn, (512, 512), chunk_bytes=1)
+        self.assertTrue(np.array_equal(reduced, chunked))
+
+        converter = Base64Converter(max_size=(512, 512))
+        data = base64.b64decode(converter.from_mrc(micFn))
+        self.assertEqual(Image.open(io.BytesIO(data)).size, (512, 341))
+        self.assertAlmostEqual(converter.scale, 1500 / 512)
+
+    def test_volumes(self):
+        import mrcfile
+        from emtools.image import Thumbnail
+        from emhub.data.processing import volumes
+
+        volumes.clear_volumes_cache()
+        volFn = os.path.join(self.path, 'volume.mrc')
+        data = np.random.rand(40, 50, 60).astype(np.float32)
+        with mrcfile.new(volFn) as mrc:
+            mrc.set_data(data)
+
+        stats = volumes.get_volume_stats(volFn)
+        self.assertEqual(stats['dimensions'], [60, 50, 40])
+        self.assertEqual((stats['min'], stats['max']), (data.min(), data.max()))
+
+        with mock.patch.object(volumes, 'SLAB_BYTES', 1):  # One slice per slab
+            array = b''.join(volumes.iter_volume_uint8(volFn))
+        expected = ((data - data.min()) / (data.max() - data.min()) * 255).astype(np.uint8)
+        self.assertEqual(array, expected.tobytes())
+
+        thumb = Thumbnail(max_size=(32, 32), output_format='base64',
+                          min_max=(data.min(), data.max()))
+        slices = volumes.get_volume_slices(volFn, 'y', [3, 7], slice_dim=32)
+        self.assertEqual(list(slices), [3, 7])
+        self.assertEqual(slices[7], thumb.from_array(data[:, 7, :]))
+
+        # Rendered slices are cached
+        with mock.patch.object(Thumbnail, 'from_array') as from_array:
+            self.assertEqual(volumes.get_volume_slices(volFn, 'y', [7], slice_dim=32),
+                             {7: slices[7]})
+            from_array.assert_not_called()
+
+        # Slices indexes from the project can be sent as JSON
+        pp = get_processing_project(self.path)
+        vol = pp.get_volume_data('volume.mrc', volume_data='slices',
+                                 axis='xyz', slice_number=3, slice_dim=32)
+        self.assertEqual(json.loads(json.dumps(vol))['slices']['y'],
+                         {str(i): s for i, s in volumes.get_volume_slices(
+                             volFn, 'y', [12, 25, 38], slice_dim=32).items()})
+
+        # Constant volumes are converted to zeros
+        with mrcfile.new(volFn, overwrite=True) as mrc:
+            mrc.set_data(np.full((4, 5, 6), 3.0, dtype=np.float32))
+        self._touch('volume.mrc')
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            self.assertEqual(b''.join(volumes.iter_volume_uint8(volFn)),
+                             bytes(120))
+            slices = volumes.get_volume_slices(volFn, 'z', [0], slice_dim=32)
+        self.assertEqual(slices[0], Thumbnail(max_size=(32, 32),
+                                              output_format='base64',
+                                              min_max=(3.0, 4.0)).from_array(
+            np.full((5, 6), 3.0, dtype=np.float32)))
+
+
+class TestVolumeEndpoints(unittest.TestCase):
+    """ Check access and input validation of the volume endpoints. """
+    @classmethod
+    def setUpClass(cls):
+        import mrcfile
+
+        cls.instance_path = tempfile.mkdtemp(prefix='emhub-test-')
+        create_instance(cls.instance_path, None, True)
+        os.environ['EMHUB_INSTANCE'] = cls.instance_path
+        cls.app = create_app({'TESTING': True, 'QUERY_DETECTOR_THRESHOLD': 0,
+                              'ADMISSION_MAX_ACTIVE': 2})
+
+        cls.path = tempfile.mkdtemp(prefix='emhub-processing-')
+        create_relion_project(os.path.join(cls.path, 'project'))
+        cls.data = np.random.rand(8, 10, 12).astype(np.float32)
+        for fn in ['project/Refine3D/job010/run_class001.mrc', 'outside.mrc']:
+            fn = os.path.join(cls.path, fn)
+            os.makedirs(os.path.dirname(fn), exist_ok=True)
+            with mrcfile.new(fn) as mrc:
+                mrc.set_data(cls.data)
+
+        with cls.app.test_request_context('/'):
+            dm = cls.app.dm
+            flask_login.login_user(dm.get_user_by(username='admin'))
+            project = dm.get_projects()[0]
+            entry = dm.create_entry(
+                project_id=project.id, type='data_processing', title='Volume',
+                extra={'data': {'project_path': os.path.join(cls.path, 'project')}})
+            cls.entry_id = entry.id
+            cls.no_access = next(u for u in dm.get_users()
+                                 if not (u.can_edit_project(project) or
+                                         u.same_pi(project.user)))
+
+    @classmethod
+    def tearDownClass(cls):
+        os.environ.pop('EMHUB_INSTANCE', None)
+        shutil.rmtree(cls.instance_path, ignore_errors=True)
+        shutil.rmtree(cls.path, ignore_errors=True)
+
+    def setUp(self):
+        self.client = self.app.test_client()
+        self._login('admin')
+
+    def _login(self, username):
+        user = self.app.dm.get_user_by(username=username)
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(user.id)
+
+    def _slices(self, **kwargs):
+        form = dict({'entry_id': self.entry_id,
+                     'file_path': 'Refine3D/job010/run_class001.mrc'}, **kwargs)
+        r = self.client.post('/images/get_volume_slices', data=form)
+        return json.loads(r.data)
+
+    def _array(self, **kwargs):
+        args = dict({'entry_id': self.entry_id,
+                     'file_path': 'Refine3D/job010/run_class001.mrc'}, **kwargs)
+        return self.client.get('/images/get_volume_array', query_string=args,
+                               buffered=False)
+
+    def test_volume_slices(self):
+        result = self._slices(axis='x', start=2, end=100, step=3)
+        self.assertEqual(result['dimensions'], [12, 10, 8])
+        self.assertEqual(sorted(map(int, result['slices'])), [2, 5, 8, 11])
+
+        for kwargs, error in [({'axis': 'w'}, 'Invalid axis'),
+                              ({'step': 0}, 'positive'),
+                              ({'step': -1}, 'positive'),
+                              ({'slice_dim': 0}, 'positive'),
+                              ({'start': 'abc'}, 'invalid literal')]:
+            self.assertIn(error, self._slices(**kwargs)['error'])
+
+    def test_volume_array(self):
+        r = self._array()
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.headers['X-Volume-Dimensions'], '12,10,8')
+        # The admission slot is kept until the data is sent
+        self.assertEqual(self.app.admission._active, 1)
+        data = r.get_data()
+        r.close()
+        self.assertEqual(self.app.admission._active, 0)
+        d = self.data
+        expected = ((d - d.min()) / (d.max() - d.min()) * 255).astype(np.uint8)
+        self.assertEqual(data, expected.tobytes())
+        self.assertEqual(int(r.headers['Content-Length']), len(data))
+
+    def test_invalid_paths(self):
+        outside = os.path.join(self.path, 'outside.mrc')
+        for kwargs in [{'file_path': '../outside.mrc'},
+                       {'file_path': outside},
+                       {'file_path': 'default_pipeline.star'}]:
+            for func in [self._slices, self._array]:
+                r = func(**kwargs)
+                r = r if isinstance(r, dict) else json.loads(r.data)
+                self.assertIn('Invalid volume path', r['error'])
+
+        # Projects are only loaded from entries or sessions
+        for func in [self._slices, self._array]:
+            r = func(entry_id=None, path=os.path.dirname(outside),
+                     file_path='outside.mrc')
+            r = r if isinstance(r, dict) else json.loads(r.data)
+            self.assertIn("Expecting either 'entry_id' or 'session_id'",
+                          r['error'])
+        self.assertEqual(self.app.admission._active, 0)
+
+    def test_access(self):
+        self._login(self.no_access.username)
+        for func in [self._slices, self._array]:
+            r = func()
+            r = r if isinstance(r, dict) else json.loads(r.data)
+            self.assertIn('do not have access', r['error'])
+
+        with self.client.session_transaction() as session:
+            session.clear()
+        r = self.client.get('/images/get_volume_array',
+                            query_string={'entry_id': self.entry_id,
+                                          'file_path': 'Refine3D/job010/run_class001.mrc'})
+        self.assertNotEqual(r.status_code, 200)
+        self.assertNotIn('X-Volume-Dimensions', r.headers)
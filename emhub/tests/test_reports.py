@@ -0,0 +1,508 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *
+# * [1] SciLifeLab, Stockholm University
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'delarosatrevin@scilifelab.se'
+# *
+# **************************************************************************
+
+
+import os
+import shutil
+import tempfile
+import unittest
+import datetime as dt
+from unittest import mock
+from collections import defaultdict
+
+import flask_login
+
+from emhub import create_app
+from emhub.data.imports.test import create_instance
+from emhub.utils import SuffixMap
+from emhub.reports.time_distribution import get_booking_counters
+from .benchmark import synthetic_bookings, legacy_booking_counters
+
+
+class TestReports(unittest.TestCase):
+    """ Check that reports computed from the columnar BookingSnapshot
+    give the same results as iterating over Booking objects.
+    """
+    RANGE = {'start': '2020/01/01', 'end': '2030/01/01'}
+
+    @classmethod
+    def setUpClass(cls):
+        cls.instance_path = tempfile.mkdtemp(prefix='emhub-test-')
+        create_instance(cls.instance_path, None, True)
+        os.environ['EMHUB_INSTANCE'] = cls.instance_path
+        cls.app = create_app({'TESTING': True, 'QUERY_DETECTOR_THRESHOLD': 0})
+
+    @classmethod
+    def tearDownClass(cls):
+        os.environ.pop('EMHUB_INSTANCE', None)
+        shutil.rmtree(cls.instance_path, ignore_errors=True)
+
+    def setUp(self):
+        self.ctx = self.app.test_request_context('/')
+        self.ctx.push()
+        self.dm = self.app.dm
+        flask_login.login_user(self.dm.get_user_by(id=1))
+        self.bookings = self.dm.get_bookings_range(
+            *self.app.dc._range_dates(self.RANGE))
+
+    def tearDown(self):
+        self.ctx.pop()
+
+    def _ids(self, bookings):
+        return [b.id for b in bookings]
+
+    def test_snapshot(self):
+        snap, _ = self.app.dc.get_booking_snapshot(self.RANGE)
+        bookings = self.bookings
+        self.assertGreater(len(bookings), 0)
+        self.assertEqual(snap.id.tolist(), self._ids(bookings))
+        self.assertEqual(snap.days.tolist(), [b.days for b in bookings])
+        self.assertEqual(snap.hours.tolist(), [b.hours for b in bookings])
+        self.assertEqual(snap.units(12).tolist(),
+                         [b.units(hours=12) for b in bookings])
+        self.assertEqual(snap.total_cost.tolist(),
+                         [b.total_cost for b in bookings])
+        self.assertEqual(snap.total_size.tolist(),
+                         [b.total_size for b in bookings])
+        self.assertEqual(snap.pi_id.tolist(),
+                         [b.owner.get_pi().id if b.owner.get_pi() else 0
+                          for b in bookings])
+
+    def test_invoices(self):
+        result = self.app.dc.get(content_id='reports_invoices', **self.RANGE)
+
+        # Reference computation from Booking objects
+        apps_dict = defaultdict(lambda: defaultdict(lambda: [[], 0, 0]))
+        pi_dict = defaultdict(lambda: [[], 0, 0])
+        for b in self.bookings:
+            pi = b.owner.get_pi()
+            if (b.application is None or pi is None or not b.is_booking or
+                    b.resource.daily_cost <= 0 or
+                    pi not in b.application.pi_list):
+                continue
+            for info in [apps_dict[b.application.code][pi.id], pi_dict[pi.id]]:
+                info[0].append(b.id)
+                info[1] += b.total_cost
+                info[2] += b.days
+
+        def _check(info, expected):
+            self.assertEqual((self._ids(info['bookings']), info['sum_cost'],
+                              info['sum_days']), tuple(expected))
+
+        for pi_id, info in result['pi_dict'].items():
+            _check(info, pi_dict.get(pi_id, [[], 0, 0]))
+
+        for code, app_pis in result['apps_dict'].items():
+            for pi_id, info in app_pis.items():
+                _check(info, apps_dict[code].get(pi_id, [[], 0, 0]))
+
+    def _usage_reference(self, metric):
+        """ Compute the microscopes usage entries iterating bookings. """
+        centers = self.dm.get_config('sessions').get('centers', {})
+        pi_apps = {pi.id: app for app in self.dm.get_visible_applications()
+                   if app.is_active for pi in app.pi_list}
+        report_resources = self.dm.get_config('reports')['resources']
+        selected = [r.id for r in self.dm.get_resources()
+                    if r.name in report_resources]
+
+        def _value(b):
+            if metric == 'data':
+                return b.total_size
+            return b.units(hours=12) if metric == 'days' else b.hours
+
+        entries, operators, data_usage = {}, {}, defaultdict(list)
+        for b in self.bookings:
+            if b.is_slot or b.resource_id not in selected:
+                continue
+            v = _value(b)
+            if b.type in ['downtime', 'maintenance', 'special']:
+                key, label = b.type, b.type.capitalize()
+            else:
+                pi = b.project.user.get_pi() if b.project else b.owner.get_pi()
+                if not pi or pi.id not in pi_apps:
+                    continue
+                key, label = str(pi.id), centers.get(pi.email, pi.name)
+                data_usage[b.resource_id].append((b.end.timestamp() * 1000, v))
+                op = b.operator.name if b.operator else 'Unknown'
+                e = operators.setdefault(op, {'days': defaultdict(int),
+                                              'total_days': 0})
+                e['days'][b.resource_id] += 1
+                e['total_days'] += 1
+
+            e = entries.setdefault(key, {'label': label, 'bookings': [],
+                                         'days': defaultdict(int),
+                                         'total_days': 0, 'users': set()})
+            e['bookings'].append(b.id)
+            e['days'][b.resource_id] += v
+            e['total_days'] += v
+            e['users'].add(b.owner.email)
+
+        return entries, operators, data_usage
+
+    def test_microscopes_usage(self):
+        for metric in ['days', 'hours', 'data']:
+            with self.subTest(metric=metric):
+                try:
+                    data = self.app.dc.get(content_id='report_microscopes_usage',
+                                           metric=metric, **self.RANGE)
+                except Exception as e:
+                    self.assertIn("no usage", str(e))
+                    continue
+
+                entries, operators, data_usage = self._usage_reference(metric)
+                result = {e['key']: e for e in data['entries'][1:]}
+                for k in ['downtime', 'maintenance', 'special']:
+                    if k in entries:
+                        result[k] = self.app.dc.get(
+                            content_id='report_microscopes_usage',
+                            metric=metric, key=k, **self.RANGE)['selected_entry']
+
+                self.assertEqual(sorted(result), sorted(entries))
+                for key, e in entries.items():
+                    r = result[key]
+                    self.assertEqual(r['label'], e['label'])
+                    self.assertEqual(self._ids(r['bookings']), e['bookings'])
+                    # Days of other resources are filled with 0 by the report
+                    self.assertEqual({k: v for k, v in r['days'].items() if v},
+                                     {k: v for k, v in e['days'].items() if v})
+                    self.assertEqual(r['total_days'], e['total_days'])
+                    self.assertEqual(r['users'], e['users'])
+
+                self.assertEqual(
+                    {e['key']: (dict(e['days']), e['total_days'])
+                     for e in data['entries_operators']},
+                    {k: (dict(e['days']), e['total_days'])
+                     for k, e in operators.items()})
+
+                for serie in data['data_usage_series']:
+                    rid = data['resources'][[r['name'] for r in data['resources']].index(serie['name'])]['id']
+                    self.assertEqual(serie['data'], sorted(data_usage[rid],
+                                                           key=lambda i: i[0]))
+
+    def test_memoized_content(self):
+        dc = self.app.dc
+        kwargs = dict(self.RANGE, metric='days')
+        statements = []
+
+        def _listener(statement, parameters, elapsed):
+            if 'FROM sessions' in statement:
+                statements.append(statement)
+
+        self.dm.add_query_listener(_listener)
+        try:
+            overview = dc.get(content_id='report_projects_overview', **kwargs)
+            usage = dc.get(content_id='report_microscopes_usage_content', **kwargs)
+            entrylist = dc.get(content_id='report_microscopes_usage_entrylist',
+                               **kwargs)
+        finally:
+            self.dm.remove_query_listener(_listener)
+
+        # Base datasets are computed only once in the request
+        self.assertIs(usage['entries'], overview['entries'])
+        self.assertIs(entrylist['entries'], overview['entries'])
+        self.assertNotIn('sessions', usage)
+        # Session objects (not the snapshot columns) are loaded once
+        sessions_queries = [s for s in statements
+                            if s.lstrip().startswith('SELECT sessions.id')
+                            and 'sessions.name' in s and 'WHERE' not in s]
+        self.assertEqual(len(sessions_queries), 1)
+
+        # Cached values are discarded after changes in the database
+        self.dm.commit()
+        usage2 = dc.get(content_id='report_microscopes_usage_content', **kwargs)
+        self.assertIsNot(usage2['entries'], overview['entries'])
+        self.assertEqual(usage2['total_usage'], overview['total_usage'])
+
+    def _invoices_reference(self, pi):
+        """ Entries and running balances iterating all bookings. """
+        dm, dc = self.dm, self.app.dc
+        entries = [(b.start, b.id, 'booking', b.total_cost)
+                   for b in dm.get_bookings()
+                   if (b.resource.daily_cost > 0 and b.start <= dm.now() and
+                       b.is_booking and b.owner.get_pi() == pi)]
+        entries.extend((t.date, t.id, 'transaction', t.amount)
+                       for t in dm.get_transactions() if t.user == pi)
+        periods = dc.get(content_id='invoice_periods_list')['invoice_periods']
+        entries.extend((ip['end'], ip['id'], 'summary', 0)
+                       for ip in periods if ip['order'] > 0)
+        entries.sort(key=lambda e: e[0])
+        result, total = [], 0
+        for date, eid, etype, amount in entries:
+            if etype == 'summary':
+                amount = total
+                if total > 0:
+                    total = 0
+            else:
+                total += amount
+            result.append((eid, etype, amount))
+        return result, total
+
+    def test_invoices_per_pi(self):
+        dm, dc = self.dm, self.app.dc
+        pis = [u for u in dm.get_users() if u.is_pi]
+        period = dm.get_invoice_periods()[0]
+        dm.create_transaction(user_id=pis[0].id, amount=-5000, comment='Paid',
+                              date=period.start + (period.end - period.start) / 2)
+
+        def _check():
+            for pi in pis:
+                data = dc.get(content_id='invoices_per_pi', pi_id=pi.id)
+                self.assertEqual(([(e['id'], e['type'], e['amount'])
+                                   for e in data['entries']], data['total']),
+                                 self._invoices_reference(pi))
+
+        def _summary(pi, period):
+            return next(amount for eid, etype, amount
+                        in self._invoices_reference(pi)[0]
+                        if etype == 'summary' and eid == period.id)
+
+        _check()
+        # Split the period in three, the middle one is not closed
+        start, end = period.start, period.end
+        step = (end - start) / 3
+        dm.update_invoice_period(id=period.id, end=start + step)
+        middle = dm.create_invoice_period(start=start + step,
+                                          end=start + 2 * step, status='active')
+        last = dm.create_invoice_period(start=start + 2 * step, end=end,
+                                        status='active')
+        first = period
+        dm.update_invoice_period(id=first.id, status='closed')
+        balances = dm.get_invoice_period_by(id=first.id).extra['balances']
+        self.assertTrue(any(v > 0 for v in balances.values()))
+        _check()
+
+        # Later periods start from the balances stored in the previous
+        # closed period, that are not modified
+        with mock.patch.object(dm, 'get_invoice_balances',
+                               wraps=dm.get_invoice_balances) as get_balances:
+            dm.update_invoice_period(id=last.id, status='closed')
+            get_balances.assert_called_once_with(last)
+        self.assertEqual(dm.get_invoice_period_by(id=first.id).extra['balances'],
+                         balances)
+        stored = dict(dm.get_invoice_period_by(id=last.id).extra['balances'])
+        for pi in pis:
+            for p in [first, last]:
+                self.assertEqual(
+                    dm.get_invoice_period_by(id=p.id).extra['balances'].get(
+                        str(pi.id), 0), _summary(pi, p))
+        _check()
+
+        # Stored balances are not computed again until the period is reopened
+        with mock.patch.object(dm, 'get_invoice_balances') as get_balances:
+            dm.update_invoice_period(id=last.id, status='closed')
+            get_balances.assert_not_called()
+        self.assertEqual(dm.get_invoice_period_by(id=last.id).extra['balances'],
+                         stored)
+
+        dm.update_invoice_period(id=first.id, status='active', end=end)
+        self.assertNotIn('balances', dm.get_invoice_period_by(id=first.id).extra)
+        for p in [middle, last]:
+            dm.delete_invoice_period(id=p.id)
+
+    def test_booking_counters(self):
+        bookings = synthetic_bookings(2000)
+        for old, new in zip(legacy_booking_counters(bookings),
+                            get_booking_counters(bookings)):
+            self.assertEqual(old.data(), new.data())
+            for c in old._counters:
+                self.assertEqual(new[c._name].bookings, c.bookings)
+            self.assertEqual(new.reminder, old.reminder)
+
+    def test_export(self):
+        import io
+        import csv
+        import zipfile
+        from emhub.utils.export import export_chunks
+
+        dc = self.app.dc
+        header, rows = dc.get_export(export_id='bookings', **self.RANGE)
+        rows = list(rows)
+        self.assertEqual([r[0] for r in rows], self._ids(self.bookings))
+
+        data = b''.join(export_chunks('csv', header, rows, chunk_size=7))
+        lines = list(csv.reader(io.StringIO(data.decode('utf-8'))))
+        self.assertEqual(lines[0], header)
+        self.assertEqual(len(lines), len(rows) + 1)
+
+        data = b''.join(export_chunks('xlsx', header, rows, chunk_size=7))
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            self.assertIsNone(zf.testzip())
+            sheet = zf.read('xl/worksheets/sheet1.xml').decode('utf-8')
+            self.assertEqual(sheet.count('<row>'), len(rows) + 1)
+
+        for export_id in ['reports_invoices', 'report_microscopes_usage']:
+            header, rows = dc.get_export(export_id=export_id, **self.RANGE)
+            for row in rows:
+                self.assertEqual(len(row), len(header))
+
+        # Related objects of bookings are not queried for each booking
+        statements = []
+
+        def _listener(statement, parameters, elapsed):
+            if statement.lstrip().startswith('SELECT'):
+                statements.append(statement)
+
+        invoices = dc.get(content_id='reports_invoices', **self.RANGE)
+        expected = [(code, b.id, b.owner.name, b.total_cost)
+                    for code, pi_dict in invoices['apps_dict'].items()
+                    for pi_info in pi_dict.values()
+                    for b in pi_info['bookings']]
+        self.assertGreater(len(expected), 0)
+        ids = [b.id for b in self.dm.iter_bookings_range(
+            *dc._range_dates(invoices))]
+        self.dm._db_session.expunge_all()
+
+        self.dm.add_query_listener(_listener)
+        try:
+            for export_id in ['bookings', 'reports_invoices']:
+                statements.clear()
+                header, rows = dc.get_export(export_id=export_id, **self.RANGE)
+                rows = list(rows)
+                self.assertLess(len(statements), 20, export_id)
+        finally:
+            self.dm.remove_query_listener(_listener)
+
+        # Rows are in the order of the bookings range
+        self.assertEqual([(r[0], r[3], r[9], r[-1]) for r in rows],
+                         sorted(expected, key=lambda e: ids.index(e[1])))
+
+        with self.assertRaises(Exception):
+            dc.get_export(export_id='missing')
+
+    def test_booking_events(self):
+        from emhub.tests.benchmark import legacy_booking_to_event
+
+        dc = self.app.dc
+        users = self.dm.get_users()
+        # Managers, PIs and some lab members see different titles
+        users = ([u for u in users if u.is_manager or u.is_pi] +
+                 [u for u in users if not (u.is_manager or u.is_pi)][:5])
+        for user in users:
+            flask_login.login_user(user)
+            for kwargs in [{}, {'prettyDate': True, 'piApp': True}]:
+                events = [legacy_booking_to_event(dc, b, **kwargs)
+                          for b in self.bookings]
+                self.assertEqual(dc.bookings_to_events(self.bookings, **kwargs),
+                                 events)
+                self.assertEqual([dc.booking_to_event(b, **kwargs)
+                                  for b in self.bookings], events)
+
+    def test_sessions_distribution(self):
+        dc = self.app.dc
+        data = dc.get(content_id='report_sessions_distribution_content',
+                      **self.RANGE)
+
+        # Reference computation from Session objects
+        monthly = {}
+        images = []
+        for s in self.dm.get_sessions():
+            b = s.booking
+            if (s.resource_id not in data['selected_resources'] or
+                    s.total_movies <= 0 or b is None or
+                    b.start < data['start_date'] or b.end > data['end_date']):
+                continue
+            m = monthly.setdefault(s.start.strftime('%Y-%m-01'), [0, 0, 0])
+            m[0] += 1
+            m[1] += s.total_size
+            m[2] += s.total_movies
+            images.append(s.total_movies)
+
+        self.assertGreater(len(images), 0)
+        self.assertEqual(data['sessions_images'], images)
+        self.assertEqual(data['sessions_monthly'],
+                         [(k, *v) for k, v in monthly.items()])
+        self.assertEqual(data['avg_images'], sum(images) // len(images))
+
+        # The snapshot is cached until there are changes in the database
+        snap = dc.get_session_snapshot()
+        self.assertIs(dc.get_session_snapshot(), snap)
+        self.dm.commit()
+        self.assertIsNot(dc.get_session_snapshot(), snap)
+
+    def test_pis_usage(self):
+        dm, dc = self.dm, self.app.dc
+        params = [{'value': 'emhub.org', 'label': 'EMhub University'},
+                  {'value': 'lab.emhub.org', 'label': 'EMhub Lab'},
+                  {'value': 'su.se', 'label': 'Stockholm University'}]
+        univ_dict = {p['value']: p['label'] for p in params}
+
+        def _get_univ(email):
+            for k, v in univ_dict.items():
+                if email.endswith(k):
+                    return v
+            return 'z-Unknown'
+
+        univ_map = SuffixMap(univ_dict.items())
+        for email in ['a@emhub.org', 'b@lab.emhub.org', 'c@dbb.su.se',
+                      'd@bsu.se', 'e@kth.se', '']:
+            self.assertEqual(univ_map.get(email, 'z-Unknown'), _get_univ(email))
+
+        form = dm.create_form(name='universities', definition={'params': params})
+        try:
+            data = dc.get(content_id='report_pis_usage', **self.RANGE)
+            self.assertGreater(len(data['pi_list']), 0)
+            for e in data['pi_list']:
+                self.assertEqual(e['university'], _get_univ(e['email']))
+        finally:
+            dm.delete_form(id=form.id)
+
+        # Same values than counting every booking in the range, when whole
+        # months are read from the usage aggregates
+        def _in_range(range_dict):
+            start, end = dc._range_dates(range_dict)
+            start = dm.date(start.date())
+            end = dm.date(end.date()) + dt.timedelta(days=1)
+            return [b for b in dm.get_bookings()
+                    if start <= b.start <= end or start <= b.end <= end or
+                    (b.start <= start and b.end >= end)]
+
+        def _reference(range_dict):
+            pi_dict = {}
+            for b in _in_range(range_dict):
+                pi = b.owner.get_pi()
+                if b.resource.daily_cost > 0 and not b.is_slot and pi:
+                    e = pi_dict.setdefault(pi.email, [0, 0, set()])
+                    e[0] += 1
+                    e[1] += b.days
+                    e[2].add(b.owner.email)
+            return pi_dict
+
+        self.assertTrue(dm.usage_aggregates.tracking)
+        for start, end in [('2020/01/01', '2030/01/01'),
+                           ('2026/08/15', '2026/10/20'),
+                           ('2026/09/01', '2026/09/30'),
+                           ('2026/09/03', '2026/09/20')]:
+            range_dict = {'start': start, 'end': end}
+            data = dc.get(content_id='report_pis_usage', **range_dict)
+            self.assertEqual({e['email']: [e['bookings'], e['days'], e['users']]
+                              for e in data['pi_list']}, _reference(range_dict))
+
+            aggregates, _, bookings = dm.get_usage_range(
+                *dc._range_dates(range_dict))
+            self.assertEqual(sum(a.bookings for a in aggregates) + len(bookings),
+                             len(_in_range(range_dict)))
+            if start == '2020/01/01':  # Only whole months
+                self.assertEqual(bookings, [])
@@ -0,0 +1,221 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *
+# * [1] SciLifeLab, Stockholm University
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'delarosatrevin@scilifelab.se'
+# *
+# **************************************************************************
+
+
+
+import os
+import json
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from emhub import create_app
+from emhub.data.imports.test import create_instance
+from emhub.data.task_waiter import TaskWaiter
+
+
+class FakeRedis:
+    """ Minimal in-memory implementation of the Redis stream commands
+    used by the TaskWaiter. """
+    def __init__(self):
+        self.streams = {}
+        self.count = 0
+        self.reads = 0
+        self._cond = threading.Condition()
+
+    def xadd(self, stream, fields):
+        with self._cond:
+            self.count += 1
+            entry_id = f'{self.count}-0'
+            self.streams.setdefault(stream, []).append((entry_id, fields))
+            self._cond.notify_all()
+            return entry_id
+
+    def xrevrange(self, stream, count=1):
+        with self._cond:
+            return list(reversed(self.streams.get(stream, [])))[:count]
+
+    def _new_entries(self, streams):
+        def _seq(entry_id):
+            return int(entry_id.split('-')[0])
+
+        results = []
+        for stream, last_id in streams.items():
+            entries = [e for e in self.streams.get(stream, [])
+                       if _seq(e[0]) > _seq(last_id)]
+            if entries:
+                results.append((stream, entries))
+        return results
+
+    def xread(self, streams, block=0):
+        deadline = time.time() + block / 1000
+        with self._cond:
+            self.reads += 1
+            while not (results := self._new_entries(streams)):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return results
+
+
+class TestTaskWaiter(unittest.TestCase):
+    def test_wait_for(self):
+        r = FakeRedis()
+        r.xadd('w1:tasks', {'name': 'old'})
+        waiter = TaskWaiter(r, block=100)
+        self.assertEqual(waiter.waiting, 0)
+
+        with waiter.wait_for('w1:tasks') as e1, \
+                waiter.wait_for('w1:tasks') as e1b, \
+                waiter.wait_for('w2:tasks') as e2:
+            self.assertEqual(waiter.waiting, 3)
+            # Entries added before registration do not wake up waiters
+            self.assertFalse(e1.wait(0.3))
+            r.xadd('w1:tasks', {'name': 'new'})
+            self.assertTrue(e1.wait(2))
+            self.assertTrue(e1b.wait(2))
+            self.assertFalse(e2.is_set())
+
+        self.assertEqual(waiter.waiting, 0)
+        self.assertEqual(waiter._streams, {})
+
+        # The reader thread is idle when nobody is waiting
+        time.sleep(0.3)
+        reads = r.reads
+        time.sleep(0.3)
+        self.assertEqual(r.reads, reads)
+
+        with waiter.wait_for('w2:tasks') as e2:
+            self.assertFalse(e2.is_set())
+            r.xadd('w2:tasks', {'name': 'new'})
+            self.assertTrue(e2.wait(2))
+
+    def test_redis_errors(self):
+        r = FakeRedis()
+        xread = r.xread
+        errors = []
+
+        def _xread(streams, block=0):
+            if not errors:
+                errors.append(1)
+                raise Exception("Connection error")
+            return xread(streams, block)
+
+        r.xread = _xread
+        waiter = TaskWaiter(r, block=100)
+        with mock.patch('traceback.print_exc'):
+            with waiter.wait_for('w1:tasks') as event:
+                time.sleep(0.2)
+                r.xadd('w1:tasks', {'name': 'new'})
+                self.assertTrue(event.wait(2))
+        self.assertEqual(errors, [1])
+
+
+class FakeWorkerStream:
+    def __init__(self, tasks):
+        self.tasks = list(tasks)
+        self.timeouts = []
+
+    def get_new_tasks(self, timeout=0):
+        self.timeouts.append(timeout)
+        if self.tasks:
+            return [self.tasks.pop(0)]
+        time.sleep(0.05)  # wait for timeout, shortened
+        return []
+
+
+class TestTasksApi(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.instance_path = tempfile.mkdtemp(prefix='emhub-test-')
+        create_instance(cls.instance_path, None, True)
+        os.environ['EMHUB_INSTANCE'] = cls.instance_path
+        cls.app = create_app({'TESTING': True, 'QUERY_DETECTOR_THRESHOLD': 0,
+                              'TASKS_WAIT_TIMEOUT': 30,
+                              'TASKS_STREAM_TIMEOUT': 0.5})
+
+    @classmethod
+    def tearDownClass(cls):
+        os.environ.pop('EMHUB_INSTANCE', None)
+        shutil.rmtree(cls.instance_path, ignore_errors=True)
+
+    def _post(self, client, method, **attrs):
+        from emhub.blueprints.api import get_worker_token
+
+        with self.app.app_context():
+            attrs['token'] = get_worker_token('worker1')
+        return client.post(f'/api/{method}', json={'attrs': attrs})
+
+    def test_tasks_timeout(self):
+        from emhub.blueprints.api import _tasks_timeout
+
+        with self.app.app_context():
+            for attrs, expected in [({}, 30), ({'timeout': 5}, 5),
+                                    ({'timeout': 2.5}, 2.5),
+                                    ({'timeout': 1000}, 30),
+                                    ({'timeout': float('inf')}, 30),
+                                    ({'timeout': 0}, 1),
+                                    ({'timeout': -10}, 1)]:
+                self.assertEqual(_tasks_timeout(attrs), expected)
+
+            for timeout in ['5', None, True, [1], float('nan')]:
+                with self.assertRaises(Exception):
+                    _tasks_timeout({'timeout': timeout})
+
+    def test_get_new_tasks(self):
+        ws = FakeWorkerStream([])
+        client = self.app.test_client()
+        with mock.patch.object(self.app.dm, 'get_worker_stream',
+                               return_value=ws):
+            r = self._post(client, 'get_new_tasks', timeout=0)
+            self.assertEqual(json.loads(r.data), {'tasks': []})
+            r = self._post(client, 'get_new_tasks', timeout='abc')
+            self.assertIn('Invalid timeout', json.loads(r.data)['error'])
+        self.assertEqual(ws.timeouts, [1.0])
+
+    def test_stream_new_tasks(self):
+        task = {'id': '1-0', 'name': 'command', 'args': {}}
+        ws = FakeWorkerStream([task])
+        client = self.app.test_client()
+        with mock.patch.object(self.app.dm, 'get_worker_stream',
+                               return_value=ws):
+            r = self._post(client, 'stream_new_tasks', timeout=-1)
+            self.assertEqual(r.mimetype, 'text/event-stream')
+            events = r.get_data(as_text=True).split('\n\n')
+
+            r = self._post(client, 'stream_new_tasks', timeout=[])
+            self.assertIn('Invalid timeout', json.loads(r.data)['error'])
+
+        self.assertEqual(events[0], f"data: {json.dumps({'tasks': [task]})}")
+        self.assertTrue(all(e == ': keep-alive' for e in events[1:-1]))
+        # The minimum timeout is used and the stream is closed after
+        # TASKS_STREAM_TIMEOUT, not polling in a busy loop
+        self.assertEqual(set(ws.timeouts), {1.0})
+        self.assertLess(len(ws.timeouts), 20)
@@ -24,11 +24,9 @@
 # *
 # **************************************************************************
 
+import sys
 import json
 import datetime as dt
-import numpy as np
-
-from . import image
 
 
 def pretty_json(d):
@@ -118,14 +116,38 @@ def pairname(user):
         return shortname(user)
 
 
+class SuffixMap:
+    """ Map strings (e.g. emails) to values by the first key (in the
+    given order) that is a suffix of the string. Same result as testing
+    endswith for each key, but only looking up the string suffixes.
+    """
+    def __init__(self, items):
+        self._keys = {}
+        for i, (k, v) in enumerate(items):
+            if k not in self._keys:
+                self._keys[k] = (i, v)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def get(self, s, default=None):
+        keys = self._keys
+        found = [keys[s[i:]] for i in range(len(s) + 1) if s[i:] in keys]
+        return min(found)[1] if found else default
+
+
 class NpJsonEncoder(json.JSONEncoder):
     def default(self, obj):
-        if isinstance(obj, np.integer):
-            return int(obj)
-        if isinstance(obj, np.floating):
-            return float(obj)
-        if isinstance(obj, np.ndarray):
-            return obj.tolist()
+        # Numpy is not imported here to keep this module lightweight,
+        # if it has not been loaded, obj can not be a numpy type
+        np = sys.modules.get('numpy', None)
+        if np is not None:
+            if isinstance(obj, np.integer):
+                return int(obj)
+            if isinstance(obj, np.floating):
+                return float(obj)
+            if isinstance(obj, np.ndarray):
+                return obj.tolist()
         return super(NpJsonEncoder, self).default(obj)
 
 
@@ -0,0 +1,173 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *
+# * [1] SciLifeLab, Stockholm University
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'delarosatrevin@scilifelab.se'
+# *
+# **************************************************************************
+
+import json
+import time
+import functools
+import threading
+from collections import OrderedDict, deque
+
+
+class AdmissionController:
+    """ Limit the number of heavy requests running at the same time.
+
+    Requests over the limit wait in per-user queues that are served in
+    round-robin, so a single user opening many images can not starve the
+    others. Requests are rejected if the queue is full or if they waited
+    more than max_wait seconds.
+    """
+    def __init__(self, max_active=4, max_queue=32, max_wait=10, metrics=None):
+        self.max_active = max_active
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self._active = 0
+        self._queued = 0
+        self._queues = OrderedDict()  # user -> deque of tickets
+        self._cond = threading.Condition()
+        self._metrics = None
+
+        if metrics is not None:
+            from .metrics import Gauge, Counter, Histogram
+            self._metrics = {
+                'active': metrics.add(Gauge(
+                    'emhub_admission_active', 'Heavy requests running')),
+                'queued': metrics.add(Gauge(
+                    'emhub_admission_queue_depth', 'Heavy requests waiting')),
+                'wait': metrics.add(Histogram(
+                    'emhub_admission_wait_seconds', 'Wait time of heavy requests')),
+                'rejected': metrics.add(Counter(
+                    'emhub_admission_rejected_total', 'Rejected heavy requests'))
+            }
+
+    def _update_metrics(self):
+        if self._metrics:
+            self._metrics['active'].set(value=self._active)
+            self._metrics['queued'].set(value=self._queued)
+
+    def _next_ticket(self):
+        for queue in self._queues.values():
+            return queue[0]
+        return None
+
+    def _dequeue(self, user, ticket):
+        queue = self._queues[user]
+        queue.remove(ticket)
+        self._queued -= 1
+        if queue:
+            # Move the user to the end for round-robin between users
+            self._queues.move_to_end(user)
+        else:
+            del self._queues[user]
+
+    def acquire(self, user):
+        """ Return True when the request can run (release should be
+        called later) or False if it has been rejected. """
+        start = time.time()
+        with self._cond:
+            try:
+                if self._active < self.max_active and not self._queued:
+                    self._active += 1
+                    return True
+
+                if self._queued >= self.max_queue:
+                    self._reject()
+                    return False
+
+                ticket = object()
+                self._queues.setdefault(user, deque()).append(ticket)
+                self._queued += 1
+                self._update_metrics()
+
+                while True:
+                    if (self._active < self.max_active and
+                            self._next_ticket() is ticket):
+                        self._dequeue(user, ticket)
+                        self._active += 1
+                        self._cond.notify_all()
+                        return True
+
+                    remaining = start + self.max_wait - time.time()
+                    if remaining <= 0:
+                        self._dequeue(user, ticket)
+                        self._cond.notify_all()
+                        self._reject()
+                        return False
+
+                    self._cond.wait(remaining)
+            finally:
+                self._update_metrics()
+                if self._metrics:
+                    self._metrics['wait'].observe(value=time.time() - start)
+
+    def _reject(self):
+        if self._metrics:
+            self._metrics['rejected'].inc()
+
+    def release(self):
+        with self._cond:
+            self._active -= 1
+            self._update_metrics()
+            self._cond.notify_all()
+
+
+def admission_control(func):
+    """ Decorator for heavy endpoints that should go through the
+    app AdmissionController (if any). Rejected requests get a
+    503 response with a Retry-After header. For streamed responses,
+    the slot is released when the response is closed, after the body
+    has been sent.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        import flask
+        import flask_login
+
+        app = flask.current_app
+        controller = getattr(app, 'admission', None)
+        if controller is None:
+            return func(*args, **kwargs)
+
+        user = flask_login.current_user
+        user_key = user.id if user.is_authenticated else flask.request.remote_addr
+
+        if not controller.acquire(user_key):
+            retry = app.config.get('ADMISSION_RETRY_AFTER', 5)
+            return flask.Response(
+                json.dumps({'error': 'Server is busy, please try again later.'}),
+                status=503, mimetype='application/json',
+                headers={'Retry-After': str(retry)})
+        streamed = False
+        try:
+            response = func(*args, **kwargs)
+            if isinstance(response, flask.Response) and response.is_streamed:
+                response.call_on_close(controller.release)
+                streamed = True
+            return response
+        finally:
+            if not streamed:
+                controller.release()
+
+    return wrapper
@@ -0,0 +1,120 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *
+# * [1] SciLifeLab, Stockholm University
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'delarosatrevin@scilifelab.se'
+# *
+# **************************************************************************
+
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """ Thread-safe Least-Recently-Used cache.
+
+    Entries are evicted when the number of items is greater than
+    ``max_items`` or when the sum of the entries size is greater
+    than ``max_size``. The size of each entry is computed with the
+    ``sizeof`` function (1 per item if not provided).
+    """
+    def __init__(self, max_items=128, max_size=None, sizeof=None):
+        self.max_items = max_items
+        self.max_size = max_size
+        self._sizeof = sizeof or (lambda v: 1)
+        self._items = OrderedDict()
+        self._sizes = {}
+        self._size = 0
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    @property
+    def size(self):
+        return self._size
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return self._items[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self._lock:
+            self._remove(key)
+            size = self._sizeof(value)
+            if self.max_size is not None and size > self.max_size:
+                return  # Do not store items bigger than the whole cache
+            self._items[key] = value
+            self._sizes[key] = size
+            self._size += size
+            self._evict()
+
+    def pop(self, key, default=None):
+        with self._lock:
+            value = self._items.get(key, default)
+            self._remove(key)
+            return value
+
+    def get_or_create(self, key, createFunc):
+        """ Return the value for this key or create it (and store it)
+        by calling createFunc. """
+        value = self.get(key, self)
+        if value is self:
+            value = createFunc()
+            self.put(key, value)
+        return value
+
+    def remove_if(self, predicate):
+        """ Remove all entries whose key matches the predicate. """
+        with self._lock:
+            for key in [k for k in self._items if predicate(k)]:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._sizes.clear()
+            self._size = 0
+
+    def _remove(self, key):
+        if key in self._items:
+            del self._items[key]
+            self._size -= self._sizes.pop(key)
+
+    def _evict(self):
+        def _exceeded():
+            if self.max_items is not None and len(self._items) > self.max_items:
+                return True
+            return self.max_size is not None and self._size > self.max_size
+
+        while self._items and _exceeded():
+            key, _ = self._items.popitem(last=False)
+            self._size -= self._sizes.pop(key)
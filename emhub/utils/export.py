@@ -0,0 +1,160 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *
+# * [1] SciLifeLab, Stockholm University
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'delarosatrevin@scilifelab.se'
+# *
+# **************************************************************************
+
+"""
+Incremental writers to export tabular data (CSV and XLSX) as a stream
+of bytes chunks, keeping only one chunk of rows in memory.
+"""
+
+import io
+import csv
+import zipfile
+import datetime as dt
+from xml.sax.saxutils import escape
+
+
+FORMATS = {
+    'csv': 'text/csv',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+}
+
+
+class _ChunkBuffer(io.RawIOBase):
+    """ Write-only stream that keeps written bytes until drained. """
+    def __init__(self):
+        self._chunks = []
+        self._pos = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        self._pos += len(b)
+        return len(b)
+
+    def tell(self):
+        return self._pos
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _value(v):
+    if hasattr(v, 'item'):  # numpy scalars
+        v = v.item()
+    if isinstance(v, dt.datetime):
+        return v.strftime('%Y-%m-%d %H:%M')
+    return '' if v is None else v
+
+
+def csv_chunks(header, rows, chunk_size=500):
+    """ Generate CSV content (utf-8 bytes) every chunk_size rows. """
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(header)
+    for i, row in enumerate(rows, 1):
+        writer.writerow([_value(v) for v in row])
+        if i % chunk_size == 0:
+            yield out.getvalue().encode('utf-8')
+            out.seek(0)
+            out.truncate()
+    yield out.getvalue().encode('utf-8')
+
+
+_XLSX_FILES = {
+    '[Content_Types].xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'),
+    '_rels/.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>'),
+    'xl/_rels/workbook.xml.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+        '</Relationships>'),
+    'xl/workbook.xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="{sheet}" sheetId="1" r:id="rId1"/></sheets>'
+        '</workbook>'),
+}
+
+
+def _xlsx_row(row):
+    cells = []
+    for v in row:
+        v = _value(v)
+        if isinstance(v, bool) or not isinstance(v, (int, float)):
+            cells.append('<c t="inlineStr"><is><t>%s</t></is></c>' % escape(str(v)))
+        else:
+            cells.append('<c><v>%s</v></c>' % v)
+    return '<row>%s</row>' % ''.join(cells)
+
+
+def xlsx_chunks(header, rows, chunk_size=500, sheet='Sheet1'):
+    """ Generate a XLSX file (single sheet, inline strings) every
+    chunk_size rows, without requiring any external library. """
+    buffer = _ChunkBuffer()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name, content in _XLSX_FILES.items():
+            zf.writestr(name, content.replace('{sheet}', escape(sheet)))
+        yield buffer.drain()
+
+        with zf.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as f:
+            f.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                    b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+                    b'<sheetData>')
+            f.write(_xlsx_row(header).encode('utf-8'))
+            for i, row in enumerate(rows, 1):
+                f.write(_xlsx_row(row).encode('utf-8'))
+                if i % chunk_size == 0:
+                    yield buffer.drain()
+            f.write(b'</sheetData></worksheet>')
+    yield buffer.drain()
+
+
+def export_chunks(fmt, header, rows, chunk_size=500):
+    """ Return the chunks generator for the given format (csv or xlsx). """
+    if fmt not in FORMATS:
+        raise Exception(f"Invalid export format '{fmt}', "
+                        f"expected one of: {', '.join(FORMATS)}")
+    func = csv_chunks if fmt == 'csv' else xlsx_chunks
+    return func(header, rows, chunk_size=chunk_size)
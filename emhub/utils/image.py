@@ -32,10 +32,47 @@ import mrcfile
 from PIL import Image, ImageEnhance, ImageOps
 
 
+def read_mrc_reduced(mrc_path, max_size=None, chunk_bytes=16 * 1024 * 1024):
+    """ Read the image (or first slice) of an MRC file, averaging blocks
+    of pixels to reduce it close to max_size (keeping the aspect ratio).
+    The reduced image is never smaller than max_size, since PIL thumbnail
+    (used for the final resize) does not enlarge images.
+    The file is memory-mapped and reduced by chunks of rows, so large
+    micrographs are never loaded completely in memory.
+    Return the reduced float32 array and the reduction factor.
+    """
+    try:
+        mrc = mrcfile.mmap(mrc_path, mode='r', permissive=True)
+    except (ValueError, OSError):  # e.g. compressed files can not be mapped
+        mrc = mrcfile.open(mrc_path, permissive=True)
+
+    with mrc:
+        data = mrc.data
+        if data.ndim == 3:
+            data = data[0, :, :]
+        h, w = data.shape
+        f = 1
+        if max_size is not None:
+            f = max(1, int(max(w / max_size[0], h / max_size[1])))
+        if f == 1:
+            return np.array(data, dtype=np.float32), 1
+
+        oh, ow = h // f, w // f
+        reduced = np.empty((oh, ow), dtype=np.float32)
+        rows = max(1, chunk_bytes // (f * w * data.itemsize))
+        for r in range(0, oh, rows):
+            r2 = min(oh, r + rows)
+            block = data[r * f:r2 * f, :ow * f].astype(np.float32)
+            reduced[r:r2] = block.reshape(r2 - r, f, ow, f).mean(axis=(1, 3))
+        return reduced, f
+
+
 class Base64Converter:
     def __init__(self, **kwargs):
         self.max_size = kwargs.get('max_size', (512, 512))
         self.contrast_factor = kwargs.get('contrast_factor', None)
+        # Percentiles used as min/max values when converting MRC images
+        self.percentiles = kwargs.get('percentiles', (0.1, 99.9))
         self.scale = 1.0
 
     def from_pil(self, pil_img):
@@ -68,12 +105,14 @@ class Base64Converter:
 
         return encoded
 
-    def from_array(self, imageArray):
+    def from_array(self, imageArray, iMin=None, iMax=None):
         # imean = imageArray.mean()
         # isd = imageArray.std()
-        iMax = imageArray.max()  # min(imean + 10 * isd, imageArray.max())
-        iMin = imageArray.min()  # max(imean - 10 * isd, imageArray.min())
-        im255 = ((imageArray - iMin) / (iMax - iMin) * 255).astype(np.uint8)
+        if iMin is None or iMax is None:
+            iMax = imageArray.max()  # min(imean + 10 * isd, imageArray.max())
+            iMin = imageArray.min()  # max(imean - 10 * isd, imageArray.min())
+        iRange = (iMax - iMin) or 1
+        im255 = (np.clip((imageArray - iMin) / iRange, 0, 1) * 255).astype(np.uint8)
 
         pil_img = Image.fromarray(im255)
 
@@ -81,17 +120,14 @@ class Base64Converter:
 
     def from_mrc(self, mrc_path):
         """ Convert real float32 mrc to base64.
-        Convert to int8 first, then scale with Pillow.
+        The image is reduced (averaging blocks of pixels) close to max_size
+        before normalizing it with the given percentiles and PIL does
+        the final resize. The scale is relative to the original image.
         """
-        mrc_img = mrcfile.open(mrc_path, permissive=True)
-
-        if mrc_img.is_volume():
-            imfloat = mrc_img.data[0, :, :]
-        else:
-            imfloat = mrc_img.data
-
-        result = self.from_array(imfloat)
-        mrc_img.close()
+        reduced, factor = read_mrc_reduced(mrc_path, self.max_size)
+        iMin, iMax = np.percentile(reduced, self.percentiles)
+        result = self.from_array(reduced, iMin, iMax)
+        self.scale *= factor
 
         return result
 
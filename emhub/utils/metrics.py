@@ -0,0 +1,200 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *
+# * [1] SciLifeLab, Stockholm University
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'delarosatrevin@scilifelab.se'
+# *
+# **************************************************************************
+"""
+Simple in-process metrics (counters and histograms) that can be exported
+in the Prometheus text format.
+"""
+
+import time
+import bisect
+import threading
+
+
+def _labels_str(names, values):
+    def _escape(v):
+        return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    return ','.join(f'{n}="{_escape(v)}"' for n, v in zip(names, values))
+
+
+class Counter:
+    TYPE = 'counter'
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, value=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + value
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for labels, v in values:
+            yield self.name, _labels_str(self.labels, labels), v
+
+
+class Gauge(Counter):
+    TYPE = 'gauge'
+
+    def set(self, *labels, value=0):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Counter):
+    TYPE = 'histogram'
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name, doc, labels=(), buckets=None):
+        Counter.__init__(self, name, doc, labels)
+        self.buckets = tuple(buckets or self.BUCKETS)
+
+    def observe(self, *labels, value):
+        with self._lock:
+            if labels not in self._values:
+                self._values[labels] = [[0] * len(self.buckets), 0, 0]
+            h = self._values[labels]
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                h[0][i] += 1
+            h[1] += value
+            h[2] += 1
+
+    def samples(self):
+        with self._lock:
+            values = [(k, (list(v[0]), v[1], v[2])) for k, v in self._values.items()]
+        for labels, (counts, total, count) in values:
+            lstr = _labels_str(self.labels, labels)
+            prefix = lstr + ',' if lstr else ''
+            acc = 0
+            for b, c in zip(self.buckets, counts):
+                acc += c
+                yield f'{self.name}_bucket', f'{prefix}le="{b}"', acc
+            yield f'{self.name}_bucket', f'{prefix}le="+Inf"', count
+            yield f'{self.name}_sum', lstr, total
+            yield f'{self.name}_count', lstr, count
+
+
+class Metrics:
+    """ Collect metrics about requests, SQL queries and Redis commands.
+
+    Per-request values (e.g. number of SQL queries) are accumulated in a
+    thread-local object between start_request and end_request.
+    """
+    SIZE_BUCKETS = (1e3, 1e4, 1e5, 1e6, 1e7, 1e8)
+    QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+    def __init__(self):
+        self._local = threading.local()
+        self._metrics = []
+
+        def _add(m):
+            self._metrics.append(m)
+            return m
+
+        self.requests = _add(Counter(
+            'emhub_requests_total', 'Number of HTTP requests',
+            ('endpoint', 'method', 'status')))
+        self.request_time = _add(Histogram(
+            'emhub_request_duration_seconds', 'Request latency per endpoint',
+            ('endpoint',)))
+        self.content_time = _add(Histogram(
+            'emhub_content_duration_seconds', 'Request latency per content_id',
+            ('content_id',)))
+        self.response_size = _add(Histogram(
+            'emhub_response_size_bytes', 'Response size per endpoint',
+            ('endpoint',), buckets=self.SIZE_BUCKETS))
+        self.sql_queries = _add(Histogram(
+            'emhub_request_sql_queries', 'Number of SQL queries per request',
+            ('endpoint',), buckets=self.QUERY_BUCKETS))
+        self.sql_time = _add(Histogram(
+            'emhub_request_sql_seconds', 'Time spent in SQL queries per request',
+            ('endpoint',)))
+        self.redis_calls = _add(Counter(
+            'emhub_redis_commands_total', 'Number of Redis commands',
+            ('command',)))
+
+    def add(self, metric):
+        """ Register other metric to be exported. """
+        self._metrics.append(metric)
+        return metric
+
+    def start_request(self):
+        local = self._local
+        local.start = time.perf_counter()
+        local.sql_count = 0
+        local.sql_time = 0.0
+
+    def record_sql(self, statement, parameters, elapsed):
+        """ Query listener to be registered in the DbManager. """
+        local = self._local
+        if getattr(local, 'start', None) is not None:
+            local.sql_count += 1
+            local.sql_time += elapsed
+
+    def end_request(self, endpoint, method, status, size=None, content_id=None):
+        local = self._local
+        start = getattr(local, 'start', None)
+        if start is None:
+            return
+
+        elapsed = time.perf_counter() - start
+        local.start = None
+        endpoint = endpoint or 'unknown'
+        self.requests.inc(endpoint, method, str(status))
+        self.request_time.observe(endpoint, value=elapsed)
+        if content_id:
+            self.content_time.observe(content_id, value=elapsed)
+        if size is not None:
+            self.response_size.observe(endpoint, value=size)
+        self.sql_queries.observe(endpoint, value=local.sql_count)
+        self.sql_time.observe(endpoint, value=local.sql_time)
+
+    def wrap_redis(self, redis):
+        """ Count commands executed by the given Redis client. """
+        execute_command = redis.execute_command
+
+        def _execute_command(*args, **kwargs):
+            self.redis_calls.inc(str(args[0]))
+            return execute_command(*args, **kwargs)
+
+        redis.execute_command = _execute_command
+
+    def render(self):
+        """ Return all metrics in the Prometheus text format. """
+        lines = []
+        for m in self._metrics:
+            lines.append(f'# HELP {m.name} {m.doc}')
+            lines.append(f'# TYPE {m.name} {m.TYPE}')
+            for name, labels, value in m.samples():
+                lstr = '{%s}' % labels if labels else ''
+                lines.append(f'{name}{lstr} {value}')
+        return '\n'.join(lines) + '\n'